@@ -31,15 +31,27 @@
 # ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
 # POSSIBILITY OF SUCH DAMAGE.
 
+import json
 import logging
+import os
+import re
+import shlex
+import subprocess
 import sys
+import threading
 from argparse import ArgumentParser
 from base64 import b64encode, b64decode
-from datetime import datetime
+from contextlib import contextmanager
+from copy import copy
+from datetime import datetime, timedelta
+from functools import partial
+from hashlib import sha1, sha256
 from logging import info, debug, warning, error, exception
-from time import sleep
+from random import uniform
+from time import sleep, time
 from types import MethodType
 
+from boto.exception import EC2ResponseError, S3ResponseError
 from boto.s3.connection import S3Connection
 from boto.ec2 import connect_to_region
 from boto.ec2.blockdevicemapping import BlockDeviceMapping, BlockDeviceType
@@ -68,33 +80,603 @@ def check(condition, error_msg):
     if not condition:
         raise AmiCopyError(error_msg)
 
+def new_key(bucket, name):
+    '''Create a key for this copy in a bucket and delete it on cleanup. Keys
+       are prefixed with the copy's name so copies can share a bucket.'''
+    key = bucket.new_key(args.name + '/' + name)
+    cleanup.add(key, 'delete', 'Deleting %s from S3' % name,
+                resource('key', key, bucket = bucket.name))
+    return key
+
+def delete_prefix(bucket, prefix):
+    '''Delete every key in a bucket whose name starts with prefix'''
+    bucket.delete_keys([k.name for k in bucket.list(prefix)])
+
+def upload_key(bucket, name, contents):
+    '''Upload a string to S3 and return a temporary URL for it'''
+    info('Uploading %s to %s', name, bucket.name)
+    key = new_key(bucket, name)
+    key.set_contents_from_string(contents)
+    info('Generating temporary URL for %s', name)
+    return key.generate_url(3600)
+
+def artifact_bucket(region):
+    '''Return the persistent bucket that holds the artifacts for instances
+       in a region, creating it the first time'''
+    with artifact_lock:
+        if region in artifact_buckets:
+            return artifact_buckets[region]
+        name = '%s-%s' % (args.artifact_bucket or 'amicopy-' +
+                          sha1(s3con.aws_access_key_id).hexdigest()[:16],
+                          region)
+        bucket = s3con.lookup(name)
+        if bucket is None:
+            info('Creating S3 bucket %s for artifacts in %s', name, region)
+            try:
+                bucket = s3con.create_bucket(name, location =
+                        region != 'us-east-1' and region or '')
+            except S3ResponseError, e:
+                # Another copy created it first
+                if e.error_code != 'BucketAlreadyOwnedByYou':
+                    raise
+                bucket = s3con.get_bucket(name)
+        artifact_buckets[region] = bucket
+        return bucket
+
+def artifact_url(name, region):
+    '''Upload an artifact to the region's artifact bucket, unless an earlier
+       copy already put the same contents there, and return a temporary URL
+       for it'''
+    artifact = artifacts[name]
+    bucket = artifact_bucket(region)
+    key_name = '%s/%s' % (artifact.digest(), artifact.name)
+    key = bucket.get_key(key_name)
+    if key is None:
+        info('Uploading %s to %s', artifact.name, bucket.name)
+        key = bucket.new_key(key_name)
+        key.set_contents_from_string(artifact.contents())
+    return key.generate_url(3600)
+
+def sg_authorize(sg, protocol, from_port, to_port, cidr):
+    '''Add a rule to a security group. Rules added to a shared security
+       group are revoked on cleanup.'''
+    sg.authorize(protocol, from_port, to_port, cidr)
+    if args.security_group:
+        cleanup.add(partial(sg.revoke, protocol, from_port, to_port, cidr),
+                    '__call__', 'Revoking %s %d-%d from %s in %s' %
+                    (protocol, from_port, to_port, cidr, sg.name),
+                    resource('rule', sg,
+                             rule = [protocol, from_port, to_port, cidr]))
+
+def read_jobs(filename):
+    '''Read a batch file of "AMI SOURCE DESTINATION [OPTIONS]" lines'''
+    jobs = []
+    for n, line in enumerate(open(filename)):
+        fields = shlex.split(line, comments = True)
+        if not fields:
+            continue
+        check(len(fields) >= 3 and not fields[0].startswith('-'),
+              '%s:%d: expected AMI SOURCE DESTINATION [OPTIONS]' %
+              (filename, n + 1))
+        jobs.append(fields)
+    return jobs
+
+def strip_options(argv, options):
+    '''Remove options that take a value, and their values, from a list of
+       arguments'''
+    out = []
+    skip = False
+    for a in argv:
+        if skip:
+            skip = False
+        elif a.split('=', 1)[0] in options:
+            skip = '=' not in a
+        else:
+            out.append(a)
+    return out
+
+def run_batch():
+    '''Run every job in the batch file as a separate copy, sharing one
+       security group per region, and return the number of jobs that
+       failed'''
+    jobs = read_jobs(args.batch)
+    common = strip_options(sys.argv[1:], batch_options)
+    check(jobs, 'No jobs in %s' % args.batch)
+
+    # Shared objects. The jobs already share the artifact bucket of each
+    # source region, or the bucket given with --bucket.
+    accounts = set()
+    for job in jobs:
+        accounts.add((job[1], args.src_key, args.src_secret))
+        for region in job[2].split(','):
+            accounts.add((region, args.dst_key, args.dst_secret))
+    conns = {}
+    for region, key, secret in sorted(accounts):
+        ec2 = ec2_connect(region, aws_access_key_id = key,
+                          aws_secret_access_key = secret)
+        conns[region, key] = ec2
+        info('Creating shared security group %s in %s', args.name, region)
+        sg = ec2.create_security_group(args.name, 'AMI Copy')
+        cleanup.add(sg, 'delete', 'Removing security group %s in %s' %
+                    (args.name, region))
+        sg.authorize('tcp', 22, 22, '0.0.0.0/0')
+
+    # A job that copies a snapshot to a region that an earlier job also
+    # copies it to waits for that job, and then finds it in the snapshot
+    # cache instead of transferring it again
+    copies = []
+    for job in jobs:
+        ami = conns[job[1], args.src_key].get_image(job[0])
+        copies.append(set((job[1], t.snapshot_id, r)
+                          for t in (ami and ami.block_device_mapping or {})
+                                   .values() if t.snapshot_id
+                          for r in job[2].split(',')))
+    deps = [[i for i in range(n) if copies[i] & copies[n]]
+            for n in range(len(jobs))]
+    if args.no_snapshot_cache:
+        deps = [[] for job in jobs]
+
+    # Start jobs as long as they fit in the global and per-region limits
+    lock = threading.Condition()
+    active = {}
+    finished = set()
+    results = [None] * len(jobs)
+    procs = []
+
+    def run(n, job, regions):
+        name = '%s-%d' % (args.name, n + 1)
+        start = time()
+        results[n] = (None, 0, name + '.log')
+        options = ['--name', name, '--security-group', args.name]
+        if args.trace:
+            # Each job writes its own trace, e.g. trace-3.json
+            base, ext = os.path.splitext(args.trace)
+            options += ['--trace', '%s-%d%s' % (base, n + 1, ext)]
+        try:
+            log = open(name + '.log', 'w')
+            p = subprocess.Popen([sys.executable, sys.argv[0]] + job + common +
+                                 options,
+                                 stdout = log, stderr = subprocess.STDOUT)
+            procs.append(p)
+            p.wait()
+            log.close()
+            m = re.search(r'AMI Copy Complete: (.+)',
+                          open(name + '.log').read())
+            results[n] = (p.returncode == 0 and m and m.group(1),
+                          time() - start, name + '.log')
+            info('Job %d (%s %s -> %s) finished', n + 1, job[0], job[1],
+                 job[2])
+        except Exception, e:
+            exception('Job %d failed to run', n + 1)
+
+        lock.acquire()
+        for r in regions:
+            active[r] -= 1
+        active[None] -= 1
+        finished.add(n)
+        lock.notify()
+        lock.release()
+
+    pending = range(len(jobs))
+    active[None] = 0
+    lock.acquire()
+    try:
+        while pending or active[None]:
+            for n in pending[:]:
+                regions = set([jobs[n][1]] + jobs[n][2].split(','))
+                if (active[None] < args.max_jobs and
+                        all(active.get(r, 0) < args.max_region_jobs
+                            for r in regions) and
+                        all(i in finished for i in deps[n])):
+                    pending.remove(n)
+                    for r in regions:
+                        active[r] = active.get(r, 0) + 1
+                    active[None] += 1
+                    info('Starting job %d: %s', n + 1, ' '.join(jobs[n]))
+                    t = threading.Thread(target = run,
+                                         args = (n, jobs[n], regions))
+                    t.daemon = True
+                    t.start()
+            # Wait with a timeout so that CTRL-C still works
+            lock.wait(1)
+    finally:
+        lock.release()
+        # The jobs get the CTRL-C too and clean up after themselves. Wait
+        # for them so that the shared objects aren't in use any more.
+        for p in procs:
+            p.wait()
+
+    print 'Batch results:'
+    for job, result in zip(jobs, results):
+        print '  %-14s %-15s -> %-15s %-14s %6.0fs  %s' % (job[0], job[1],
+                job[2], result[0] or 'FAILED', result[1], result[2])
+    return len([r for r in results if not r[0]])
+
+def make_dirs(path):
+    '''Create a directory and its parents, tolerating another thread
+       creating it first'''
+    try:
+        os.makedirs(path)
+    except OSError:
+        if not os.path.isdir(path):
+            raise
+
+def manifest_path(region, ami_id):
+    '''Return the path of the local chunk manifest for an AMI'''
+    return os.path.join(args.state_dir, 'manifests', region, ami_id + '.json')
+
+def load_manifest(region, ami_id):
+    '''Load the chunk manifest for an AMI, or return None if there isn't
+       one'''
+    try:
+        return json.load(open(manifest_path(region, ami_id)))
+    except IOError:
+        return None
+
+def save_manifest(region, ami_id, manifest):
+    '''Save the chunk manifest for an AMI'''
+    path = manifest_path(region, ami_id)
+    make_dirs(os.path.dirname(path))
+    json.dump(manifest, open(path, 'w'), indent = 1)
+
+def history_path():
+    '''Return the path of the timings of finished copies'''
+    return os.path.join(args.state_dir, 'history.json')
+
+def load_history():
+    '''Return the timings of the copies that have finished, one dict each'''
+    try:
+        return [json.loads(l) for l in open(history_path()) if l.strip()]
+    except IOError:
+        return []
+
+def save_history(run):
+    '''Add the timings of a finished copy to the history'''
+    make_dirs(args.state_dir)
+    f = open(history_path(), 'a')
+    f.write(json.dumps(run) + '\n')
+    f.close()
+
+def median(values):
+    '''Return the median of a list of numbers, or None if it's empty'''
+    values = sorted(values)
+    if not values:
+        return None
+    return values[len(values) / 2]
+
+def volume_rate(bdt):
+    '''Return the MB/s a volume is assumed to read and write at'''
+    if bdt.volume_type == 'io1' and bdt.iops:
+        return min(bdt.iops * 16 / 1024.0, plan_ebs_rates['io1'])
+    return plan_ebs_rates.get(bdt.volume_type, plan_ebs_rates['standard'])
+
+def estimate(inst_type, transport, parallel, volumes, history):
+    '''Estimate a copy of volumes, a list of (bytes, MB/s), to every
+       destination. Return (seconds, MB/s, number of copies it was
+       calibrated from), or None for an instance type with nothing to go
+       on.'''
+    n = len(dests)
+    runs = [r for r in history if r['inst_type'] == inst_type and
+            r['transport'] == transport and r['transfer'] > 0]
+    if runs:
+        # What the source sent. Only S3 sends the data once for every
+        # destination.
+        net = median([r['bytes'] / 1048576.0 / r['transfer'] *
+                      (transport != 's3' and r['destinations'] or 1)
+                      for r in runs])
+    elif inst_type in plan_network:
+        net = plan_network[inst_type] * plan_transport_share[transport]
+    else:
+        return None
+    if transport != 's3':
+        net /= n
+    rate = min(net, min(parallel, len(volumes)) *
+                    median([v[1] for v in volumes]))
+
+    snapshot_rate = median([r['largest'] / 1048576.0 / r['registration']
+                            for r in history
+                            if r['registration'] > 0 and r['largest']])
+    provisioning = median([r['provisioning'] for r in history])
+    seconds = (sum(v[0] for v in volumes) / 1048576.0 / rate +
+               max(v[0] for v in volumes) / 1048576.0 /
+               (snapshot_rate or plan_snapshot_rate) +
+               (provisioning or plan_provisioning))
+    return seconds, rate, len(runs)
+
+def plan_copy():
+    '''Print the volumes to copy, an estimate of the copy with the options
+       given and the instance type, transport and --parallel-volumes that
+       look best'''
+    history = load_history()
+    print 'Plan for %s (%s -> %s)' % (src_ami.id, args.src_region,
+                                      ', '.join(d.region for d in dests))
+    volumes = []
+    for b, t in sorted(src_ami.block_device_mapping.items()):
+        if not t.snapshot_id:
+            continue
+        kind = t.volume_type or 'standard'
+        if t.iops:
+            kind += ' %d IOPS' % t.iops
+        if b in cached_snapshots:
+            print '  %-10s %6d GB  %-16s already copied' % (b, t.size, kind)
+            continue
+        volumes.append((t.size * 1073741824, volume_rate(t)))
+        print '  %-10s %6d GB  %-16s %4.0f MB/s' % (b, t.size, kind,
+                                                     volumes[-1][1])
+    if not volumes:
+        print 'Every volume has been copied before, nothing to transfer'
+        return
+    size = sum(v[0] for v in volumes) / 1073741824.0
+    print 'Transfer: %.0f GB to each destination, %.0f GB out of the source' \
+          ' (%.0f GB with --transport s3)%s' % (size, size * len(dests), size,
+          (args.sparse or args.used_blocks) and ', less the free space' or '')
+
+    def describe(inst_type, transport, parallel):
+        e = estimate(inst_type, transport, parallel, volumes, history)
+        if e is None:
+            return 'no estimate, %s has not been timed' % inst_type
+        seconds, rate, runs = e
+        return '%s at %.0f MB/s (%s)' % (timedelta(seconds = int(seconds)),
+                rate, runs and 'from %d timed cop%s' % (runs, runs == 1 and
+                               'y' or 'ies') or 'no copies timed yet')
+
+    transports = transport == 'auto' and ['tsunami', 'tcp', 's3'] or \
+                 [transport]
+    for t in transports:
+        print 'With these options (%s, %s, %d at a time): %s' % (
+                args.inst_type, t, args.parallel_volumes,
+                describe(args.inst_type, t, args.parallel_volumes))
+
+    # The quickest settings for each instance type, using as few volumes
+    # at a time as gets the quickest estimate
+    options = []
+    for i in sorted(set(plan_network) | set(r['inst_type'] for r in history)):
+        best = None
+        for t in ['tsunami', 'tcp', 's3']:
+            for p in range(1, len(volumes) + 1):
+                e = estimate(i, t, p, volumes, history)
+                if e and (best is None or e[0] < best[0] * 0.999):
+                    best = (e[0], i, t, p)
+        if best:
+            options.append(best)
+    fastest = min(o[0] for o in options)
+    # Instance types with no default are ranked by what they were timed at
+    rank = lambda o: plan_network.get(o[1]) or estimate(o[1], o[2], o[3],
+                                                        volumes, history)[1]
+    chosen = min([o for o in options if o[0] <= fastest * (1 + plan_margin)],
+                 key = rank)
+    print 'Recommended: --inst-type %s --transport %s --parallel-volumes %d' \
+          % chosen[1:]
+    print '  %s' % describe(*chosen[1:])
+    print 'Quickest for each instance type:'
+    for seconds, i, t, p in sorted(options, key = rank):
+        print '  %-12s %-8s %2d at a time  %s' % (i, t, p, describe(i, t, p))
+
+def journal_path(name):
+    '''Return the path of the journal of a copy'''
+    return os.path.join(args.state_dir, 'journals', name + '.json')
+
+def load_journal(name):
+    '''Load the journal of a copy, or return None if there isn't one'''
+    try:
+        return json.load(open(journal_path(name)))
+    except IOError:
+        return None
+
+def resource(kind, obj, **fields):
+    '''Describe an AWS object for the journal, so that a later run can find
+       it again with load_resource()'''
+    fields['kind'] = kind
+    if kind in ('bucket', 'key', 'prefix'):
+        fields['id'] = obj.name
+    else:
+        fields['id'] = obj.id
+        fields['region'] = obj.connection.region.name
+        fields['account'] = obj.connection is ec2src and 'src' or 'dst'
+    return fields
+
+def load_resource(r):
+    '''Look up an AWS object recorded in the journal, or return None if it
+       doesn't exist any more'''
+    try:
+        if r['kind'] == 'bucket':
+            return s3con.get_bucket(r['id'])
+        if r['kind'] == 'key':
+            return s3con.get_bucket(r['bucket']).new_key(r['id'])
+        if r['kind'] == 'prefix':
+            return partial(delete_prefix, s3con.get_bucket(r['id']),
+                           r['prefix'])
+        if r['account'] == 'src':
+            ec2 = ec2src
+        else:
+            ec2 = [d.ec2 for d in dests if d.region == r['region']][0]
+        if r['kind'] == 'sg':
+            return ec2.get_all_security_groups(group_ids = [r['id']])[0]
+        if r['kind'] == 'rule':
+            sg = ec2.get_all_security_groups(group_ids = [r['id']])[0]
+            return partial(sg.revoke, *r['rule'])
+        if r['kind'] == 'instance':
+            i = ec2.get_all_instances([r['id']])[0].instances[0]
+            add_method(i, 'terminate_wait', instance_terminate_wait)
+            return i
+        if r['kind'] == 'volume':
+            v = ec2.get_all_volumes([r['id']])[0]
+            add_method(v, 'detach_wait', volume_detach_wait)
+            return v
+    except (EC2ResponseError, S3ResponseError), e:
+        warning('%s %s no longer exists (%s)', r['kind'], r['id'], e.reason)
+        return None
+    raise AmiCopyError('Unknown resource in journal: %s' % r['kind'])
+
+def snapshot_path(src_region, snapshot_id, dst_region):
+    '''Return the path of the local record of a snapshot's copy in a
+       region'''
+    return os.path.join(args.state_dir, 'snapshots', src_region, snapshot_id,
+                        dst_region + '.json')
+
+def load_snapshot(src_region, snapshot_id, dst_region):
+    '''Load the record of a snapshot's copy in a region, or return None if
+       it hasn't been copied there'''
+    try:
+        return json.load(open(snapshot_path(src_region, snapshot_id,
+                                            dst_region)))
+    except IOError:
+        return None
+
+def save_snapshot(src_region, snapshot_id, dst_region, record):
+    '''Save the record of a snapshot's copy in a region'''
+    path = snapshot_path(src_region, snapshot_id, dst_region)
+    make_dirs(os.path.dirname(path))
+    json.dump(record, open(path, 'w'), indent = 1)
+
+def poll(check, what, timeout = None):
+    '''Call check() until it returns True. The delay between calls starts
+       short and backs off, with some jitter, so quick state changes are
+       noticed quickly without hammering the API during long waits.'''
+    start = time()
+    delay = poll_min
+    while not check():
+        if timeout is not None and time() - start > timeout:
+            raise AmiCopyError('Timed out after %ds waiting for %s' %
+                               (timeout, what))
+        sleep(delay * uniform(1 - poll_jitter, 1 + poll_jitter))
+        delay = min(delay * poll_backoff, poll_max)
+    debug('Waited %.0fs for %s', time() - start, what)
+
+def choose_transport(keys):
+    '''Wait for the instances to time the transports, then return the one
+       that's fastest for the slowest destination. The source times uploads
+       to S3 and each destination times tsunami, TCP and downloads from S3.
+       Whatever has been measured after transport_timeout is used, and
+       tsunami if nothing has.'''
+    links = {}
+    def measured():
+        for instance, key in keys:
+            if instance in links:
+                continue
+            try:
+                report = json.loads(key.get_contents_as_string())
+            except S3ResponseError:
+                continue
+            if 'link' in report:
+                links[instance] = report['link']
+        return len(links) == len(keys)
+    try:
+        poll(measured, 'the instances to time the transports',
+             transport_timeout)
+    except AmiCopyError, e:
+        warning('%s', e)
+
+    # {transport: Mbit/s of the slowest destination}
+    dst_links = [links.get(instance, {}) for instance, key in keys
+                 if instance != 'source']
+    rates = {}
+    for name, field in (('tsunami', lambda l: l['settings']['rate']),
+                        ('tcp', lambda l: l['tcp']),
+                        ('s3', lambda l: l['s3_download'])):
+        try:
+            rates[name] = min(field(l) for l in dst_links)
+        except KeyError:
+            pass
+    if 's3' in rates:
+        if 's3_upload' in links.get('source', {}):
+            rates['s3'] = min(rates['s3'], links['source']['s3_upload'])
+        else:
+            del rates['s3']
+    if not rates:
+        warning('No transport was timed, using tsunami')
+        return 'tsunami'
+    info('Transport rates: %s', ', '.join('%s %.0f Mbit/s' % r
+                                          for r in sorted(rates.items())))
+    return max(rates, key = rates.get)
+
+def refresh(objs):
+    '''Update a list of instances, volumes, snapshots or images with a single
+       describe call per connection'''
+    ec2 = objs[0].connection
+    others = [o for o in objs if o.connection is not ec2]
+    if others:
+        # Objects in other regions can only be described there
+        refresh(others)
+        objs = [o for o in objs if o.connection is ec2]
+    ids = [o.id for o in objs]
+    kind = objs[0].__class__.__name__
+    if kind == 'Instance':
+        fresh = [i for r in ec2.get_all_instances(instance_ids = ids)
+                 for i in r.instances]
+    elif kind == 'Volume':
+        fresh = ec2.get_all_volumes(volume_ids = ids)
+    elif kind == 'Snapshot':
+        fresh = ec2.get_all_snapshots(snapshot_ids = ids)
+    elif kind == 'Image':
+        fresh = ec2.get_all_images(image_ids = ids)
+    else:
+        raise AmiCopyError('cannot refresh %s objects' % kind)
+    fresh = dict((o.id, o) for o in fresh)
+    for o in objs:
+        if o.id in fresh:
+            o.__dict__.update(fresh[o.id].__dict__)
+
+def wait_state(objs, attr, states, what, timeout = None, failed = ()):
+    '''Wait until attr of every object is one of states, refreshing them all
+       with one API call per poll. Fail if any of them reaches one of the
+       failed states.'''
+    def check():
+        try:
+            refresh(objs)
+        except EC2ResponseError, e:
+            # New objects can take a moment to show up in describe calls
+            if e.error_code and e.error_code.endswith('NotFound'):
+                return False
+            raise
+        for o in objs:
+            if getattr(o, attr) in failed:
+                raise AmiCopyError('%s %s is %s' % (what, o.id,
+                                                    getattr(o, attr)))
+        return all(getattr(o, attr) in states for o in objs)
+    with tracer.span('wait for ' + what, 'wait'):
+        poll(check, what, timeout)
+
 def ec2_run_instance_wait(self, *args, **kwargs):
     '''Run an EC2 instance and wait for it to change to the running state'''
     i = self.run_instances(*args, **kwargs).instances[0]
     add_method(i, 'terminate_wait', instance_terminate_wait)
-    while i.state != 'running':
-        sleep(30)
-        i.update()
+    wait_state([i], 'state', ('running',), 'instance to start',
+               wait_timeouts['instance'],
+               failed = ('shutting-down', 'terminated'))
     return i
 
 def instance_terminate_wait(self, *args, **kwargs):
     '''Terminate an EC2 instance and wait for it to change to the terminated
        state'''
     r = self.terminate(*args, **kwargs)
-    while self.state != 'terminated':
-        sleep(30)
-        self.update()
+    wait_state([self], 'state', ('terminated',), 'instance to terminate',
+               wait_timeouts['instance'])
     return r
 
 def volume_detach_wait(self, *args, **kwargs):
     '''Detach a volume and then delete it'''
     r = self.detach(force = True)
-    self.update()
-    while self.status != 'available':
-        sleep(10)
-        self.update()
+    wait_state([self], 'status', ('available',), 'volume to detach',
+               wait_timeouts['volume'])
     return r
 
+def trace_requests(conn, service):
+    '''Record a span for every request made on a boto connection'''
+    make_request = conn.make_request
+    def traced_request(action, *args, **kwargs):
+        with tracer.span('%s %s' % (service, action), 'aws'):
+            return make_request(action, *args, **kwargs)
+    conn.make_request = traced_request
+    return conn
+
+def write_trace():
+    '''Log where the time went and write the trace file'''
+    tracer.summary()
+    if args.trace:
+        info('Writing trace to %s', args.trace)
+        tracer.write(args.trace)
+
 def add_method(obj, name, func):
     '''Add a function to an existing object as a method'''
     setattr(obj, name, MethodType(func, obj))
@@ -103,9 +685,9 @@ def ec2_connect(region, *args, **kwargs):
     '''Connect to a region but fail if the region was invalid'''
     info('Connecting to EC2 region: %s', region)
     ec2 = connect_to_region(region, *args, **kwargs)
-    add_method(ec2, 'run_instance_wait', ec2_run_instance_wait)
     check(ec2 is not None, 'invalid region: %s' % region)
-    return ec2
+    add_method(ec2, 'run_instance_wait', ec2_run_instance_wait)
+    return trace_requests(ec2, 'EC2 ' + region)
 
 ###############################################################################
 # Constants
@@ -139,26 +721,201 @@ valid_block_devs = ['/dev/sdf', '/dev/sdg', '/dev/sdh', '/dev/sdi', '/dev/sdj',
                     '/dev/sdk', '/dev/sdl', '/dev/sdm', '/dev/sdn', '/dev/sdo',
                     '/dev/sdp', ]
 
+tsunami_port = 46224
+stream_port = 46225
+probe_port = 46223
+
+# Manifests are uploaded by the source instance once a volume has been read,
+# which can be a long time after it starts
+manifest_url_expiry = 7 * 86400
+
+# Polling of AWS resources: start at poll_min seconds, back off by
+# poll_backoff per poll up to poll_max, and add +/- poll_jitter
+poll_min = 2
+poll_max = 20
+poll_backoff = 1.5
+poll_jitter = 0.2
+
+# Timeouts in seconds for each kind of wait (None waits forever)
+wait_timeouts = {
+        'instance':     20 * 60,
+        'volume':       15 * 60,
+        'snapshot':     None,
+        'image':        2 * 60 * 60,
+        'transfer':     None,
+        }
+
+# Options that run_batch doesn't pass on to the jobs
+batch_options = ['--batch', '--max-jobs', '--max-region-jobs', '--name',
+                 '--security-group', '--trace']
+
+# Number of threads used to set up the AWS objects for a copy
+provision_threads = 8
+
+# Seconds between polls of the progress reported by the instances
+telemetry_interval = 30
+
+# Number of times the destination tries to fetch a chunk before giving up
+chunk_retries = 5
+
+# S3 transfers send each volume in parts of s3_part_size MB. A volume gets
+# presigned URLs for a few more parts than its encrypted stream can need.
+# With --transport auto the instances time s3_bench_parts parts per stream.
+s3_part_size = 64
+s3_bench_parts = 2
+
+# Seconds to wait for the instances to time the transports with --transport
+# auto before falling back to tsunami
+transport_timeout = 30 * 60
+
+# What --plan assumes until copies with the same settings have been timed:
+# the MB/s an instance type sends between regions, the share of it each
+# transport gets, the MB/s each kind of EBS volume reads and writes at (io1
+# also by its IOPS, at 16KB each), the MB/s snapshots complete at and the
+# seconds provisioning takes
+plan_network = {'m1.small': 15, 'm1.medium': 30, 'c1.medium': 30,
+                'm1.large': 60, 'm2.xlarge': 60, 'm3.xlarge': 60,
+                'm1.xlarge': 100, 'm2.4xlarge': 100, 'm3.2xlarge': 100,
+                'c1.xlarge': 100, 'cc2.8xlarge': 400}
+plan_transport_share = {'tsunami': 0.9, 'tcp': 0.6, 's3': 0.5}
+plan_ebs_rates = {'standard': 40, 'gp2': 128, 'io1': 500}
+plan_snapshot_rate = 30
+plan_provisioning = 5 * 60
+
+# Estimates within plan_margin of the fastest count as just as fast, and the
+# smallest instance type among them is recommended
+plan_margin = 0.1
+
+# Commands used by the transfer scripts to read a source volume and write a
+# destination volume ("$1" is the device). The read commands are filled in
+# with reader_opts.
+raw_read_cmd = 'python amicopy_helper.py read --raw%s "$1"'
+raw_write_cmd = 'dd of="$1" bs=1M'
+sparse_read_cmd = ('python amicopy_helper.py read%s'
+                   + ' --manifests manifests.txt "$1"')
+sparse_write_cmd = 'python amicopy_helper.py write "$1"'
+verify_write_cmd = 'python amicopy_helper.py write --verify%s "$1"'
+used_read_cmd = ('python amicopy_helper.py read --used-only%s'
+                 + ' --manifests manifests.txt "$1"')
+striped_read_cmd = 'python amicopy_helper.py read%s --stripe "$3"/%d "$1"'
+reader_opts = ' --readers %d --meter "$BASE".scanned'
+compress_cmd = 'python amicopy_helper.py compress --level %d'
+decompress_cmd = 'python amicopy_helper.py decompress'
+
+# Each of the transfer scripts below calls itself with a device, an index
+# and a stripe to copy a single volume, or with --stripes one byte range of
+# it. Up to --parallel-volumes volumes are copied at the same time, all of
+# their stripes at once, and each stripe gets its own port (base port +
+# index).
+#
+# The volumes are sent with one of these transports:
+#   tsunami  images are staged on ephemeral0 in chunks and fetched with
+#            tsunami over UDP
+#   tcp      volumes are streamed straight to the destination volumes over
+#            --streams TCP connections each, so nothing is staged and every
+#            stage runs at the same time
+#   s3       volumes are streamed through the S3 bucket in parts, which the
+#            destinations download as soon as they've been uploaded
+# With auto the source and destinations time each of them, and wait for
+# amicopy to publish the one it picked.
 src_data = '''#!/bin/sh
 
 cat << 'SRCEOF' > /media/ephemeral0/amicopy_src.sh
-#!/bin/sh
-set -x; set -e
+#!/bin/bash
+set -x; set -e; set -o pipefail
 cd /media/ephemeral0
-wget --no-check-certificate '%(tsunamid)s' -O tsunamid ; chmod +x tsunamid
+
+if [ -n "$1" ] ; then
+    BASE=`basename "$1"`
+    INDEX=$2
+    if [ %(stripes)d -gt 1 ] ; then BASE="$BASE-$3" ; fi
+    case $TRANSPORT in
+    tsunami)
+        send() {
+            python amicopy_helper.py split --chunk-size %(chunk_size)d \
+                    --manifest "$BASE".manifest "$BASE".img.
+        } ;;
+    tcp)
+        send() {
+            python amicopy_helper.py serve \
+                    --port $((%(stream_port)d + $INDEX)) \
+                    --clients %(destinations)d
+        } ;;
+    s3)
+        send() {
+            python amicopy_helper.py s3-put --urls urls.txt \
+                    --streams %(streams)d --part-size %(s3_part_size)d \
+                    "$BASE"
+        } ;;
+    esac
+    # If reading the volume fails, encrypt finds no .ok file and aborts the
+    # stream, so the destination doesn't take what was sent for all of it
+    rm -f "$BASE".ok
+    { %(read_cmd)s | python amicopy_helper.py meter "$BASE".read \
+            && touch "$BASE".ok ; } \
+            | python amicopy_helper.py encrypt --key-file secret.txt \
+                    --ok-file "$BASE".ok \
+            | send
+    exit 0
+fi
+
+if [ -n '%(tsunamid)s' ] ; then
+    wget --no-check-certificate '%(tsunamid)s' -O tsunamid ; chmod +x tsunamid
+fi
+if [ -n '%(urls)s' ] ; then
+    wget --no-check-certificate '%(urls)s' -O urls.txt
+fi
+wget --no-check-certificate '%(helper)s' -O amicopy_helper.py
+
+# Answer the link probes of the destinations
+TRANSPORT=%(transport)s
+if [ $TRANSPORT = tsunami -o $TRANSPORT = auto ] ; then
+    python amicopy_helper.py probe-server --port %(probe_port)d \
+            > probe.log 2>&1 &
+fi
+
+# Upload the progress of the transfer for amicopy to show
+report() {
+    python amicopy_helper.py report --url '%(progress_url)s' \
+            --chunks staged "$@" || true
+}
+report &
+REPORTER=$!
 
 cat > secret.txt << 'EOF'
 %(secret)s
 EOF
 
-for DEV in /dev/xvd[f-p] ; do
-    BASE=`basename "$DEV"`
-    dd if="$DEV" bs=1M | openssl enc -e -aes-128-cbc -pass file:secret.txt \
-            > "$BASE".img
-    sha1sum "$BASE".img > "$BASE".img.sha1
-done
+cat > manifests.txt << 'EOF'
+%(manifests)s
+EOF
 
-./tsunamid --hbtimeout 600 > tsunamid.log
+# Time uploading to S3, then wait for amicopy to pick the transport
+if [ $TRANSPORT = auto ] ; then
+    python amicopy_helper.py s3-bench --urls urls.txt \
+            --streams %(streams)d --part-size %(s3_part_size)d || true
+    until wget --no-check-certificate -q '%(transport_url)s' \
+            -O transport.txt ; do
+        sleep 10
+    done
+    TRANSPORT=`cat transport.txt`
+fi
+export TRANSPORT
+
+I=0
+for DEV in /dev/xvd[f-p] ; do
+    for S in `seq 0 $((%(stripes)d - 1))` ; do
+        echo "$DEV" $(($I * %(stripes)d + $S)) $S
+    done
+    I=$(($I + 1))
+done | xargs -n 3 -P $((%(parallel_volumes)d * %(stripes)d)) "$0"
+
+# The reporter is a subshell running python, so stop them both
+pkill -P $REPORTER || true ; kill $REPORTER || true
+report --once
+if [ $TRANSPORT = tsunami ] ; then
+    ./tsunamid --hbtimeout 600 > tsunamid.log
+fi
 SRCEOF
 
 chmod +x /media/ephemeral0/amicopy_src.sh
@@ -169,31 +926,147 @@ chmod +x /media/ephemeral0/amicopy_src.sh
 dst_data = '''#!/bin/sh
 
 cat << 'DSTEOF' > /media/ephemeral0/amicopy_dst.sh
-set -x; set -e
+#!/bin/bash
+set -x; set -e; set -o pipefail
 cd /media/ephemeral0
-wget --no-check-certificate '%(tsunami)s' -O tsunami ; chmod +x tsunami
+
+if [ -n "$1" ] ; then
+    BASE=`basename "$1"`
+    INDEX=$2
+    if [ %(stripes)d -gt 1 ] ; then BASE="$BASE-$3" ; fi
+
+    # Decrypt a volume's stream and write it to device $1
+    write_volume() {
+        python amicopy_helper.py decrypt --key-file secret.txt \
+                | python amicopy_helper.py meter "$BASE".written \
+                | %(write_cmd)s
+    }
+
+    case $TRANSPORT in
+    tcp)
+        python amicopy_helper.py fetch --host $SOURCE \
+                --port $((%(stream_port)d + $INDEX)) \
+                --streams %(streams)d | write_volume "$1"
+        ;;
+    s3)
+        python amicopy_helper.py s3-get --urls urls.txt \
+                --streams %(streams)d "$BASE" | write_volume "$1"
+        ;;
+    tsunami)
+        TSUNAMI="./tsunami set rateadjust yes $TUNING
+                set udpport $((%(tsunami_port)d + $INDEX)) connect $SOURCE"
+
+        # Fetch the manifest, then whatever chunks are missing or the wrong
+        # size. Every block of a chunk is checked against the manifest as
+        # it's written to the volume, and a corrupt chunk is removed so that
+        # the next pass fetches it again. Chunks that are already here are
+        # kept, so running this again after a failure only fetches the ones
+        # still needed.
+        PASS=0
+        while true ; do
+            if [ ! -s "$BASE".manifest ] ; then
+                $TSUNAMI get "$BASE".manifest exit < /dev/null || true
+            fi
+            if [ -s "$BASE".manifest ] ; then
+                GETS=
+                while read CHUNK SIZE LEAVES ; do
+                    if [ "`stat -c %%s "$CHUNK" 2> /dev/null`" != "$SIZE" ]
+                    then
+                        rm -f "$CHUNK"
+                        GETS="$GETS get $CHUNK"
+                    fi
+                done < "$BASE".manifest
+                if [ -n "$GETS" ] ; then
+                    $TSUNAMI $GETS exit < /dev/null || true
+                fi
+                if python amicopy_helper.py join "$BASE".manifest \
+                        | write_volume "$1" ; then
+                    break
+                fi
+            fi
+            PASS=$(($PASS + 1))
+            if [ $PASS -gt %(chunk_retries)d ] ; then exit 1 ; fi
+        done
+        ;;
+    esac
+
+    # Flush the volume and tell amicopy, which snapshots it once all of its
+    # stripes are written, while the other volumes still are
+    sync
+    python amicopy_helper.py meter "$BASE".synced < /dev/null > /dev/null
+    python amicopy_helper.py report --url '%(progress_url)s' \
+            --chunks received --once || true
+    exit 0
+fi
+
+if [ -n '%(tsunami)s' ] ; then
+    wget --no-check-certificate '%(tsunami)s' -O tsunami ; chmod +x tsunami
+fi
+if [ -n '%(urls)s' ] ; then
+    wget --no-check-certificate '%(urls)s' -O urls.txt
+fi
+wget --no-check-certificate '%(helper)s' -O amicopy_helper.py
+
+# Upload the progress of the transfer for amicopy to show
+report() {
+    python amicopy_helper.py report --url '%(progress_url)s' \
+            --chunks received "$@" || true
+}
+report &
+REPORTER=$!
 
 cat > secret.txt << 'EOF'
 %(secret)s
 EOF
     
-until nc -z %(source)s 46224 > /dev/null ; do
-    sleep 30
-done
-
-for DEV in /dev/xvd[f-p] ; do
-    BASE=`basename "$DEV"`
-    ./tsunami set rateadjust yes connect %(source)s get "$BASE".img \
-            get "$BASE".img.sha1 exit || true
+# Wait for amicopy to publish the address of the source instance
+until wget --no-check-certificate -q '%(source_url)s' -O source.txt ; do
+    sleep 10
 done
-
+SOURCE=`cat source.txt` ; export SOURCE
+
+# Measure the link from the source while it stages the images and tune
+# tsunami for it. --tsunami-options come last so that they win. With auto
+# the TCP and S3 transports are timed too.
+TRANSPORT=%(transport)s
+TUNING=
+if [ $TRANSPORT = auto ] ; then
+    TUNING=`python amicopy_helper.py probe --host $SOURCE \
+            --port %(probe_port)d --udp-port %(tsunami_port)d \
+            --tcp --urls urls.txt --streams %(streams)d` || TUNING=
+elif [ $TRANSPORT = tsunami -a %(probe)d = 1 ] ; then
+    TUNING=`python amicopy_helper.py probe --host $SOURCE \
+            --port %(probe_port)d --udp-port %(tsunami_port)d` || TUNING=
+fi
+TUNING="$TUNING %(tsunami_options)s" ; export TUNING
+
+# Wait for amicopy to pick the transport from what was measured
+if [ $TRANSPORT = auto ] ; then
+    until wget --no-check-certificate -q '%(transport_url)s' \
+            -O transport.txt ; do
+        sleep 10
+    done
+    TRANSPORT=`cat transport.txt`
+fi
+export TRANSPORT
+
+if [ $TRANSPORT = tsunami ] ; then
+    until nc -z $SOURCE %(tsunami_port)d > /dev/null ; do
+        sleep 30
+    done
+fi
+
+I=0
 for DEV in /dev/xvd[f-p] ; do
-    BASE=`basename "$DEV"`
-    sha1sum -c "$BASE".img.sha1
-    dd if="$BASE".img bs=1M | openssl enc -d -aes-128-cbc \
-            -pass file:secret.txt > "$DEV"
-done
-
+    for S in `seq 0 $((%(stripes)d - 1))` ; do
+        echo "$DEV" $(($I * %(stripes)d + $S)) $S
+    done
+    I=$(($I + 1))
+done | xargs -n 3 -P $((%(parallel_volumes)d * %(stripes)d)) "$0"
+
+# The reporter is a subshell running python, so stop them both
+pkill -P $REPORTER || true ; kill $REPORTER || true
+report --once
 halt
 DSTEOF
 
@@ -203,26 +1076,447 @@ chmod +x /media/ephemeral0/amicopy_dst.sh
 
 '''
 
-tsunamid = load_file('tsunami-udp/tsunamid')
-tsunami = load_file('tsunami-udp/tsunami')
-
 ###############################################################################
 # Classes
 ###############################################################################
+class Artifact(object):
+    '''A file that the instances download. The built amicopy has it
+       embedded base64 encoded by insert_loadfile.py. Either way it's only
+       read or decoded when a copy uploads it.'''
+    def __init__(self, filename, encoded = None):
+        self.name = os.path.basename(filename)
+        self.filename = os.path.abspath(filename)
+        self.encoded = encoded
+        self.__contents = None
+        self.__digest = None
+
+    def contents(self):
+        '''Return the contents of the file'''
+        if self.__contents is None:
+            if self.encoded is not None:
+                self.__contents = b64decode(self.encoded)
+            else:
+                self.__contents = load_file(self.filename)
+        return self.__contents
+
+    def digest(self):
+        '''Return the SHA-256 of the contents, which names the artifact in
+           S3'''
+        if self.__digest is None:
+            self.__digest = sha256(self.contents()).hexdigest()
+        return self.__digest
+
+    def exists(self):
+        '''Return whether the contents are embedded or the file is there'''
+        return self.encoded is not None or os.path.isfile(self.filename)
+
 class Cleanup(object):
-    '''Keep track of a list of functions to call on cleanup'''
-    def __init__(self):
+    '''Keep track of a list of functions to call on cleanup. Objects that
+       are described by resource() are also recorded in the journal.'''
+    def __init__(self, journal = None):
         self.__items = []
-
-    def add(self, obj, func, log, ):
-        self.__items.append((obj, func, log))
+        self.__lock = threading.Lock()
+        self.journal = journal
+
+    def add(self, obj, func, log, resource = None):
+        self.__lock.acquire()
+        if resource and self.journal:
+            resource = dict(resource, method = func, log = log)
+            self.journal.add_resource(resource)
+        self.__items.append((obj, func, log, resource))
+        self.__lock.release()
     
     def cleanup(self):
         info('Cleaning up temporary AWS objects')
         while self.__items:
-            o, f, l = self.__items.pop()
+            o, f, l, r = self.__items.pop()
             info(l)
-            getattr(o, f)()
+            with tracer.span(l, 'cleanup'):
+                getattr(o, f)()
+            if r and self.journal:
+                self.journal.remove_resource(r)
+
+class Journal(object):
+    '''Keep the state of a copy in a file: the AWS objects it created and
+       the phases it has finished. If amicopy dies part way through, the
+       copy can be resumed or cleaned up from here.'''
+    def __init__(self, path, state):
+        self.path = path
+        self.state = state
+        self.__lock = threading.Lock()
+
+    def update(self, **kwargs):
+        self.__lock.acquire()
+        self.state.update(kwargs)
+        self.__write()
+        self.__lock.release()
+
+    def update_destination(self, region, **kwargs):
+        self.__lock.acquire()
+        self.state['destinations'].setdefault(region, {}).update(kwargs)
+        self.__write()
+        self.__lock.release()
+
+    def add_resource(self, resource):
+        self.__lock.acquire()
+        self.state['resources'].append(resource)
+        self.__write()
+        self.__lock.release()
+
+    def remove_resource(self, resource):
+        self.__lock.acquire()
+        self.state['resources'].remove(resource)
+        self.__write()
+        self.__lock.release()
+
+    def remove(self):
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+    def __write(self):
+        # Write a new file and rename it over the old one, so that the
+        # journal is never left half written. The journal has the command
+        # line, which can include AWS keys, so only the owner can read it.
+        if not os.path.isdir(os.path.dirname(self.path)):
+            os.makedirs(os.path.dirname(self.path))
+        fd = os.open(self.path + '.tmp', os.O_WRONLY | os.O_CREAT | os.O_TRUNC,
+                     0600)
+        f = os.fdopen(fd, 'w')
+        json.dump(self.state, f, indent = 1)
+        f.flush()
+        os.fsync(f.fileno())
+        f.close()
+        os.rename(self.path + '.tmp', self.path)
+
+class TaskGraph(object):
+    '''Run functions on a pool of threads, each one as soon as the tasks it
+       depends on have finished, and keep track of how long they took'''
+    def __init__(self):
+        self.tasks = {}
+        self.order = []
+        self.done = {}
+        self.times = {}
+
+    def add(self, name, func, deps = []):
+        for d in deps:
+            assert d in self.tasks, 'unknown dependency: %s' % d
+        self.tasks[name] = (func, deps)
+        self.order.append(name)
+
+    def run(self, threads):
+        '''Run all of the tasks and raise the first exception any of them
+           raised. No new tasks are started once one has failed. On CTRL-C
+           the tasks that are running are waited for before it's raised,
+           unless it's pressed again.'''
+        lock = threading.Condition()
+        pending = self.order[:]
+        running = []
+        errors = []
+        interrupted = False
+        self.start = time()
+
+        def worker(name):
+            started = time()
+            try:
+                with tracer.span(name, 'task'):
+                    self.tasks[name][0]()
+            except BaseException:
+                errors.append(sys.exc_info())
+            lock.acquire()
+            self.times[name] = (started - self.start, time() - self.start)
+            self.done[name] = True
+            running.remove(name)
+            lock.notify()
+            lock.release()
+
+        lock.acquire()
+        try:
+            while pending or running:
+                ready = [n for n in pending
+                         if all(d in self.done for d in self.tasks[n][1])]
+                if errors:
+                    ready = []
+                    pending = []
+                for name in ready[:threads - len(running)]:
+                    pending.remove(name)
+                    running.append(name)
+                    t = threading.Thread(target = worker, args = (name,))
+                    t.daemon = True
+                    t.start()
+                if running:
+                    # Wait with a timeout so that CTRL-C still works
+                    try:
+                        lock.wait(1)
+                    except KeyboardInterrupt:
+                        if interrupted:
+                            raise
+                        # The cleanup that follows would race the running
+                        # tasks for the AWS objects they're creating
+                        interrupted = True
+                        errors.insert(0, sys.exc_info())
+                        warning('Interrupted, waiting for %s to finish',
+                                ', '.join(running))
+        finally:
+            lock.release()
+
+        if errors:
+            raise errors[0][0], errors[0][1], errors[0][2]
+
+    def critical_path(self):
+        '''Return the chain of tasks that determined the total time'''
+        path = []
+        name = max(self.times, key = lambda n: self.times[n][1])
+        while name:
+            path.insert(0, name)
+            deps = self.tasks[name][1]
+            name = deps and max(deps, key = lambda n: self.times[n][1])
+        return path
+
+    def report(self, title):
+        path = self.critical_path()
+        info('%s took %.0fs (critical path: %s)', title,
+             max(t[1] for t in self.times.values()), ' -> '.join(path))
+        for name in self.order:
+            start, end = self.times[name]
+            info('  %s %-28s start %5.0fs  took %5.0fs',
+                 name in path and '*' or ' ', name, start, end - start)
+
+class Destination(object):
+    '''The AWS objects for copying to one destination region'''
+    def __init__(self, region, ec2):
+        self.region = region
+        self.ec2 = ec2
+        self.dst_ami = None
+        self.kernel_id = None
+        self.sg = None
+        self.inst = None
+        self.inst_bdm = {}
+        self.progress_url = None
+        self.artifact_urls = {}
+        self.ami = None
+
+class Tracer(object):
+    '''Record how long each phase of the copy, AWS request and wait takes,
+       and write them as a Chrome trace that chrome://tracing or Perfetto
+       can show'''
+    def __init__(self):
+        self.start = time()
+        self.spans = []
+        self.threads = {}
+        self.__lock = threading.Lock()
+
+    def add(self, name, cat, start, end, thread = None):
+        '''Record a span. thread defaults to the current thread.'''
+        thread = thread or threading.current_thread().name
+        self.__lock.acquire()
+        self.spans.append((name, cat, start, end,
+                           self.threads.setdefault(thread, len(self.threads))))
+        self.__lock.release()
+
+    @contextmanager
+    def span(self, name, cat = 'phase'):
+        start = time()
+        try:
+            yield
+        finally:
+            self.add(name, cat, start, time())
+
+    def total(self, name):
+        '''Return the seconds spent in spans called name, or None if there
+           weren't any'''
+        spans = [s for s in self.spans if s[0] == name]
+        return spans and sum(s[3] - s[2] for s in spans) or None
+
+    def write(self, filename):
+        events = []
+        for thread, tid in self.threads.items():
+            events.append({'name': 'thread_name', 'ph': 'M', 'pid': 1,
+                           'tid': tid, 'args': {'name': thread}})
+        for name, cat, start, end, tid in self.spans:
+            events.append({'name': name, 'cat': cat, 'ph': 'X', 'pid': 1,
+                           'tid': tid,
+                           'ts': int((start - self.start) * 1000000),
+                           'dur': int((end - start) * 1000000)})
+        json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'},
+                  open(filename, 'w'))
+
+    def summary(self):
+        '''Log the time of each phase, and the slowest kinds of request,
+           wait and instance stage'''
+        info('Timing summary (total %.0fs):', time() - self.start)
+        for name, cat, start, end, tid in sorted(self.spans,
+                                                 key = lambda s: s[2]):
+            if cat == 'phase':
+                info('  %-40s start %6.0fs  took %6.0fs', name,
+                     start - self.start, end - start)
+        for cat in ('aws', 'wait', 'instance'):
+            totals = {}
+            for name, c, start, end, tid in self.spans:
+                if c == cat:
+                    t = totals.setdefault(name, [0, 0.0, 0.0])
+                    t[0] += 1
+                    t[1] += end - start
+                    t[2] = max(t[2], end - start)
+            for name, t in sorted(totals.items(),
+                                  key = lambda i: -i[1][1])[:10]:
+                info('  %-8s %-40s %4dx  total %6.1fs  max %6.1fs', cat,
+                     name[:40], t[0], t[1], t[2])
+
+class Telemetry(threading.Thread):
+    '''Poll the progress the instances report to S3 while the transfer runs,
+       and log the throughput of each stage and an estimate of the time
+       left. Each sample is also written to the metrics file as a line of
+       JSON. synced is called with the instance and volume the first time
+       an instance reports that it has flushed a volume. The rate each
+       source volume was read at is logged once it has been read.'''
+    def __init__(self, keys, total, volumes, interval, metrics = None,
+                 synced = None):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.keys = keys
+        self.total = total
+        self.volumes = volumes
+        self.interval = interval
+        self.metrics = metrics and open(metrics, 'a')
+        self.synced = synced
+        self.flushed = set()
+        self.scanned = set()
+        self.last = {}
+        self.stages = {}
+        self.links = set()
+        self.stopped = threading.Event()
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            try:
+                self.poll()
+            except Exception, e:
+                warning('Could not read the transfer progress: %s', e)
+
+    def stop(self):
+        self.stopped.set()
+        self.join()
+        try:
+            self.poll()
+        except Exception, e:
+            warning('Could not read the transfer progress: %s', e)
+        if self.metrics:
+            self.metrics.close()
+
+        # Add the time each instance spent in each stage to the trace. The
+        # instance clocks are mapped to ours with the smallest difference
+        # seen between a report and the poll that read it.
+        for (instance, volume, stage), (start, end, offset) in \
+                sorted(self.stages.items()):
+            if start is not None:
+                tracer.add('%s %s' % (volume, stage), 'instance',
+                           start + offset, end + offset, instance)
+
+    def poll(self):
+        # {instance: {stage: [bytes, rate, volumes done, volumes]}}
+        stages = {}
+        for instance, key in self.keys:
+            try:
+                report = json.loads(key.get_contents_as_string())
+            except S3ResponseError:
+                continue
+            offset = time() - report['time']
+            if 'link' in report and instance not in self.links:
+                self.log_link(instance, report['link'])
+            for volume, volume_stages in sorted(report['volumes'].items()):
+                for stage, (size, done, first, updated) in \
+                        sorted(volume_stages.items()):
+                    if stage == 'synced':
+                        if self.synced and (instance, volume) not in \
+                                self.flushed:
+                            self.flushed.add((instance, volume))
+                            self.synced(instance, volume)
+                        continue
+                    if stage == 'scanned' and done and updated > first and \
+                            (instance, volume) not in self.scanned:
+                        self.scanned.add((instance, volume))
+                        info('Read %s on %s at %.1f MB/s', volume, instance,
+                             size / (updated - first) / 1048576.0)
+                    span = self.stages.get((instance, volume, stage))
+                    if span:
+                        offset = min(offset, span[2])
+                    self.stages[instance, volume, stage] = (first, updated,
+                                                            offset)
+                    # Rates are worked out from the instance's own clock
+                    last = self.last.get((instance, volume, stage))
+                    rate = 0.0
+                    if last and report['time'] > last[0]:
+                        rate = (size - last[1]) / (report['time'] - last[0])
+                    self.last[instance, volume, stage] = (report['time'], size)
+                    totals = stages.setdefault(instance, {})
+                    t = totals.setdefault(stage, [0, 0.0, 0, 0])
+                    t[0] += size
+                    t[1] += rate
+                    t[2] += done
+                    t[3] += 1
+                    if self.metrics:
+                        self.metrics.write(json.dumps({'time': time(),
+                                'copy': args.name, 'instance': instance,
+                                'volume': volume, 'stage': stage,
+                                'bytes': size, 'rate': rate,
+                                'done': done}) + '\n')
+        if self.metrics:
+            self.metrics.flush()
+        if not stages:
+            return
+
+        for instance, instance_stages in sorted(stages.items()):
+            info('Progress %s: %s', instance, ', '.join(
+                    '%s %.1f GB (%.1f MB/s)' % (stage, t[0] / 1073741824.0,
+                                                t[1] / 1048576.0)
+                    for stage, t in sorted(instance_stages.items())))
+        eta = self.eta(stages)
+        if eta is not None:
+            info('Estimated time left: %s', timedelta(seconds = int(eta)))
+
+    def log_link(self, instance, link):
+        '''Log the link an instance measured, the tsunami settings it picked
+           for it and how fast the other transports were'''
+        self.links.add(instance)
+        if 'steps' in link:
+            best = max(link['steps'], key = lambda s: s['mbps'])
+            info('Link from source to %s: RTT %.1f ms, up to %.0f Mbit/s'
+                 ' (%.2f%% loss), background loss %.2f%%', instance,
+                 link['rtt'] * 1000, best['mbps'], best['loss'] * 100,
+                 link['steps'][0]['loss'] * 100)
+            info('Tsunami settings for %s: rate %dM, error %.1f%%,'
+                 ' blocksize %d%s', instance, link['settings']['rate'],
+                 link['settings']['error'], link['settings']['blocksize'],
+                 args.tsunami_options and
+                 ', overridden by "%s"' % args.tsunami_options or '')
+        if 'tcp' in link:
+            info('TCP from source to %s: %.0f Mbit/s over %d connections',
+                 instance, link['tcp'], args.streams)
+        if 's3_upload' in link:
+            info('S3 upload from %s: %.0f Mbit/s', instance,
+                 link['s3_upload'])
+        if 's3_download' in link:
+            info('S3 download to %s: %.0f Mbit/s', instance,
+                 link['s3_download'])
+        if self.metrics:
+            self.metrics.write(json.dumps({'time': time(), 'copy': args.name,
+                    'instance': instance, 'link': link}) + '\n')
+
+    def eta(self, stages):
+        '''Estimate the seconds left: while the source is still reading,
+           from the part of the volumes that hasn't been read, and after
+           that from what the slowest destination has left to write'''
+        read = stages.get('source', {}).get('read')
+        if not read:
+            return None
+        if read[2] < self.volumes:
+            return read[1] and (self.total - read[0]) / read[1] or None
+        etas = []
+        for instance, instance_stages in stages.items():
+            written = instance_stages.get('written')
+            if instance != 'source' and written and written[1]:
+                etas.append(max(read[0] - written[0], 0) / written[1])
+        return etas and max(etas) or None
 
 class AmiCopyError(Exception): pass
 
@@ -233,19 +1527,21 @@ class AmiCopyError(Exception): pass
 parser = ArgumentParser()
 
 # Positional arguments
-parser.add_argument('ami', metavar = 'AMI',
+parser.add_argument('ami', metavar = 'AMI', nargs = '?',
                     help = 'AMI to copy')
-parser.add_argument('src_region', metavar = 'SOURCE',
+parser.add_argument('src_region', metavar = 'SOURCE', nargs = '?',
                     help = 'region of source AMI')
-parser.add_argument('dst_region', metavar = 'DESTINATION',
-                    help = 'destination region for new AMI')
+parser.add_argument('dst_region', metavar = 'DESTINATION', nargs = '?',
+                    help = 'destination region for new AMI, or a comma'
+                           + ' separated list of regions')
 
 # Options
 parser.add_argument('-v', '--verbose', action = 'store_true', default = False,
                     help = 'turn on verbose output')
 
 parser.add_argument('--dst-ami',
-                    help = 'Destination AMI to use for Windows AMIs')
+                    help = 'Destination AMI to use for Windows AMIs (comma'
+                           + ' separated, one per destination region)')
 
 parser.add_argument('--src-key',
                     help = 'access key id for source account')
@@ -259,7 +1555,8 @@ parser.add_argument('--dst-secret',
                            + ' same as destination account)')
 
 parser.add_argument('--kernel-id',
-                    help = 'AKI to use in destination region')
+                    help = 'AKI to use in destination region (comma'
+                           + ' separated, one per destination region)')
 
 parser.add_argument('--key-size', type = int, default = 2048,
                     help = 'length of the secret key used to encrypt the'
@@ -271,6 +1568,103 @@ parser.add_argument('--name', default = ('amicopy'
                         + datetime.now().strftime('%Y%m%d%H%M%S')),
                     help = 'name/tag to use for temporary object (default:'
                            + ' amicopy + timestamp)')
+parser.add_argument('--parallel-volumes', type = int, default = 1,
+                    metavar = 'N',
+                    help = 'number of volumes to copy at the same time'
+                           + ' (default: %(default)s)')
+parser.add_argument('--stripes', type = int, default = 1, metavar = 'N',
+                    help = 'split each volume into N byte ranges that are'
+                           + ' read, sent and written at the same time'
+                           + ' (default: %(default)s)')
+parser.add_argument('--readers', type = int, default = 16, metavar = 'N',
+                    help = 'number of reads of each source volume in flight'
+                           + ' at a time, to hydrate volumes restored from'
+                           + ' snapshots faster (default: %(default)s)')
+parser.add_argument('--sparse', action = 'store_true', default = False,
+                    help = 'only transfer the non-zero parts of each volume')
+parser.add_argument('--used-blocks', action = 'store_true', default = False,
+                    help = 'only transfer blocks that are allocated in ext2/3/4,'
+                           + ' XFS or NTFS filesystems (implies --sparse)')
+parser.add_argument('--compress', action = 'store_true', default = False,
+                    help = 'compress the volumes before encrypting them')
+parser.add_argument('--compress-level', type = int, default = 0,
+                    choices = range(10), metavar = 'LEVEL',
+                    help = 'zlib compression level, 0 picks the level from'
+                           + ' the measured throughput (default: %(default)s)')
+parser.add_argument('--chunk-size', type = int, default = 1024, metavar = 'MB',
+                    help = 'size of the chunks each image is split into for'
+                           + ' the transfer (default: %(default)s)')
+parser.add_argument('--transport', default = 'tsunami',
+                    choices = ['tsunami', 'tcp', 's3', 'auto'],
+                    help = 'how to send the volumes: staged and fetched with'
+                           + ' tsunami, streamed over TCP, streamed through'
+                           + ' S3, or whichever measures fastest (default:'
+                           + ' %(default)s)')
+parser.add_argument('--stream', action = 'store_true', default = False,
+                    help = 'same as --transport tcp')
+parser.add_argument('--streams', type = int, default = 4, metavar = 'N',
+                    help = 'number of TCP connections per volume with'
+                           + ' --transport tcp, or S3 parts in flight per'
+                           + ' volume with --transport s3 (default:'
+                           + ' %(default)s)')
+parser.add_argument('--no-probe', action = 'store_true', default = False,
+                    help = 'don\'t measure the link before a tsunami transfer'
+                           + ' to tune tsunami for it')
+parser.add_argument('--tsunami-options', default = '', metavar = 'COMMANDS',
+                    help = 'tsunami client commands that override the tuned'
+                           + ' settings, e.g. "set rate 300M set error 10"')
+parser.add_argument('--verify', action = 'store_true', default = False,
+                    help = 'read each destination volume back once it has'
+                           + ' been written and check it')
+parser.add_argument('--base-ami',
+                    help = 'AMI in the destination region previously created'
+                           + ' by amicopy; only the chunks that changed since'
+                           + ' it are transferred (implies --sparse)')
+parser.add_argument('--state-dir', default = os.path.expanduser('~/.amicopy'),
+                    help = 'directory for the chunk manifests of copied AMIs,'
+                           + ' the snapshots they were copied to and how long'
+                           + ' copies took (default: %(default)s)')
+parser.add_argument('--plan', action = 'store_true', default = False,
+                    help = 'estimate how long the copy takes and recommend an'
+                           + ' instance type, transport and'
+                           + ' --parallel-volumes, without starting anything')
+parser.add_argument('--resume', metavar = 'NAME',
+                    help = 'continue the copy called NAME after amicopy died,'
+                           + ' using its journal in --state-dir')
+parser.add_argument('--cleanup', metavar = 'NAME',
+                    help = 'remove the temporary AWS objects left behind by'
+                           + ' the copy called NAME')
+parser.add_argument('--trace', metavar = 'FILE',
+                    help = 'write how long each phase, AWS request and wait'
+                           + ' took to FILE as a Chrome trace')
+parser.add_argument('--metrics', metavar = 'FILE',
+                    help = 'append the progress of each transfer stage to FILE'
+                           + ' as lines of JSON')
+parser.add_argument('--no-snapshot-cache', action = 'store_true',
+                    default = False,
+                    help = 'copy every volume, even if its snapshot has been'
+                           + ' copied to the destination region before')
+parser.add_argument('--batch', metavar = 'FILE',
+                    help = 'copy every "AMI SOURCE DESTINATION [OPTIONS]" line'
+                           + ' in FILE instead of a single AMI')
+parser.add_argument('--max-jobs', type = int, default = 4, metavar = 'N',
+                    help = 'number of batch jobs to run at the same time'
+                           + ' (default: %(default)s)')
+parser.add_argument('--max-region-jobs', type = int, default = 2,
+                    metavar = 'N',
+                    help = 'number of batch jobs to run at the same time in'
+                           + ' any one region (default: %(default)s)')
+parser.add_argument('--bucket',
+                    help = 'existing S3 bucket to keep the keys of the copy'
+                           + ' in instead of the artifact bucket')
+parser.add_argument('--artifact-bucket', metavar = 'PREFIX',
+                    help = 'prefix of the buckets, one per region, that keep'
+                           + ' the helper and tsunami binaries between copies'
+                           + ' (default: amicopy- and a hash of the access'
+                           + ' key)')
+parser.add_argument('--security-group',
+                    help = 'existing security group to use in both regions'
+                           + ' instead of creating them (used by --batch)')
 parser.add_argument('--src-keypair',
                     help = 'keypair in source region')
 parser.add_argument('--dst-keypair',
@@ -284,20 +1678,114 @@ parser.add_argument('-V', '--version', action = 'version',
 
 args = parser.parse_args()
 
+# A copy is resumed or cleaned up with the options it was started with
+journal_state = None
+if args.resume or args.cleanup:
+    name = args.resume or args.cleanup
+    journal_state = load_journal(name)
+    if journal_state is None:
+        parser.error('no journal for %s in %s' % (name, journal_path(name)))
+    args = parser.parse_args(journal_state['argv'] + sys.argv[1:]
+                             + ['--name', name])
+
+if not args.batch and not args.dst_region:
+    parser.error('AMI, SOURCE and DESTINATION are required')
+if (not args.batch and journal_state is None
+        and os.path.exists(journal_path(args.name))):
+    parser.error('there is already a copy called %s, use --resume or'
+                 ' --cleanup' % args.name)
+
 if args.dst_key == None: args.dst_key = args.src_key
 if args.dst_secret == None: args.dst_secret = args.src_secret
 
 ###############################################################################
 # Variables
 ###############################################################################
+# State of the copy, kept on disk so that it can be resumed
+journal = None
+if not args.batch:
+    if journal_state is None:
+        journal_state = {'argv': sys.argv[1:] + ['--name', args.name],
+                         'destinations': {}}
+    # Resources that still exist are added back by the Resume section
+    old_resources = journal_state.get('resources', [])
+    journal_state['resources'] = []
+    journal = Journal(journal_path(args.name), journal_state)
+
 # Stuff to clean up when we're done
-cleanup = Cleanup()
+cleanup = Cleanup(journal)
+
+# How long everything takes
+tracer = Tracer()
 
 # Generate secret key
 secret = generate_secret(args.key_size)
 
+# Files the instances download, and the persistent bucket in each region
+# that they're uploaded to
+artifacts = {'helper': Artifact('amicopy_helper.py'),
+             'tsunamid': Artifact('tsunami-udp/tsunamid'),
+             'tsunami': Artifact('tsunami-udp/tsunami')}
+artifact_buckets = {}
+artifact_lock = threading.Lock()
+src_artifact_urls = {}
+
+# Held while a destination snapshot is started and recorded
+snapshot_lock = threading.Lock()
+
+# {(region, volume): stripes written} with --stripes
+synced_stripes = {}
+
+# --stream is the old name of --transport tcp
+transport = args.stream and 'tcp' or args.transport
+
 # User data variables
-userdata = {'secret': secret}
+userdata = {'secret': secret,
+            'tsunami_port': tsunami_port,
+            'stream_port': stream_port,
+            'probe_port': probe_port,
+            'probe': int(not args.no_probe),
+            'tsunami_options': args.tsunami_options,
+            'transport': transport,
+            'streams': args.streams,
+            's3_part_size': s3_part_size,
+            'tsunami': '',
+            'tsunamid': '',
+            'transport_url': '',
+            'chunk_size': args.chunk_size,
+            'chunk_retries': chunk_retries,
+            'parallel_volumes': args.parallel_volumes,
+            'stripes': args.stripes}
+
+# Volumes read by the helper get a chunk manifest
+record_manifests = bool(args.sparse or args.used_blocks or args.base_ami)
+
+if args.stripes > 1:
+    # Each stripe is read by the helper as a sparse image of its byte range.
+    # A manifest covers a whole volume, so none are recorded.
+    record_manifests = False
+    userdata['read_cmd'] = striped_read_cmd % (
+            (args.used_blocks and ' --used-only' or '')
+            + reader_opts % args.readers, args.stripes)
+    userdata['write_cmd'] = sparse_write_cmd
+elif args.used_blocks:
+    userdata['read_cmd'] = used_read_cmd % (reader_opts % args.readers)
+    userdata['write_cmd'] = sparse_write_cmd
+elif args.sparse or args.base_ami:
+    userdata['read_cmd'] = sparse_read_cmd % (reader_opts % args.readers)
+    userdata['write_cmd'] = sparse_write_cmd
+else:
+    userdata['read_cmd'] = raw_read_cmd % (reader_opts % args.readers)
+    userdata['write_cmd'] = raw_write_cmd
+
+# The helper reads back what it wrote, raw images included
+if args.verify:
+    userdata['write_cmd'] = verify_write_cmd % (
+            userdata['write_cmd'] == raw_write_cmd and ' --raw' or '')
+
+if args.compress:
+    userdata['read_cmd'] += ' | ' + compress_cmd % args.compress_level
+    userdata['write_cmd'] = decompress_cmd + ' | ' + userdata['write_cmd']
 
 ###############################################################################
 # Set up logging
@@ -314,93 +1802,418 @@ logging.basicConfig(format = '%(asctime)s %(levelname)s: %(message)s',
                     level = level,
                     stream = sys.stdout)
 
+###############################################################################
+# Batch Mode
+###############################################################################
+if args.batch:
+    try:
+        failed = run_batch()
+    except (Exception, KeyboardInterrupt) as e:
+        exception('Batch failed')
+        failed = 1
+    try:
+        cleanup.cleanup()
+    except Exception, ce:
+        exception('Error during cleanup')
+    sys.exit(failed and 1 or 0)
+
 ###############################################################################
 # Connections
 ###############################################################################
 # Connect to AWS
+connect_start = time()
 ec2src = ec2_connect(args.src_region, aws_access_key_id = args.src_key,
                      aws_secret_access_key = args.src_secret)
-ec2dst = ec2_connect(args.dst_region, aws_access_key_id = args.dst_key,
-                     aws_secret_access_key = args.dst_secret)
+dests = []
+for region in args.dst_region.split(','):
+    dests.append(Destination(region, ec2_connect(region,
+            aws_access_key_id = args.dst_key,
+            aws_secret_access_key = args.dst_secret)))
 
 info('Connecting to S3')
-s3con = S3Connection(aws_access_key_id = args.src_key,
-                     aws_secret_access_key = args.src_secret)
+s3con = trace_requests(S3Connection(aws_access_key_id = args.src_key,
+                                    aws_secret_access_key = args.src_secret),
+                       'S3')
+tracer.add('connect', 'phase', connect_start, time())
+
+###############################################################################
+# Resume
+###############################################################################
+# Pick up the AWS objects that an earlier run of this copy created. Objects
+# that are gone, like instances that have terminated, are dropped.
+for r in old_resources:
+    obj = load_resource(r)
+    if obj is not None:
+        cleanup.add(obj, r['method'], r['log'], r)
+
+if args.cleanup:
+    try:
+        cleanup.cleanup()
+    except (Exception, KeyboardInterrupt) as e:
+        exception('Error during cleanup')
+        print 'Cleanup Failed!'
+        sys.exit(1)
+    journal.remove()
+    print 'Cleanup Complete: %s' % args.name
+    sys.exit(0)
 
 ###############################################################################
 # Pre-flight Checks
 ###############################################################################
 # Make sure AMI is valid
+preflight_start = time()
 info('Checking source AMI')
 src_ami = ec2src.get_image(args.ami)
 check(src_ami is not None, 'Invalid AMI: %s' % args.ami)
 
-# Make sure the AMI name is unique in the dest region
-info('Checking if AMI name exists in destination region')
-n = ec2dst.get_all_images(filters = {'name': src_ami.name})
-check(len(n) == 0, 'AMI name %s already exists in destination region' %
-      src_ami.name)
-
-# Make sure the kernel id is valid
-dst_kernel_id = None
-if src_ami.kernel_id is not None:
-    if args.kernel_id:
-        dst_kernel_id = args.kernel_id
-    else:
-        info('Determining destination kernel id')
-        if pvgrub_kernel_ids[args.src_region] == src_ami.kernel_id:
-            dst_kernel_id = pvgrub_kernel_ids[args.dst_region]
+check(args.parallel_volumes > 0, '--parallel-volumes must be at least 1')
+check(args.chunk_size > 0, '--chunk-size must be at least 1')
+check(args.streams > 0, '--streams must be at least 1')
+check(args.stripes > 0, '--stripes must be at least 1')
+check(args.readers > 0, '--readers must be at least 1')
+check(args.stripes == 1 or not args.base_ami,
+      '--stripes can\'t be used with --base-ami')
+check(not (args.stream and args.transport not in ('tsunami', 'tcp')),
+      '--stream can\'t be used with --transport %s' % args.transport)
+check(not (transport in ('tcp', 's3') and args.tsunami_options),
+      '--tsunami-options can\'t be used with --transport %s' % transport)
+check(re.match(r'^[\w .%-]*$', args.tsunami_options),
+      '--tsunami-options should only be tsunami set commands')
+
+# Every destination gets the same stream from the source instance
+regions = [dst.region for dst in dests]
+check(len(set(regions)) == len(regions),
+      'Destination regions must be different')
+userdata['destinations'] = len(dests)
+
+# --dst-ami and --kernel-id are region specific, so they take one value per
+# destination region
+dst_amis = args.dst_ami and args.dst_ami.split(',') or [None] * len(dests)
+check(len(dst_amis) == len(dests),
+      '--dst-ami needs one AMI per destination region')
+kernel_ids = (args.kernel_id and args.kernel_id.split(',')
+              or [None] * len(dests))
+check(len(kernel_ids) == len(dests),
+      '--kernel-id needs one kernel id per destination region')
+
+for dst, dst_ami, kernel_id in zip(dests, dst_amis, kernel_ids):
+    # Make sure the AMI name is unique in the dest region, unless this copy
+    # registered it before it was resumed
+    info('Checking if AMI name exists in %s', dst.region)
+    n = dst.ec2.get_all_images(filters = {'name': src_ami.name})
+    check(len(n) == 0 or 'ami' in
+          journal.state['destinations'].get(dst.region, {}),
+          'AMI name %s already exists in %s' % (src_ami.name, dst.region))
+
+    # Make sure the kernel id is valid
+    if src_ami.kernel_id is not None:
+        if kernel_id:
+            dst.kernel_id = kernel_id
         else:
-            raise AmiCopyError('Could not determine destination kernel' +
-                               ' id. Specify it using --kernel-id')
-
-# Check to make sure that a dest AMI is specified for Windows
-if src_ami.platform == 'windows':
-    info('Checking destination AMI (Windows)')
-    check(args.dst_ami,
-          'Destination AMI must be specified for Windows AMIs')
-    a = ec2dst.get_all_images([args.dst_ami])
-    check(len(a) > 0, 'Destination AMI not found')
-    check(a[0].platform == 'windows',
-            'Destination AMI is not a Windows AMI')
+            info('Determining kernel id for %s', dst.region)
+            if pvgrub_kernel_ids[args.src_region] == src_ami.kernel_id:
+                dst.kernel_id = pvgrub_kernel_ids[dst.region]
+            else:
+                raise AmiCopyError('Could not determine destination kernel' +
+                                   ' id. Specify it using --kernel-id')
+
+    # Check to make sure that a dest AMI is specified for Windows
+    if src_ami.platform == 'windows':
+        info('Checking destination AMI (Windows) in %s', dst.region)
+        check(dst_ami,
+              'Destination AMI must be specified for Windows AMIs')
+        a = dst.ec2.get_all_images([dst_ami])
+        check(len(a) > 0, 'Destination AMI not found in %s' % dst.region)
+        check(a[0].platform == 'windows',
+                'Destination AMI is not a Windows AMI')
+        dst.dst_ami = dst_ami
+
+# Make sure there's a manifest for the base AMI
+base_ami = None
+base_manifest = None
+if args.base_ami:
+    info('Checking base AMI')
+    check(len(dests) == 1,
+          '--base-ami only works with one destination region')
+    base_ami = dests[0].ec2.get_image(args.base_ami)
+    check(base_ami is not None, 'Invalid base AMI: %s' % args.base_ami)
+    base_manifest = load_manifest(dests[0].region, args.base_ami)
+    check(base_manifest is not None,
+          'No manifest for base AMI %s in %s' % (args.base_ami,
+          manifest_path(dests[0].region, args.base_ami)))
+
+# Look up the snapshots that have already been copied to every destination
+# region. Their volumes aren't transferred again. Windows AMIs are created
+# from an instance with the copied volumes attached, so they always copy.
+cached_snapshots = {}
+if not args.no_snapshot_cache and src_ami.platform != 'windows':
+    for b, t in src_ami.block_device_mapping.items():
+        if t.snapshot_id:
+            records = {}
+            for dst in dests:
+                r = load_snapshot(args.src_region, t.snapshot_id, dst.region)
+                if r:
+                    records[dst.region] = r
+            if len(records) == len(dests):
+                cached_snapshots[b] = records
+
+    # Make sure the copies still exist. A copy is as large as the volume of
+    # the AMI it was made for, which may be larger than this AMI's, and a
+    # block device can't be smaller than its snapshot.
+    for dst in dests:
+        ids = [r[dst.region]['snapshot_id'] for r in cached_snapshots.values()]
+        if not ids:
+            continue
+        info('Checking snapshots copied to %s before', dst.region)
+        snapshots = dst.ec2.get_all_snapshots(filters = {'snapshot-id': ids,
+                                                         'status': 'completed'})
+        found = dict((ss.id, ss.volume_size) for ss in snapshots)
+        for b, r in cached_snapshots.items():
+            size = found.get(r[dst.region]['snapshot_id'])
+            if size is None:
+                warning('Copy of %s in %s no longer exists', b, dst.region)
+                del cached_snapshots[b]
+            elif size > src_ami.block_device_mapping[b].size:
+                warning('Copy of %s in %s is %d GB, larger than its %d GB'
+                        ' volume here', b, dst.region, size,
+                        src_ami.block_device_mapping[b].size)
+                del cached_snapshots[b]
+
+# With --plan nothing is started
+if args.plan:
+    plan_copy()
+    sys.exit(0)
+
+# Make sure the files the instances need are there
+for name in ['helper'] + (transport in ('tsunami', 'auto') and
+                          ['tsunamid', 'tsunami'] or []):
+    check(artifacts[name].exists(), '%s not found, run make first' %
+          artifacts[name].filename)
+
+tracer.add('pre-flight checks', 'phase', preflight_start, time())
 
 ###############################################################################
-# Copy
+# Provisioning Steps
 ###############################################################################
-try:
-    # Upload tsunami to S3
-    info('Creating temporary S3 bucket: %s', args.name)
-    bucket = s3con.create_bucket(args.name)
-    cleanup.add(bucket, 'delete', 'Removing S3 bucket: %s' % args.name)
-
-    info('Uploading tsunamid to %s', args.name)
-    key = bucket.new_key('tsunamid')
-    key.set_contents_from_string(tsunamid)
-    cleanup.add(key, 'delete', 'Deleting tsunamid from S3')
-    info('Generating temporary URL for tsunamid')
-    userdata['tsunamid'] = key.generate_url(3600)
-    
-    info('Uploading tsunami to %s', args.name)
-    key = bucket.new_key('tsunami')
-    key.set_contents_from_string(tsunami)
-    cleanup.add(key, 'delete', 'Deleting tsunami from S3')
-    info('Generating temporary URL for tsunami')
-    userdata['tsunami'] = key.generate_url(3600)
-
-    # Create the security groups
+# Each of these sets up one AWS object for the copy. They're run by a
+# TaskGraph, so they only depend on the globals set by the steps they're
+# declared to depend on. Steps for a destination region are passed its
+# Destination.
+def create_bucket():
+    # The keys of the copy go in the source region's artifact bucket, under
+    # the name of the copy, and are deleted on cleanup
+    global bucket
+    if args.bucket:
+        bucket = s3con.get_bucket(args.bucket)
+    else:
+        bucket = artifact_bucket(args.src_region)
+
+def upload_src_artifacts():
+    names = ['helper'] + (transport in ('tsunami', 'auto') and
+                          ['tsunamid'] or [])
+    for name in names:
+        src_artifact_urls[name] = artifact_url(name, args.src_region)
+
+def upload_dst_artifacts(dst):
+    names = ['helper'] + (transport in ('tsunami', 'auto') and
+                          ['tsunami'] or [])
+    for name in names:
+        dst.artifact_urls[name] = artifact_url(name, dst.region)
+
+def create_source_key():
+    # The destination instances are started without waiting for the source
+    # instance, and fetch the source address from here once it's known
+    global source_key
+    source_key = new_key(bucket, 'source')
+    userdata['source_url'] = source_key.generate_url(3600)
+
+def upload_manifests():
+    # The source records a chunk manifest for each volume it reads with the
+    # helper, and uses the base AMI's manifest to skip unchanged chunks
+    lines = []
+    if record_manifests:
+        for b, d in device_map.items():
+            dev = 'xvd' + d[-1]
+            base_url = '-'
+            if b in base_devices:
+                info('Using base manifest for %s', b)
+                base_url = upload_key(bucket, 'base-' + dev,
+                                      base_manifest['volumes'][b])
+            key = new_key(bucket, 'manifest-' + dev)
+            manifest_keys[b] = key
+            put_url = key.generate_url(manifest_url_expiry, 'PUT',
+                    headers = {'Content-Type': 'application/octet-stream'})
+            lines.append('%s %s %s' % (dev, base_url, put_url))
+    userdata['manifests'] = '\n'.join(lines)
+
+def upload_transfer_urls():
+    # S3 transfers need a presigned URL for every part of every volume, PUT
+    # for the source and GET for the destinations. There are too many to fit
+    # in the user data, so they're uploaded as a file for each side.
+    global src_urls_url, dst_urls_url
+    src_urls_url = dst_urls_url = ''
+    if transport not in ('s3', 'auto'):
+        return
+    streams = [('bench', s3_bench_parts * args.streams)]
+    for b, d in device_map.items():
+        size = src_ami.block_device_mapping[b].size * 1024 / args.stripes
+        names = ['xvd' + d[-1]]
+        if args.stripes > 1:
+            names = ['xvd%s-%d' % (d[-1], i) for i in range(args.stripes)]
+        for name in names:
+            streams.append((name, size * 101 / 100 / s3_part_size + 3))
+    prefix = args.name + '/parts/'
+    cleanup.add(partial(delete_prefix, bucket, prefix), '__call__',
+                'Deleting transfer parts from S3',
+                resource('prefix', bucket, prefix = prefix))
+    src_lines = []
+    dst_lines = []
+    for name, parts in streams:
+        for i in range(parts) + ['done']:
+            key = bucket.new_key('%s%s.%s' % (prefix, name, i))
+            src_lines.append('%s %s %s' % (name, i, key.generate_url(
+                    manifest_url_expiry, 'PUT',
+                    headers = {'Content-Type': 'application/octet-stream'})))
+            dst_lines.append('%s %s %s' % (name, i,
+                    key.generate_url(manifest_url_expiry)))
+    src_urls_url = upload_key(bucket, 'urls-source', '\n'.join(src_lines))
+    dst_urls_url = upload_key(bucket, 'urls-destination',
+                              '\n'.join(dst_lines))
+
+def create_transport_key():
+    # With --transport auto the instances fetch the transport from here once
+    # amicopy has picked it
+    global transport_key
+    transport_key = None
+    if transport == 'auto':
+        transport_key = new_key(bucket, 'transport')
+        userdata['transport_url'] = transport_key.generate_url(
+                manifest_url_expiry)
+
+def create_progress_keys():
+    # Each instance uploads the progress of its transfer stages here
+    global progress_keys, src_progress_url
+    progress_keys = [('source', new_key(bucket, 'progress-source'))]
+    src_progress_url = progress_keys[0][1].generate_url(manifest_url_expiry,
+            'PUT', headers = {'Content-Type': 'application/octet-stream'})
+    for dst in dests:
+        key = new_key(bucket, 'progress-' + dst.region)
+        progress_keys.append((dst.region, key))
+        dst.progress_url = key.generate_url(manifest_url_expiry, 'PUT',
+                headers = {'Content-Type': 'application/octet-stream'})
+
+def create_src_sg():
+    global src_sg
+    if args.security_group:
+        src_sg = ec2src.get_all_security_groups([args.security_group])[0]
+        return
     info('Creating source security group: %s', args.name)
     src_sg = ec2src.create_security_group(args.name, 'AMI Copy')
     cleanup.add(src_sg, 'delete',
-                'Removing source security group: %s' % args.name)
+                'Removing source security group: %s' % args.name,
+                resource('sg', src_sg))
     info('Allowing SSH access from 0.0.0.0/0')
     src_sg.authorize('tcp', 22, 22, '0.0.0.0/0')
-   
-    info('Creating destination security group: %s', args.name)
-    dst_sg = ec2dst.create_security_group(args.name, 'AMI Copy')
-    cleanup.add(dst_sg, 'delete',
-                'Removing destination security group: %s' % args.name)
+
+def create_dst_sg(dst):
+    if args.security_group:
+        dst.sg = dst.ec2.get_all_security_groups([args.security_group])[0]
+        return
+    info('Creating destination security group %s in %s', args.name,
+         dst.region)
+    dst.sg = dst.ec2.create_security_group(args.name, 'AMI Copy')
+    cleanup.add(dst.sg, 'delete', 'Removing destination security group %s'
+                ' in %s' % (args.name, dst.region), resource('sg', dst.sg))
     info('Allowing SSH access from 0.0.0.0/0')
-    dst_sg.authorize('tcp', 22, 22, '0.0.0.0/0')
+    dst.sg.authorize('tcp', 22, 22, '0.0.0.0/0')
+
+def start_src_inst():
+    global src_inst
+    info('Starting EC2 source instance')
+    src_inst = ec2src.run_instance_wait(amazon_linux_ebs_64[args.src_region],
+            key_name = args.src_keypair,
+            security_groups = [src_sg.name],
+            user_data = src_data % dict(userdata,
+                                        progress_url = src_progress_url,
+                                        urls = src_urls_url,
+                                        **src_artifact_urls),
+            instance_type = args.inst_type,
+            block_device_map = src_inst_bdm,
+            instance_initiated_shutdown_behavior = 'terminate')
+    cleanup.add(src_inst, 'terminate_wait', 'Terminating source instance',
+                resource('instance', src_inst))
+
+    info('Tagging EC2 source instance')
+    ec2src.create_tags([src_inst.id], {'Name': args.name})
+
+def publish_source():
+    info('Publishing source address %s', src_inst.public_dns_name)
+    source_key.set_contents_from_string(src_inst.public_dns_name)
+
+def start_dst_inst(dst):
+    info('Starting EC2 destination instance in %s', dst.region)
+    dst.inst = dst.ec2.run_instance_wait(amazon_linux_ebs_64[dst.region],
+            key_name = args.dst_keypair,
+            security_groups = [dst.sg.name],
+            user_data = dst_data % dict(userdata,
+                                        progress_url = dst.progress_url,
+                                        urls = dst_urls_url,
+                                        **dst.artifact_urls),
+            instance_type = args.inst_type,
+            block_device_map = dst_inst_bdm,
+            instance_initiated_shutdown_behavior = 'terminate')
+    
+    # Clean up created volumes
+    dst.inst_bdm = dst.inst.block_device_mapping
+    vol_ids = []
+    for b in dst.inst_bdm.keys():
+        if dst.inst_bdm[b].volume_id and b != '/dev/sda1':
+            vol_ids.append(dst.inst_bdm[b].volume_id)
+    vols = dst.ec2.get_all_volumes(vol_ids)
+    for v in vols:
+        cleanup.add(v, 'delete', 'Deleting destination volume in %s' %
+                    dst.region, resource('volume', v))
+
+    cleanup.add(dst.inst, 'terminate_wait',
+                'Terminating destination instance in %s' % dst.region,
+                resource('instance', dst.inst))
+    
+    info('Tagging EC2 destination instance in %s', dst.region)
+    dst.ec2.create_tags([dst.inst.id], {'Name': args.name})
+
+def authorize_src_sg(dst):
+    # Each stripe of each volume gets its own port so that they can be
+    # copied in parallel. S3 transfers don't need any rules, and auto needs
+    # all of them.
+    last_port = len(device_map) * args.stripes - 1
+    rules = []
+    if transport in ('tcp', 'auto'):
+        rules.append(('streaming', stream_port, stream_port + last_port))
+    if transport in ('tsunami', 'auto'):
+        rules.append(('tsunamid', tsunami_port, tsunami_port))
+    if transport == 'auto' or transport == 'tsunami' and not args.no_probe:
+        rules.append(('link probes', probe_port, probe_port))
+    for what, from_port, to_port in rules:
+        info('Allowing TCP access to source instance for %s from %s', what,
+             dst.region)
+        sg_authorize(src_sg, 'tcp', from_port, to_port,
+                     dst.inst.ip_address + '/32')
+        sg_authorize(src_sg, 'tcp', from_port, to_port,
+                     dst.inst.private_ip_address + '/32')
+
+def authorize_dst_sg(dst):
+    last_port = len(device_map) * args.stripes - 1
+    info('Allowing UDP access to destination instance in %s for tsunami',
+         dst.region)
+    sg_authorize(dst.sg, 'udp', tsunami_port, tsunami_port + last_port,
+                 src_inst.ip_address + '/32')
+    sg_authorize(dst.sg, 'udp', tsunami_port, tsunami_port + last_port,
+                 src_inst.private_ip_address + '/32')
+
+def provision():
+    '''Set up the instances and everything else needed for the transfer'''
+    global src_inst_bdm, dst_inst_bdm, device_map, base_devices, manifest_keys
+    global progress_keys, transport_key
 
     # Set up device mapping variables
     info('Generating a list of EBS volumes to copy')
@@ -408,17 +2221,26 @@ try:
     tmp_dev = valid_block_devs[:]
     # Grab the source AMI BDM
     src_ami_bdm = src_ami.block_device_mapping
-    # Use the source AMI BDM as the base for the destination AMI BDM
-    dst_ami_bdm = src_ami.block_device_mapping
-    # The instance BDMs should be empty to start with
+    # The instance BDMs should be empty to start with. Every destination
+    # instance is launched with the same BDM.
     src_inst_bdm = BlockDeviceMapping()
     dst_inst_bdm = BlockDeviceMapping()
     device_map = {}
+    base_devices = []
 
     # Generate the instance BDMs and keep track of the mappings
     for b in src_ami_bdm.keys():
-        if src_ami_bdm[b].snapshot_id:
+        if src_ami_bdm[b].snapshot_id and b not in cached_snapshots:
             d = tmp_dev.pop(0)
+            # Restore the destination volume from the base AMI if it has a
+            # manifest for the same device and size
+            base_snapshot_id = None
+            if (base_ami and b in base_manifest['volumes']
+                    and b in base_ami.block_device_mapping
+                    and base_ami.block_device_mapping[b].size
+                        == src_ami_bdm[b].size):
+                base_snapshot_id = base_ami.block_device_mapping[b].snapshot_id
+                base_devices.append(b)
             src_inst_bdm[d] = BlockDeviceType(
                     snapshot_id = src_ami_bdm[b].snapshot_id,
                     size = src_ami_bdm[b].size,
@@ -426,6 +2248,7 @@ try:
                     volume_type = src_ami_bdm[b].volume_type,
                     iops = src_ami_bdm[b].iops,)
             dst_inst_bdm[d] = BlockDeviceType(
+                    snapshot_id = base_snapshot_id,
                     size = src_ami_bdm[b].size,
                     delete_on_termination = False,
                     volume_type = src_ami_bdm[b].volume_type,
@@ -436,81 +2259,130 @@ try:
     src_inst_bdm['/dev/sdb'] = BlockDeviceType(ephemeral_name = 'ephemeral0')
     dst_inst_bdm['/dev/sdb'] = BlockDeviceType(ephemeral_name = 'ephemeral0')
 
-    # Start source instance
-    info('Starting EC2 source instance')
-    src_inst = ec2src.run_instance_wait(amazon_linux_ebs_64[args.src_region],
-            key_name = args.src_keypair,
-            security_groups = [args.name],
-            user_data = src_data % userdata,
-            instance_type = args.inst_type,
-            block_device_map = src_inst_bdm,
-            instance_initiated_shutdown_behavior = 'terminate')
-    cleanup.add(src_inst, 'terminate_wait', 'Terminating source instance')
-
-    info('Tagging EC2 source instance')
-    ec2src.create_tags([src_inst.id], {'Name': args.name})
+    manifest_keys = {}
+    progress_keys = []
+    transport_key = None
 
-    userdata['source'] = src_inst.public_dns_name
-
-    # Start the destination instance
-    info('Starting EC2 destination instance')
-    dst_inst = ec2dst.run_instance_wait(amazon_linux_ebs_64[args.dst_region],
-            key_name = args.dst_keypair,
-            security_groups = [args.name],
-            user_data = dst_data % userdata,
-            instance_type = args.inst_type,
-            block_device_map = dst_inst_bdm,
-            instance_initiated_shutdown_behavior = 'terminate')
-    
-    # Clean up created volumes
-    dst_inst_bdm = dst_inst.block_device_mapping
-    vol_ids = []
-    for b in dst_inst_bdm.keys():
-        if dst_inst_bdm[b].volume_id and b != '/dev/sda1':
-            vol_ids.append(dst_inst_bdm[b].volume_id)
-    vols = ec2dst.get_all_volumes(vol_ids)
-    for v in vols:
-        cleanup.add(v, 'delete', 'Deleting destination volume')
+    if not device_map:
+        info('Every volume has been copied before, skipping the transfer')
+    else:
+        # Set up everything that's needed for the transfer. Independent
+        # steps, like the security groups and instances in each region,
+        # run at the same time.
+        steps = TaskGraph()
+        steps.add('bucket', create_bucket)
+        steps.add('source artifacts', upload_src_artifacts)
+        steps.add('source address key', create_source_key, ['bucket'])
+        steps.add('upload manifests', upload_manifests, ['bucket'])
+        steps.add('progress keys', create_progress_keys, ['bucket'])
+        steps.add('transfer URLs', upload_transfer_urls, ['bucket'])
+        steps.add('transport key', create_transport_key, ['bucket'])
+        steps.add('source SG', create_src_sg)
+        src_deps = ['source SG', 'source artifacts', 'upload manifests',
+                    'progress keys', 'transfer URLs', 'transport key']
+        dst_deps = ['source address key', 'progress keys', 'transfer URLs',
+                    'transport key']
+        steps.add('source instance', start_src_inst, src_deps)
+        steps.add('publish source address', publish_source,
+                  ['source instance', 'source address key'])
+        for dst in dests:
+            r = ' ' + dst.region
+            steps.add('destination SG' + r, partial(create_dst_sg, dst))
+            steps.add('destination artifacts' + r,
+                      partial(upload_dst_artifacts, dst))
+            steps.add('destination instance' + r, partial(start_dst_inst, dst),
+                      dst_deps + ['destination SG' + r,
+                                  'destination artifacts' + r])
+            steps.add('source SG rules' + r, partial(authorize_src_sg, dst),
+                      ['source SG', 'destination instance' + r])
+            if transport in ('tsunami', 'auto'):
+                steps.add('destination SG rules' + r,
+                          partial(authorize_dst_sg, dst),
+                          ['destination SG' + r, 'source instance'])
+        steps.run(provision_threads)
+        steps.report('Provisioning')
 
-    cleanup.add(dst_inst, 'terminate_wait', 'Terminating destination instance')
-    
-    info('Tagging EC2 destination instance')
-    ec2dst.create_tags([dst_inst.id], {'Name': args.name})
-
-    # Set up security groups for Tsunami
-    info('Allowing TCP access to source instance for tsunamid')
-    src_sg.authorize('tcp', 46224, 46224, dst_inst.ip_address + '/32')
-    src_sg.authorize('tcp', 46224, 46224, dst_inst.private_ip_address + '/32')
-    info('Allowing UDP access to destination instance for tsunami')
-    dst_sg.authorize('udp', 46224, 46224, src_inst.ip_address + '/32')
-    dst_sg.authorize('udp', 46224, 46224, src_inst.private_ip_address + '/32')
-
-    # Wait for copy to finish
-    info('Waiting for destination instance to shutdown')
-    while dst_inst.state == 'running':
-        sleep(30)
-        dst_inst.update()
-    info('Destination instance has shut down')
+###############################################################################
+# Registration Steps
+###############################################################################
+# Once the volumes have been written, each destination region turns them
+# into an AMI. The regions are independent, so they're done at the same time.
+def snapshot_volume(dst, b):
+    '''Start the snapshot of a destination volume, unless it has been started
+       already, and record it in the journal'''
+    with snapshot_lock:
+        state = journal.state['destinations'][dst.region]
+        ss_map = dict(state.get('snapshots', {}))
+        if b in ss_map:
+            return
+        vol = dst.ec2.get_all_volumes([dst.inst_bdm[b].volume_id])[0]
+        info('Creating snapshot in %s for volume %s', dst.region, vol.id)
+        ss = vol.create_snapshot(description = 'Created by amicopy (%s)'
+                                 % args.name)
+        ss_map[b] = ss.id
+        journal.update_destination(dst.region, snapshots = ss_map)
+
+def snapshot_synced(region, volume):
+    '''Snapshot a volume as soon as the destination instance reports that
+       it's been written, so the snapshot overlaps the rest of the
+       transfer. With --stripes that's once every stripe has been.'''
+    if args.stripes > 1:
+        volume, stripe = volume.split('-')
+        synced_stripes.setdefault((region, volume), set()).add(stripe)
+        if len(synced_stripes[region, volume]) < args.stripes:
+            return
+    for dst in dests:
+        for b in dst.inst_bdm.keys():
+            if (dst.region == region and b != '/dev/sda1' and
+                    dst.inst_bdm[b].volume_id and 'xvd' + b[-1] == volume):
+                try:
+                    snapshot_volume(dst, b)
+                except EC2ResponseError, e:
+                    # It's tried again once the instance has shut down
+                    warning('Could not snapshot %s in %s yet: %s', b,
+                            region, e)
+
+def register_ami(dst):
+    # Each step is recorded in the journal, so a resumed copy picks up where
+    # the last run stopped
+    state = journal.state['destinations'][dst.region]
+    if 'ami' in state:
+        ami_id = state['ami']
+        info('Resuming with AMI %s in %s', ami_id, dst.region)
+    elif src_ami.platform == 'windows':
+        check('windows' not in state, 'Windows instance %s in %s was set up'
+              ' by an earlier run and can only be cleaned up, use --cleanup'
+              % (state.get('windows'), dst.region))
+        # Snapshots started during the transfer by an older amicopy would
+        # never be used, as create_image makes its own
+        ss_ids = state.get('snapshots', {}).values()
+        if ss_ids:
+            for ss in dst.ec2.get_all_snapshots(filters = {'snapshot-id':
+                                                           ss_ids}):
+                info('Deleting unused snapshot %s in %s', ss.id, dst.region)
+                ss.delete()
+            journal.update_destination(dst.region, snapshots = {})
 
-    if src_ami.platform == 'windows':
         # Start Windows instance
-        info('Starting Windows instance')
-        win_inst = ec2dst.run_instance_wait(args.dst_ami,
+        info('Starting Windows instance in %s', dst.region)
+        win_inst = dst.ec2.run_instance_wait(dst.dst_ami,
                 key_name = args.dst_keypair,
-                security_groups = [args.name],
+                security_groups = [dst.sg.name],
                 instance_type = args.inst_type,
-                placement = dst_inst.placement)
-        cleanup.add(win_inst, 'terminate_wait', 'Terminating Windows instance')
+                placement = dst.inst.placement)
+        cleanup.add(win_inst, 'terminate_wait',
+                    'Terminating Windows instance in %s' % dst.region,
+                    resource('instance', win_inst))
+        journal.update_destination(dst.region, windows = win_inst.id)
 
-        info('Tagging EC2 Windows instance')
-        ec2dst.create_tags([win_inst.id], {'Name': 'windows' + args.name})
+        info('Tagging EC2 Windows instance in %s', dst.region)
+        dst.ec2.create_tags([win_inst.id], {'Name': 'windows' + args.name})
 
         # Stop the Windows instance
-        info('Stopping Windows instance')
+        info('Stopping Windows instance in %s', dst.region)
         win_inst.stop(force = True)
-        while win_inst.state != 'stopped':
-            sleep(30)
-            win_inst.update()
+        wait_state([win_inst], 'state', ('stopped',),
+                   'Windows instance to stop', wait_timeouts['instance'])
 
         # Remove the root volume and delete it
         win_inst_bdm = win_inst.block_device_mapping
@@ -518,85 +2390,210 @@ try:
         for b in win_inst_bdm.keys():
             if win_inst_bdm[b].volume_id:
                 vol_ids.append(win_inst_bdm[b].volume_id)
-        volumes = ec2dst.get_all_volumes(vol_ids)
+        volumes = dst.ec2.get_all_volumes(vol_ids)
         for v in volumes:
             info('Detaching volume %s from Windows instance', v.id)
             v.detach(force = True)
-            info('Waiting for volume %s to detach', v.id)
-            while v.status != 'available':
-                sleep(30)
-                v.update()
+        info('Waiting for volumes to detach')
+        wait_state(volumes, 'status', ('available',),
+                   'Windows volumes to detach', wait_timeouts['volume'])
+        for v in volumes:
             info('Deleting volume %s', v.id)
             v.delete()
 
         # Attach the new volumes
         device_map_r = dict((v,k) for k, v in device_map.iteritems())
-        for b in dst_inst_bdm.keys():
-            if dst_inst_bdm[b].volume_id and b != '/dev/sda1':
-                vol = ec2dst.get_all_volumes([dst_inst_bdm[b].volume_id])[0]
+        for b in dst.inst_bdm.keys():
+            if dst.inst_bdm[b].volume_id and b != '/dev/sda1':
+                vol = dst.ec2.get_all_volumes([dst.inst_bdm[b].volume_id])[0]
                 info('Attaching volume %s to Windows instance', vol.id)
                 vol.attach(win_inst.id, device_map_r[b])
                 add_method(vol, 'detach_wait', volume_detach_wait)
                 cleanup.add(vol, 'detach_wait',
-                        'Detaching volume %s from Windows instance' % vol.id)
+                        'Detaching volume %s from Windows instance' % vol.id,
+                        resource('volume', vol))
 
         # Create an AMI
-        info('Registering new AMI')
-        ami_id = ec2dst.create_image(instance_id = win_inst.id,
+        info('Registering new AMI in %s', dst.region)
+        ami_id = dst.ec2.create_image(instance_id = win_inst.id,
                 name = src_ami.name,
                 description = src_ami.description,
                 no_reboot = True)
     else:
-        # Generate snapshots for volumes
-        snapshots = []
-        ss_map = {}
-        for b in dst_inst_bdm.keys():
-            if dst_inst_bdm[b].volume_id and b != '/dev/sda1':
-                vol = ec2dst.get_all_volumes([dst_inst_bdm[b].volume_id])[0]
-                info('Creating snapshot in destination region for volume %s',
-                     vol.id)
-                ss = vol.create_snapshot(description = 'Created by amicopy (%s)' 
-                        % args.name)
-                snapshots.append(ss)
-                ss_map[b] = ss.id
-
-        # Wait for snapshots to finish
-        info('Waiting for snapshot creation to finish')
-        wait = True
-        while wait:
-            wait = False
-            for ss in snapshots:
-                ss.update()
-                if ss.status != 'completed':
-                    wait = True
-            sleep(30)
-        info('Snapshot creation complete')
-
-        # Set up the map for the destination AMI
-        for b in dst_ami_bdm.keys():
+        # Snapshot the volumes that weren't snapshotted during the transfer,
+        # or by an earlier run
+        for b in dst.inst_bdm.keys():
+            if dst.inst_bdm[b].volume_id and b != '/dev/sda1':
+                snapshot_volume(dst, b)
+        ss_map = state.get('snapshots', {})
+        if ss_map:
+            # Wait for snapshots to finish
+            snapshots = dst.ec2.get_all_snapshots(ss_map.values())
+            info('Waiting for snapshot creation to finish in %s', dst.region)
+            wait_state(snapshots, 'status', ('completed',),
+                       'snapshots to complete', wait_timeouts['snapshot'],
+                       failed = ('error',))
+            info('Snapshot creation complete in %s', dst.region)
+
+        # Set up the map for the destination AMI, based on the source AMI
+        # BDM. Each region gets its own copy since the snapshots differ.
+        dst_ami_bdm = BlockDeviceMapping()
+        for b in src_ami.block_device_mapping.keys():
+            dst_ami_bdm[b] = copy(src_ami.block_device_mapping[b])
             if device_map.has_key(b):
                 dst_ami_bdm[b].snapshot_id = ss_map[device_map[b]]
+                # Remember the copy so that other AMIs using the same
+                # snapshot don't have to transfer it again
+                save_snapshot(args.src_region,
+                              src_ami.block_device_mapping[b].snapshot_id,
+                              dst.region,
+                              {'snapshot_id': ss_map[device_map[b]],
+                               'manifest': manifests.get(b)})
+            elif cached_snapshots.has_key(b):
+                info('Using snapshot %s in %s for %s',
+                     cached_snapshots[b][dst.region]['snapshot_id'],
+                     dst.region, b)
+                dst_ami_bdm[b].snapshot_id = \
+                        cached_snapshots[b][dst.region]['snapshot_id']
 
         # Register the AMI
-        info('Registering new AMI')
-        ami_id = ec2dst.register_image(name = src_ami.name,
+        info('Registering new AMI in %s', dst.region)
+        ami_id = dst.ec2.register_image(name = src_ami.name,
                 description = src_ami.description,
                 architecture = src_ami.architecture,
-                kernel_id = dst_kernel_id,
+                kernel_id = dst.kernel_id,
                 root_device_name = src_ami.root_device_name,
                 block_device_map = dst_ami_bdm) 
 
-    info('Waiting for AMI to complete')
-    ami = ec2dst.get_all_images([ami_id])[0]
-    while ami.state != 'available':
-        sleep(30)
-        ami.update()
+    journal.update_destination(dst.region, ami = ami_id)
+
+    info('Waiting for AMI to complete in %s', dst.region)
+    dst.ami = dst.ec2.get_all_images([ami_id])[0]
+    wait_state([dst.ami], 'state', ('available',), 'AMI to become available',
+               wait_timeouts['image'], failed = ('failed',))
 
-    info('Tagging AMI')
+    info('Tagging AMI in %s', dst.region)
     t = ec2src.get_all_tags(filters = {'resource-id': src_ami.id, 
                                        'key': 'Name'})
     if len(t) == 1:
-        ec2dst.create_tags([ami.id], {'Name': t[0].value})
+        dst.ec2.create_tags([dst.ami.id], {'Name': t[0].value})
+
+    if manifests:
+        info('Saving manifest to %s', manifest_path(dst.region, dst.ami.id))
+        save_manifest(dst.region, dst.ami.id, {'ami': dst.ami.id,
+                'region': dst.region,
+                'source_ami': src_ami.id,
+                'source_region': args.src_region,
+                'volumes': manifests})
+
+###############################################################################
+# Copy
+###############################################################################
+try:
+    if journal.state.get('provisioned'):
+        # Everything was set up by an earlier run. The destination instances
+        # carry on with the transfer without amicopy.
+        info('Resuming copy %s', args.name)
+        device_map = journal.state['device_map']
+        cached_snapshots = journal.state['cached_snapshots']
+        manifest_keys = {}
+        for b, k in journal.state['manifest_keys'].items():
+            manifest_keys[b] = s3con.get_bucket(k[0]).new_key(k[1])
+        progress_keys = []
+        for instance, k in journal.state['progress_keys']:
+            progress_keys.append((instance,
+                                  s3con.get_bucket(k[0]).new_key(k[1])))
+        transport_key = None
+        if journal.state.get('transport_key'):
+            k = journal.state['transport_key']
+            transport_key = s3con.get_bucket(k[0]).new_key(k[1])
+        for dst in dests:
+            state = journal.state['destinations'][dst.region]
+            if 'instance' in state:
+                dst.inst = dst.ec2.get_all_instances(
+                        [state['instance']])[0].instances[0]
+                dst.sg = dst.ec2.get_all_security_groups(
+                        group_ids = [state['sg']])[0]
+            for b, v in state['volumes'].items():
+                dst.inst_bdm[b] = BlockDeviceType(volume_id = v)
+    else:
+        # Start over if an earlier run didn't get everything set up
+        if old_resources:
+            cleanup.cleanup()
+        with tracer.span('provisioning'):
+            provision()
+
+        # Record what the rest of the copy needs to carry on if amicopy dies
+        for dst in dests:
+            state = {'volumes': {}}
+            if dst.inst:
+                state['instance'] = dst.inst.id
+                state['sg'] = dst.sg.id
+            for b in dst.inst_bdm.keys():
+                if dst.inst_bdm[b].volume_id and b != '/dev/sda1':
+                    state['volumes'][b] = dst.inst_bdm[b].volume_id
+            journal.update_destination(dst.region, **state)
+        journal.update(provisioned = True,
+                       device_map = device_map,
+                       cached_snapshots = cached_snapshots,
+                       manifest_keys = dict((b, [k.bucket.name, k.name])
+                                            for b, k in manifest_keys.items()),
+                       progress_keys = [(i, [k.bucket.name, k.name])
+                                        for i, k in progress_keys],
+                       transport_key = transport_key and
+                                       [transport_key.bucket.name,
+                                        transport_key.name])
+
+    if 'manifests' in journal.state:
+        manifests = journal.state['manifests']
+    else:
+        # Wait for copy to finish
+        if device_map:
+            total = sum(src_ami.block_device_mapping[b].size
+                        for b in device_map) * 1073741824
+            # Windows AMIs are created from an instance, which snapshots the
+            # volumes itself
+            synced = src_ami.platform != 'windows' and snapshot_synced or None
+            telemetry = Telemetry(progress_keys, total,
+                                  len(device_map) * args.stripes,
+                                  telemetry_interval, args.metrics, synced)
+            telemetry.start()
+            try:
+                # With --transport auto the instances wait for this
+                if transport_key and 'transport' not in journal.state:
+                    with tracer.span('choosing transport'):
+                        chosen = choose_transport(progress_keys)
+                    info('Using the %s transport', chosen)
+                    transport_key.set_contents_from_string(chosen)
+                    journal.update(transport = chosen)
+                info('Waiting for destination instances to shutdown')
+                with tracer.span('transfer'):
+                    wait_state([dst.inst for dst in dests], 'state',
+                               ('stopping', 'stopped', 'shutting-down',
+                                'terminated'),
+                               'destination instances to shut down',
+                               wait_timeouts['transfer'])
+            finally:
+                telemetry.stop()
+            info('Destination instances have shut down')
+
+        manifests = {}
+        for b, key in manifest_keys.items():
+            try:
+                manifests[b] = key.get_contents_as_string()
+            except S3ResponseError:
+                warning('No manifest was recorded for %s', b)
+        for b, records in cached_snapshots.items():
+            if records[dests[0].region]['manifest']:
+                manifests[b] = records[dests[0].region]['manifest']
+        journal.update(manifests = manifests)
+
+    steps = TaskGraph()
+    for dst in dests:
+        steps.add('register AMI ' + dst.region, partial(register_ami, dst))
+    with tracer.span('registration'):
+        steps.run(len(dests))
+    steps.report('Registration')
 
 except (Exception, KeyboardInterrupt) as e:
     exception('Cleaning up because of error')
@@ -604,8 +2601,31 @@ except (Exception, KeyboardInterrupt) as e:
         cleanup.cleanup()
     except Exception, ce:
         exception('Error during cleanup')
+    else:
+        journal.remove()
+    write_trace()
     print 'AMI Copy Failed!'
+    sys.exit(1)
 else:
     cleanup.cleanup()
-    print 'AMI Copy Complete: %s' % ami.id
-
+    journal.remove()
+    write_trace()
+
+    # Time copies that ran from start to end for --plan
+    if device_map and tracer.total('provisioning') and \
+            tracer.total('transfer'):
+        sizes = [src_ami.block_device_mapping[b].size * 1073741824
+                 for b in device_map]
+        save_history({'time': time(),
+                      'source': args.src_region,
+                      'destinations': len(dests),
+                      'inst_type': args.inst_type,
+                      'transport': journal.state.get('transport', transport),
+                      'parallel_volumes': args.parallel_volumes,
+                      'stripes': args.stripes,
+                      'bytes': sum(sizes),
+                      'largest': max(sizes),
+                      'provisioning': tracer.total('provisioning'),
+                      'transfer': tracer.total('transfer'),
+                      'registration': tracer.total('registration')})
+    print 'AMI Copy Complete: %s' % ' '.join(dst.ami.id for dst in dests)
@@ -0,0 +1,2102 @@
+#!/usr/bin/env python
+#
+# amicopy_helper.py - Data pipeline helper for the amicopy transfer instances
+#
+# Copyright (c) 2012, David Lowry
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# * Redistributions of source code must retain the above copyright notice, this
+#   list of conditions and the following disclaimer.
+#
+# * Redistributions in binary form must reproduce the above copyright notice,
+#   this list of conditions and the following disclaimer in the documentation
+#   and/or other materials provided with the distribution.
+#
+# * Neither the name of Infor nor the names of its contributors may be used
+#   to endorse or promote products derived from this software without specific
+#   prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+#
+# This script is uploaded to the source and destination instances by amicopy
+# and runs there under the system python, which may be as old as 2.6. Keep it
+# to the standard library and avoid 2.7-only syntax.
+
+import ctypes
+import glob
+import hmac
+import json
+import logging
+import os
+import re
+import socket
+import struct
+import subprocess
+import sys
+import tempfile
+import threading
+import urllib2
+import zlib
+from bisect import bisect_right
+from ctypes.util import find_library
+from hashlib import md5, sha1, sha256
+from logging import info, debug, warning
+from multiprocessing import cpu_count
+from optparse import OptionParser
+from Queue import Queue, Empty, Full
+from time import sleep, time
+
+###############################################################################
+# Constants
+###############################################################################
+block_size = 1024 * 1024
+
+# Every frame on the wire is a 4 byte length and the SHA1 digest of the
+# frame's data followed by the data, so the receiver can check each block
+# before it's written. A zero length frame ends the stream and carries the
+# tree hash of the stream: the SHA1 of all of the frame digests.
+frame_header = struct.Struct('!I20s')
+
+# A client can spread a stream over several TCP connections. Each connection
+# starts with a "TOKEN INDEX COUNT" line, where TOKEN is the same for all of
+# the client's connections, and frame N of the stream is sent on connection
+# N % COUNT. Every connection ends with the trailer.
+
+# Sparse images start with a magic string and the size of the device. They
+# are followed by records of an offset, a length and that many bytes of data
+# for each run of non-zero data. A zero length record ends the image. Holes
+# are checked at zero_granularity within each block.
+image_magic = 'AMICPYS1'
+image_header = struct.Struct('!8sQ')
+record_header = struct.Struct('!QI')
+zero_granularity = 64 * 1024
+zero_block = '\0' * block_size
+zero_granule = '\0' * zero_granularity
+
+# Compressed streams are made of blocks with a 4 byte length and a 1 byte
+# flag (stored or zlib) followed by the data. A zero length block ends the
+# stream. With an adaptive level the level is re-evaluated every
+# compress_interval blocks: it's raised while the workers are mostly idle and
+# lowered when they're close to saturated, so compression stays off the
+# critical path.
+compress_header = struct.Struct('!IB')
+compress_stored = 0
+compress_zlib = 1
+compress_interval = 32
+compress_busy_high = 0.85
+compress_busy_low = 0.5
+
+# Streams are encrypted with AES-128-GCM in independent segments of
+# block_size bytes, so that every CPU can work on a segment at the same time.
+# An encrypted stream starts with a magic string and a random nonce prefix.
+# Each segment is a 4 byte length, a kind byte, the ciphertext and a 16 byte
+# tag, and its IV is the nonce prefix followed by the segment number. The
+# segment number and kind are authenticated too, so segments can't be
+# reordered and a stream that's been cut short is caught. The last segment
+# holds the length of the plaintext, or is an empty abort segment if the
+# commands feeding the stream failed, so a source that stopped reading
+# early can't end the stream cleanly. The key is derived from the secret in
+# --key-file.
+cipher_magic = 'AMICPYE2'
+cipher_header = struct.Struct('!8s8s')
+segment_header = struct.Struct('!IB')
+segment_aad = struct.Struct('!QB')
+segment_trailer = struct.Struct('!Q')
+segment_data = 0
+segment_last = 1
+segment_abort = 2
+tag_size = 16
+key_label = 'amicopy aes-128-gcm stream key'
+gcm_get_tag = 0x10
+gcm_set_tag = 0x11
+crypto_libs = ['libcrypto.so.10', 'libcrypto.so.1.0.0', 'libcrypto.so.1.1',
+               'libcrypto.so.3']
+
+# Chunk manifests hold the SHA1 of every manifest_chunk_size bytes of a
+# volume. They let a later copy send only the chunks that changed.
+manifest_chunk_size = 16 * 1024 * 1024
+manifest_format = 'amicopy-manifest 1 %d %d\n'
+
+# Images staged for tsunami are split into chunk files of --chunk-size MB.
+# Their manifest has a "NAME SIZE ROOT LEAF..." line for each chunk, where
+# each LEAF is the SHA1 of a block_size block of the chunk and ROOT is the
+# SHA1 of the leaves. The hashes are taken as the chunks are written and
+# checked as they're read back, so neither side makes an extra pass over the
+# chunks.
+default_chunk_size = 1024
+
+# Progress of each pipeline stage is kept in progress_dir as a file called
+# VOLUME.STAGE holding "BYTES DONE START UPDATED", rewritten every
+# meter_interval seconds
+progress_dir = 'progress'
+meter_interval = 1
+
+# Transfers through S3 upload the stream in parts of --part-size MB to a list
+# of presigned URLs, --streams at a time, and the destinations download the
+# parts as soon as they appear. Once every part is uploaded a "done" object
+# with the number of parts is uploaded. Parts are checked against the MD5
+# ETag that S3 returns, and failed requests are retried s3_retries times.
+s3_part_size = 64
+s3_retries = 5
+s3_poll = 5
+
+# Before a tsunami transfer each destination probes the link from the source.
+# It times probe_pings round trips over TCP, then has the source send UDP
+# datagrams of the size tsunami will use at each of probe_rates (Mbit/s) for
+# probe_seconds, stopping at the first rate that loses more than probe_loss
+# of them. tsunami_settings() picks the tsunami client settings from the
+# results, which are also kept in link_file for the progress reports.
+probe_rates = [50, 100, 200, 400, 800, 1600]
+probe_seconds = 2.0
+probe_pings = 10
+probe_loss = 0.02
+probe_timeout = 600
+probe_buffer = 8 * 1024 * 1024
+probe_datagram = struct.Struct('!II')
+link_file = 'link.json'
+probe_tcp_seconds = 5.0
+
+# tsunami puts a 6 byte header in front of each block. The largest block that
+# fits in a 1500 byte MTU with the IP and UDP headers is used if it gets
+# through, otherwise tsunami's default. tsunami's default target rate
+# (Mbit/s) is used when the probe can't send fast enough to find the limit of
+# the link.
+tsunami_header = 6
+tsunami_blocksize = 1466
+tsunami_default_blocksize = 1024
+tsunami_default_rate = 650
+
+# Free space smaller than this isn't worth skipping when only the used blocks
+# of a filesystem are copied
+min_free_run = zero_granularity
+sector_size = 512
+free_bytes = re.compile('\0+')
+
+# libcrypto, once load_crypto() has found it
+crypto = None
+
+###############################################################################
+# Classes
+###############################################################################
+class HelperError(Exception): pass
+
+class CorruptBlock(HelperError):
+    '''A block of data that doesn't match its digest'''
+    def __init__(self, name, offset, size):
+        HelperError.__init__(self, '%s is corrupt at bytes %d-%d' %
+                             (name, offset, offset + size))
+        self.name = name
+
+class Stage(threading.Thread):
+    '''Run one stage of a pipeline in a thread and remember its exception'''
+    def __init__(self, func, *args):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.func = func
+        self.args = args
+        self.error = None
+
+    def run(self):
+        try:
+            self.func(*self.args)
+        except Exception, e:
+            self.error = e
+
+    def finish(self):
+        self.join()
+        if self.error is not None:
+            raise self.error
+
+class OrderedWorkers(object):
+    '''Run a function in a pool of threads and return the results in the
+       order the work was submitted'''
+    def __init__(self, func, workers, depth):
+        self.func = func
+        self.work = Queue(depth)
+        self.results = Queue(depth)
+        self.busy = [0.0] * workers
+        self.error = None
+        self.threads = []
+        for i in xrange(workers):
+            t = threading.Thread(target = self._run, args = (i,))
+            t.daemon = True
+            t.start()
+            self.threads.append(t)
+
+    def _run(self, n):
+        while True:
+            item = self.work.get()
+            if item is None:
+                break
+            args, slot = item
+            start = time()
+            try:
+                slot.put((True, self.func(*args)))
+            except Exception, e:
+                # Set the error first so that the producer stops even if
+                # the consumer has given up on the results
+                if self.error is None:
+                    self.error = e
+                slot.put((False, e))
+            self.busy[n] += time() - start
+
+    def _offer(self, item):
+        '''Queue a result slot, returning False if a worker has failed, as
+           nothing may be taking the results off the queue any more'''
+        while self.error is None:
+            try:
+                self.results.put(item, True, 1)
+                return True
+            except Full:
+                pass
+        return False
+
+    def put(self, *args):
+        slot = Queue(1)
+        if not self._offer(slot):
+            raise self.error
+        self.work.put((args, slot))
+
+    def stop(self, error):
+        '''Make put() fail with error, for when whatever takes the results
+           has failed and they would never be taken off the queue'''
+        if self.error is None:
+            self.error = error
+
+    def close(self):
+        self._offer(None)
+        for t in self.threads:
+            self.work.put(None)
+        # Workers never wait on the results, so they all get to the end.
+        # Joining them keeps them from being torn down at exit.
+        for t in self.threads:
+            t.join()
+
+    def get(self):
+        '''Return the next result in order, or None after close()'''
+        slot = self.results.get()
+        if slot is None:
+            return None
+        ok, result = slot.get()
+        if not ok:
+            raise result
+        return result
+
+###############################################################################
+# Functions
+###############################################################################
+def load_crypto():
+    '''Load libcrypto for AES-GCM. It's called through ctypes, which lets go
+       of the GIL during each call, so a pool of threads can encrypt segments
+       in parallel.'''
+    global crypto
+    if crypto is not None:
+        return crypto
+    for name in [find_library('crypto')] + crypto_libs:
+        try:
+            lib = ctypes.CDLL(name)
+            lib.EVP_aes_128_gcm
+            break
+        except (OSError, TypeError, AttributeError):
+            continue
+    else:
+        raise HelperError('no libcrypto with AES-GCM support was found')
+
+    ptr, buf, size = ctypes.c_void_p, ctypes.c_char_p, ctypes.c_int
+    lib.EVP_CIPHER_CTX_new.restype = ptr
+    lib.EVP_CIPHER_CTX_free.argtypes = [ptr]
+    lib.EVP_aes_128_gcm.restype = ptr
+    for func in (lib.EVP_EncryptInit_ex, lib.EVP_DecryptInit_ex):
+        func.argtypes = [ptr, ptr, ptr, buf, buf]
+    for func in (lib.EVP_EncryptUpdate, lib.EVP_DecryptUpdate):
+        func.argtypes = [ptr, ptr, ctypes.POINTER(size), buf, size]
+    for func in (lib.EVP_EncryptFinal_ex, lib.EVP_DecryptFinal_ex):
+        func.argtypes = [ptr, ptr, ctypes.POINTER(size)]
+    lib.EVP_CIPHER_CTX_ctrl.argtypes = [ptr, size, size, ptr]
+    crypto = lib
+    return crypto
+
+def stream_key(filename):
+    '''Derive the stream key from the secret in a file'''
+    return hmac.new(open(filename).read().strip(), key_label,
+                    sha256).digest()[:16]
+
+def gcm(encrypting, key, iv, aad, data, tag = None):
+    '''Encrypt or decrypt data with AES-128-GCM and return (data, tag). When
+       decrypting, None is returned if the tag doesn't match.'''
+    lib = crypto
+    if encrypting:
+        init, update, final = (lib.EVP_EncryptInit_ex, lib.EVP_EncryptUpdate,
+                               lib.EVP_EncryptFinal_ex)
+    else:
+        init, update, final = (lib.EVP_DecryptInit_ex, lib.EVP_DecryptUpdate,
+                               lib.EVP_DecryptFinal_ex)
+    ctx = lib.EVP_CIPHER_CTX_new()
+    try:
+        size = ctypes.c_int()
+        out = ctypes.create_string_buffer(len(data) + tag_size)
+        if (not init(ctx, lib.EVP_aes_128_gcm(), None, key, iv)
+                or not update(ctx, None, ctypes.byref(size), aad, len(aad))
+                or not update(ctx, out, ctypes.byref(size), data, len(data))):
+            raise HelperError('AES-GCM failed')
+        result = ctypes.string_at(out, size.value)
+        if not encrypting:
+            lib.EVP_CIPHER_CTX_ctrl(ctx, gcm_set_tag, tag_size, tag)
+        if not final(ctx, out, ctypes.byref(size)):
+            return None, None
+        if encrypting:
+            tag = ctypes.create_string_buffer(tag_size)
+            lib.EVP_CIPHER_CTX_ctrl(ctx, gcm_get_tag, tag_size, tag)
+            tag = tag.raw
+        return result, tag
+    finally:
+        lib.EVP_CIPHER_CTX_free(ctx)
+
+def encrypt_segment(key, prefix, index, kind, data):
+    '''Return an encrypted segment of a stream'''
+    iv = prefix + struct.pack('!I', index)
+    data, tag = gcm(True, key, iv, segment_aad.pack(index, kind), data)
+    return segment_header.pack(len(data), kind) + data + tag
+
+def decrypt_segment(key, prefix, index, kind, data, offset):
+    '''Return the data in an encrypted segment of a stream'''
+    iv = prefix + struct.pack('!I', index)
+    data, tag = data[:-tag_size], data[-tag_size:]
+    plain, tag = gcm(False, key, iv, segment_aad.pack(index, kind), data,
+                     tag)
+    if plain is None:
+        raise CorruptBlock('encrypted stream', offset, len(data))
+    return plain
+
+def rate(size, start):
+    '''Return the rate in MB/s for size bytes since start'''
+    return size / 1048576.0 / max(time() - start, 0.001)
+
+def compress_block(data, level):
+    '''Compress a block, storing it as is if it doesn't compress'''
+    packed = zlib.compress(data, level)
+    if len(packed) >= len(data):
+        return compress_stored, data
+    return compress_zlib, packed
+
+def decompress_block(flag, data):
+    '''Undo compress_block'''
+    if flag == compress_zlib:
+        return zlib.decompress(data)
+    return data
+
+def hash_block(data):
+    '''Return a block and its SHA1 digest. hashlib lets go of the GIL while
+       it hashes a large block, so a pool of these uses all of the CPUs.'''
+    return data, sha1(data).digest()
+
+def check_block(data, digest, name, offset):
+    '''Return a block if it matches its digest'''
+    if sha1(data).digest() != digest:
+        raise CorruptBlock(name, offset, len(data))
+    return data
+
+def hash_blocks(f, pool):
+    '''Read blocks from a file and hash them in a pool'''
+    try:
+        while True:
+            data = f.read(block_size)
+            if not data:
+                break
+            pool.put(data)
+    finally:
+        pool.close()
+
+def write_compressed(pool, f, stats):
+    '''Write compressed blocks from a pool to a file in order'''
+    try:
+        while True:
+            block = pool.get()
+            if block is None:
+                break
+            f.write(compress_header.pack(len(block[1]), block[0]))
+            f.write(block[1])
+            stats[0] += len(block[1])
+        f.write(compress_header.pack(0, compress_stored))
+        f.flush()
+    except Exception, e:
+        pool.stop(e)
+        raise
+
+def write_pool(pool, f):
+    '''Write results from a pool to a file in order'''
+    try:
+        while True:
+            data = pool.get()
+            if data is None:
+                break
+            f.write(data)
+        f.flush()
+    except Exception, e:
+        # Don't leave the producer waiting for the results to be taken
+        pool.stop(e)
+        raise
+
+def put_extents(queue, offset, data):
+    '''Put (offset, data) on a queue for each run of non-zero data in a
+       block'''
+    if len(data) == block_size and data == zero_block:
+        return
+    run = None
+    for i in xrange(0, len(data), zero_granularity):
+        granule = data[i:i + zero_granularity]
+        if granule == zero_granule[:len(granule)]:
+            if run is not None:
+                queue.put((offset + run, data[run:i]))
+                run = None
+        elif run is None:
+            run = i
+    if run is not None:
+        queue.put((offset + run, data[run:]))
+
+def queue_reads(pool, ranges):
+    '''Queue a read of each block of (start, end) byte ranges'''
+    try:
+        for start, end in ranges:
+            for offset in xrange(start, end, block_size):
+                pool.put(offset, min(block_size, end - offset))
+    finally:
+        pool.close()
+
+def read_blocks(path, ranges, readers, name = None):
+    '''Generate (offset, data) for each block of (start, end) byte ranges of
+       a device, in order, with readers reads in flight at a time. The first
+       read of a block of a volume restored from a snapshot waits for EBS to
+       fetch it, so one read at a time is far slower than the volume. The
+       bytes read are recorded as the progress of name if it's set.'''
+    local = threading.local()
+    files = []
+    def read_at(offset, length):
+        # Each thread has its own file so that it can seek
+        if not hasattr(local, 'f'):
+            local.f = open(path, 'rb', 0)
+            files.append(local.f)
+        local.f.seek(offset)
+        return offset, read_exact(local.f, length)
+
+    if name:
+        make_dirs(progress_dir)
+    pool = OrderedWorkers(read_at, readers, readers)
+    feeder = Stage(queue_reads, pool, ranges)
+    feeder.start()
+    size = 0
+    start = last = time()
+    try:
+        while True:
+            block = pool.get()
+            if block is None:
+                break
+            yield block
+            size += len(block[1])
+            if name and time() - last >= meter_interval:
+                write_progress(name, size, False, start)
+                last = time()
+        feeder.finish()
+    finally:
+        # The files can only be closed once the workers are done, which
+        # they are when the feeder has closed the pool. If the reads were
+        # given up part way, the feeder is stopped first.
+        if feeder.is_alive():
+            pool.stop(HelperError('gave up reading %s' % path))
+            feeder.join()
+        for f in files:
+            f.close()
+    if name:
+        write_progress(name, size, True, start)
+    info('Read %s: %d bytes, up to %d reads in flight (%.1f MB/s)', path,
+         size, readers, rate(size, start))
+
+def read_extents(path, queue, ranges, readers, name):
+    '''Read (start, end) byte ranges of a device and put (offset, data) on a
+       queue for each run of non-zero data, ending with None'''
+    try:
+        for offset, data in read_blocks(path, ranges, readers, name):
+            put_extents(queue, offset, data)
+    finally:
+        queue.put(None)
+
+def read_chunks(path, queue, size, ranges, base, hashes, readers, name):
+    '''Read a whole device a chunk at a time and append the hash of each
+       chunk to hashes. Without a base manifest only the non-zero data in
+       ranges is queued. With one, chunks that match it are skipped and the
+       rest are queued whole, since the destination isn't zeroed.'''
+    try:
+        starts = [r[0] for r in ranges]
+        reader = read_blocks(path, [(0, size)], readers, name)
+        for i, chunk in enumerate(xrange(0, size, manifest_chunk_size)):
+            end = min(chunk + manifest_chunk_size, size)
+            digest = sha1()
+            blocks = []
+            offset = chunk
+            while offset < end:
+                block = reader.next()
+                digest.update(block[1])
+                blocks.append(block)
+                offset += len(block[1])
+            hashes.append(digest.hexdigest())
+
+            if base is not None:
+                if base[i] != hashes[-1]:
+                    for block in blocks:
+                        queue.put(block)
+                continue
+            for offset, data in blocks:
+                # Clip the block to the ranges that have to be copied
+                j = max(bisect_right(starts, offset) - 1, 0)
+                while j < len(ranges) and ranges[j][0] < offset + len(data):
+                    lo = max(ranges[j][0], offset) - offset
+                    hi = min(ranges[j][1], offset + len(data)) - offset
+                    if hi > lo:
+                        put_extents(queue, offset + lo, data[lo:hi])
+                    j += 1
+        # Let the reader finish and record its progress
+        for block in reader:
+            pass
+    finally:
+        queue.put(None)
+
+def write_extents(f, queue, written = None):
+    '''Write (offset, data) from a queue to a device until None is received,
+       recording what was written if written is set'''
+    while True:
+        extent = queue.get()
+        if extent is None:
+            break
+        f.seek(extent[0])
+        f.write(extent[1])
+        if written is not None:
+            record_write(written, extent[0], extent[1])
+    f.flush()
+
+def record_write(written, offset, data):
+    '''Add data written at offset to {chunk: (runs, digest)}, the byte ranges
+       written to each manifest chunk of a device and the SHA1 of their data.
+       Extents have to be written in order.'''
+    while data:
+        chunk = offset / manifest_chunk_size
+        size = min(len(data), (chunk + 1) * manifest_chunk_size - offset)
+        runs, digest = written.setdefault(chunk, ([], sha1()))
+        if runs and runs[-1][1] == offset:
+            runs[-1][1] += size
+        else:
+            runs.append([offset, offset + size])
+        digest.update(data[:size])
+        offset += size
+        data = data[size:]
+
+def verify_chunks(path, written, chunks, bad):
+    '''Read back the chunks of a device from a queue and add the ones that
+       don't match what was written to bad'''
+    f = open(path, 'rb')
+    while True:
+        try:
+            chunk = chunks.get_nowait()
+        except Empty:
+            break
+        runs, digest = written[chunk]
+        check = sha1()
+        for start, end in runs:
+            f.seek(start)
+            offset = start
+            while offset < end:
+                data = read_exact(f, min(block_size, end - offset))
+                check.update(data)
+                offset += len(data)
+        if check.digest() != digest.digest():
+            bad.append(chunk * manifest_chunk_size)
+    f.close()
+
+def drop_cache(f):
+    '''Flush a device to disk and drop the page cache, so that reading it
+       back checks what's on the disk'''
+    f.flush()
+    os.fsync(f.fileno())
+    try:
+        open('/proc/sys/vm/drop_caches', 'w').write('1\n')
+    except IOError, e:
+        warning('Reading back from the page cache: %s', e)
+
+def verify_device(path, written, workers):
+    '''Read back everything that was written to a device with several
+       threads and check it against the digests taken as it was written'''
+    chunks = Queue()
+    for chunk in sorted(written):
+        chunks.put(chunk)
+    bad = []
+    start = time()
+    readers = [Stage(verify_chunks, path, written, chunks, bad)
+               for i in xrange(workers)]
+    for reader in readers:
+        reader.start()
+    for reader in readers:
+        reader.finish()
+    size = sum(r[1] - r[0] for c in written.values() for r in c[0])
+    if bad:
+        raise HelperError('%d chunks of %s don\'t match what was written,'
+                          ' the first is at bytes %d-%d' % (len(bad), path,
+                          min(bad), min(bad) + manifest_chunk_size))
+    info('Verified %d bytes of %s (%.1f MB/s)', size, path, rate(size, start))
+
+def device_size(f):
+    '''Return the size of an open file or block device'''
+    f.seek(0, os.SEEK_END)
+    size = f.tell()
+    f.seek(0)
+    return size
+
+def read_at(f, offset, size):
+    '''Read exactly size bytes at offset'''
+    f.seek(offset)
+    return read_exact(f, size)
+
+def bitmap_free_runs(bitmap, unit, base):
+    '''Return (start, end) byte ranges for the runs of zero bytes in an
+       allocation bitmap. Only whole zero bytes count as free, so partially
+       used bytes are always copied.'''
+    runs = []
+    for m in free_bytes.finditer(bitmap):
+        runs.append((base + m.start() * 8 * unit, base + m.end() * 8 * unit))
+    return runs
+
+def ext_free_runs(f, base):
+    '''Return the free ranges of an ext2/3/4 filesystem'''
+    sb = read_at(f, base + 1024, 1024)
+    blocks_lo, first_data_block, log_block_size, blocks_per_group, \
+            inodes_per_group = struct.unpack('<4xI12xII4xI4xI', sb[:44])
+    incompat, = struct.unpack('<I', sb[96:100])
+    bsize = 1024 << log_block_size
+    blocks = blocks_lo
+    desc_size = 32
+    inode_size = 128
+    if struct.unpack('<I', sb[76:80])[0] >= 1:     # dynamic revision
+        inode_size, = struct.unpack('<H', sb[88:90])
+    reserved_gdt, = struct.unpack('<H', sb[0xce:0xd0])
+    if incompat & 0x80:         # 64bit
+        blocks |= struct.unpack('<I', sb[0x150:0x154])[0] << 32
+        desc_size = max(32, struct.unpack('<H', sb[0xfe:0x100])[0])
+    if incompat & 0x10:         # meta_bg moves the group descriptors around
+        raise HelperError('ext meta_bg is not supported')
+    if struct.unpack('<I', sb[100:104])[0] & 0x200:
+        raise HelperError('ext bigalloc is not supported')
+
+    groups = (blocks - first_data_block + blocks_per_group - 1) / \
+            blocks_per_group
+    gdt = read_at(f, base + (first_data_block + 1) * bsize,
+                  groups * desc_size)
+    descs = []
+    metadata = []
+    for g in xrange(groups):
+        desc = gdt[g * desc_size:(g + 1) * desc_size]
+        block_bitmap, inode_bitmap, inode_table = \
+                struct.unpack('<III', desc[0:12])
+        flags, = struct.unpack('<H', desc[0x12:0x14])
+        if desc_size >= 64:
+            hi = struct.unpack('<III', desc[0x20:0x2c])
+            block_bitmap |= hi[0] << 32
+            inode_bitmap |= hi[1] << 32
+            inode_table |= hi[2] << 32
+        descs.append((block_bitmap, flags))
+        # With flex_bg these can be in any group
+        metadata.extend([(block_bitmap, block_bitmap + 1),
+                         (inode_bitmap, inode_bitmap + 1),
+                         (inode_table, inode_table + (inodes_per_group *
+                          inode_size + bsize - 1) / bsize)])
+    metadata.sort()
+    # Blocks at the start of a group that may hold a backup of the
+    # superblock and group descriptors
+    head = 1 + (groups * desc_size + bsize - 1) / bsize + reserved_gdt
+
+    runs = []
+    for g, (bitmap_block, flags) in enumerate(descs):
+        start = first_data_block + g * blocks_per_group
+        count = min(blocks_per_group, blocks - start)
+        if flags & 0x2:
+            # BLOCK_UNINIT: the bitmap was never written. Like the kernel,
+            # take everything but the group's metadata to be free.
+            offset = start + head
+            for lo, hi in metadata:
+                if hi <= offset or lo >= start + count:
+                    continue
+                if lo > offset:
+                    runs.append((base + offset * bsize, base + lo * bsize))
+                offset = max(offset, hi)
+            if offset < start + count:
+                runs.append((base + offset * bsize,
+                             base + (start + count) * bsize))
+            continue
+        bitmap = read_at(f, base + bitmap_block * bsize, count / 8)
+        runs.extend(bitmap_free_runs(bitmap, bsize, base + start * bsize))
+    return runs
+
+def xfs_free_runs(f, base):
+    '''Return the free ranges of an XFS filesystem from the free space
+       by-block btree of each allocation group'''
+    sb = read_at(f, base, 512)
+    bsize, = struct.unpack('>I', sb[4:8])
+    agblocks, agcount = struct.unpack('>II', sb[84:92])
+    version, sectsize = struct.unpack('>HH', sb[100:104])
+    # v5 filesystems use the longer CRC-enabled btree block header
+    hdr = (version & 0xf) == 5 and 56 or 16
+    maxrecs = (bsize - hdr) / 12
+
+    runs = []
+    for ag in xrange(agcount):
+        agbase = base + ag * agblocks * bsize
+        agf = read_at(f, agbase + sectsize, 64)
+        if agf[:4] != 'XAGF':
+            raise HelperError('bad AGF in allocation group %d' % ag)
+        root, = struct.unpack('>I', agf[16:20])
+
+        # Walk down the left edge of the tree, then along the leaves
+        block = read_at(f, agbase + root * bsize, bsize)
+        while struct.unpack('>H', block[4:6])[0] > 0:
+            ptr, = struct.unpack('>I', block[hdr + maxrecs * 8:
+                                             hdr + maxrecs * 8 + 4])
+            block = read_at(f, agbase + ptr * bsize, bsize)
+        while True:
+            if block[:4] not in ('ABTB', 'AB3B'):
+                raise HelperError('bad free space btree block in AG %d' % ag)
+            numrecs, = struct.unpack('>H', block[6:8])
+            for i in xrange(numrecs):
+                start, count = struct.unpack('>II',
+                        block[hdr + i * 8:hdr + i * 8 + 8])
+                runs.append((agbase + start * bsize,
+                             agbase + (start + count) * bsize))
+            right, = struct.unpack('>I', block[12:16])
+            if right == 0xffffffff:
+                break
+            block = read_at(f, agbase + right * bsize, bsize)
+    return runs
+
+def ntfs_free_runs(f, base):
+    '''Return the free ranges of an NTFS filesystem from the $Bitmap file'''
+    boot = read_at(f, base, 512)
+    bps, spc = struct.unpack('<HB', boot[0x0b:0x0e])
+    mft_lcn, = struct.unpack('<Q', boot[0x30:0x38])
+    cpr, = struct.unpack('<b', boot[0x40:0x41])
+    csize = bps * spc
+    rsize = cpr > 0 and cpr * csize or 1 << -cpr
+
+    # $Bitmap is MFT record 6, which is always in the first MFT extent
+    rec = bytearray(read_at(f, base + mft_lcn * csize + 6 * rsize, rsize))
+    if rec[:4] != 'FILE':
+        raise HelperError('bad $Bitmap MFT record')
+    usa_ofs, usa_count = struct.unpack('<HH', str(rec[4:8]))
+    for i in xrange(1, usa_count):
+        rec[i * 512 - 2:i * 512] = rec[usa_ofs + i * 2:usa_ofs + i * 2 + 2]
+    rec = str(rec)
+
+    ofs, = struct.unpack('<H', rec[0x14:0x16])
+    while True:
+        atype, alen = struct.unpack('<II', rec[ofs:ofs + 8])
+        if atype == 0xffffffff or alen == 0:
+            raise HelperError('no $DATA attribute in $Bitmap')
+        if atype == 0x80 and rec[ofs + 9] == '\0':
+            break
+        ofs += alen
+    attr = rec[ofs:ofs + alen]
+
+    if attr[8] == '\0':
+        vlen, vofs = struct.unpack('<IH', attr[0x10:0x16])
+        bitmap = attr[vofs:vofs + vlen]
+    else:
+        runs_ofs, = struct.unpack('<H', attr[0x20:0x22])
+        size, = struct.unpack('<Q', attr[0x30:0x38])
+        data = []
+        lcn = 0
+        i = runs_ofs
+        while attr[i] != '\0':
+            lsize, osize = ord(attr[i]) & 0xf, ord(attr[i]) >> 4
+            length = int(attr[i + 1:i + 1 + lsize][::-1].encode('hex'), 16)
+            delta = int(attr[i + 1 + lsize:i + 1 + lsize + osize][::-1]
+                        .encode('hex') or '0', 16)
+            if osize and ord(attr[i + lsize + osize]) & 0x80:
+                delta -= 1 << (8 * osize)
+            lcn += delta
+            data.append(read_at(f, base + lcn * csize, length * csize))
+            i += 1 + lsize + osize
+        bitmap = ''.join(data)[:size]
+    return bitmap_free_runs(bitmap, csize, base)
+
+def filesystem_free_runs(f, base):
+    '''Return the free ranges of the filesystem at base, or None if there
+       isn't a filesystem there that we know how to read'''
+    head = read_at(f, base, 2048)
+    if head[1080:1082] == '\x53\xef':
+        func = ext_free_runs
+    elif head[:4] == 'XFSB':
+        func = xfs_free_runs
+    elif head[3:11] == 'NTFS    ':
+        func = ntfs_free_runs
+    else:
+        return None
+    return func(f, base)
+
+def partitions(f):
+    '''Return the byte offsets of the partitions in the MBR or GPT partition
+       table of a device'''
+    mbr = read_at(f, 0, sector_size)
+    if mbr[510:512] != '\x55\xaa':
+        return []
+    starts = []
+    for i in xrange(4):
+        entry = mbr[446 + i * 16:462 + i * 16]
+        ptype, = struct.unpack('<B', entry[4])
+        lba, count = struct.unpack('<II', entry[8:16])
+        if ptype == 0xee:
+            gpt = read_at(f, sector_size, sector_size)
+            if gpt[:8] != 'EFI PART':
+                raise HelperError('bad GPT header')
+            table_lba, entries, esize = struct.unpack('<QII', gpt[72:88])
+            table = read_at(f, table_lba * sector_size, entries * esize)
+            for j in xrange(entries):
+                e = table[j * esize:(j + 1) * esize]
+                if e[:16] != '\0' * 16:
+                    starts.append(struct.unpack('<Q', e[32:40])[0] *
+                                  sector_size)
+            return starts
+        # Extended partitions aren't followed, they get copied raw
+        if ptype not in (0, 0x05, 0x0f, 0x85) and count:
+            starts.append(lba * sector_size)
+    return starts
+
+def used_ranges(f, size):
+    '''Return the (start, end) byte ranges of a device that hold data that
+       has to be copied. Anything that isn't known to be free space in a
+       filesystem we can read is included.'''
+    free = filesystem_free_runs(f, 0)
+    if free is None:
+        free = []
+        for start in partitions(f):
+            try:
+                runs = filesystem_free_runs(f, start)
+            except (HelperError, struct.error, IndexError, ValueError), e:
+                warning('Copying partition at %d raw: %s', start, e)
+                continue
+            if runs is None:
+                info('Copying partition at %d raw: unknown filesystem', start)
+                continue
+            free.extend(runs)
+
+    ranges = []
+    offset = 0
+    for start, end in sorted(free):
+        end = min(end, size)
+        if end - start < min_free_run or start < offset:
+            continue
+        ranges.append((offset, start))
+        offset = end
+    ranges.append((offset, size))
+    skipped = size - sum(e - s for s, e in ranges)
+    info('Skipping %d bytes of filesystem free space', skipped)
+    return [r for r in ranges if r[1] > r[0]]
+
+def parse_manifest(text, size):
+    '''Return the list of chunk hashes in a manifest for a device of size
+       bytes'''
+    lines = text.splitlines()
+    if not lines or lines[0] + '\n' != manifest_format % (
+            manifest_chunk_size, size):
+        raise HelperError('manifest does not match the device (%s)' %
+                          (lines and lines[0]))
+    hashes = lines[1:]
+    if len(hashes) != (size + manifest_chunk_size - 1) / manifest_chunk_size:
+        raise HelperError('manifest has the wrong number of chunks')
+    return hashes
+
+def manifest_urls(filename, name):
+    '''Return the (base manifest URL, manifest upload URL) for a device from
+       a file of "DEVICE BASEURL PUTURL" lines. A BASEURL of "-" means there
+       is no base manifest.'''
+    for line in open(filename):
+        fields = line.split()
+        if len(fields) == 3 and fields[0] == name:
+            return fields[1], fields[2]
+    return None, None
+
+def upload(url, data):
+    '''PUT data to a presigned S3 URL'''
+    request = urllib2.Request(url, data)
+    request.add_header('Content-Type', 'application/octet-stream')
+    request.get_method = lambda: 'PUT'
+    urllib2.urlopen(request).read()
+
+def read_exact(f, size):
+    '''Read exactly size bytes from a file or fail'''
+    data = f.read(size)
+    if len(data) != size:
+        raise HelperError('stream ended early (expected %d bytes, got %d)' %
+                          (size, len(data)))
+    return data
+
+def connect(host, port, interval = 5, timeout = None):
+    '''Connect to host:port, retrying until the other side is listening or
+       timeout seconds have passed'''
+    start = time()
+    while True:
+        try:
+            return socket.create_connection((host, port))
+        except socket.error, e:
+            if timeout is not None and time() - start > timeout:
+                raise
+            debug('Connection to %s:%d failed (%s), retrying', host, port, e)
+            sleep(interval)
+
+def send_frames(conn, queue):
+    '''Send frames from a queue to a client until None is received. If the
+       client goes away the rest of the frames are dropped, so that the
+       other clients aren't held up.'''
+    error = None
+    while True:
+        data = queue.get()
+        if data is None:
+            break
+        if error is None:
+            try:
+                conn.sendall(data)
+            except socket.error, e:
+                warning('Lost client: %s', e)
+                error = e
+    conn.close()
+    if error is not None:
+        raise error
+
+def serve(opts):
+    '''Send stdin to the first --clients clients that connect to the port'''
+    pool = OrderedWorkers(hash_block, opts.workers, opts.buffer)
+    reader = Stage(hash_blocks, sys.stdin, pool)
+    reader.start()
+
+    lsock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    lsock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    lsock.bind(('', opts.port))
+    lsock.listen(opts.clients * 4)
+    clients = {}
+    senders = []
+    while len([c for c in clients.values() if None not in c]) < opts.clients:
+        info('Waiting for connections on port %d', opts.port)
+        conn, addr = lsock.accept()
+        try:
+            token, index, count = conn.makefile('rb').readline().split()
+            index, count = int(index), int(count)
+            streams = clients.setdefault(token, [None] * count)
+            if streams[index] is not None:
+                raise ValueError
+        except (ValueError, IndexError):
+            warning('Bad connection from %s:%d', addr[0], addr[1])
+            conn.close()
+            continue
+        info('Sending to %s:%d (connection %d of %d)', addr[0], addr[1],
+             index + 1, count)
+        # Each connection gets its own sender and buffer, so a short stall
+        # on one link doesn't hold up the others
+        sender = Stage(send_frames, conn, Queue(max(opts.buffer / count, 1)))
+        sender.start()
+        streams[index] = sender
+        senders.append(sender)
+    lsock.close()
+
+    # The input is read once and every client gets the same frames
+    root = sha1()
+    sent = 0
+    frames = 0
+    start = time()
+    try:
+        while True:
+            block = pool.get()
+            if block is None:
+                break
+            data, digest = block
+            root.update(digest)
+            frame = frame_header.pack(len(data), digest) + data
+            for streams in clients.values():
+                streams[frames % len(streams)].args[1].put(frame)
+            sent += len(data)
+            frames += 1
+
+        # Don't send the trailer if the input failed, the clients will
+        # notice that the stream was cut short
+        reader.finish()
+        for sender in senders:
+            sender.args[1].put(frame_header.pack(0, root.digest()))
+    finally:
+        for sender in senders:
+            sender.args[1].put(None)
+    for sender in senders:
+        sender.finish()
+    info('Sent %d bytes to %d clients over %d connections (%.1f MB/s)', sent,
+         len(clients), len(senders), rate(sent, start))
+
+def fetch(opts):
+    '''Receive a stream from a server over --streams connections and write
+       it to stdout'''
+    info('Connecting to %s:%d', opts.host, opts.port)
+    token = os.urandom(8).encode('hex')
+    socks = []
+    for i in xrange(opts.streams):
+        sock = connect(opts.host, opts.port)
+        sock.sendall('%s %d %d\n' % (token, i, opts.streams))
+        socks.append(sock)
+    files = [sock.makefile('rb') for sock in socks]
+
+    # Each frame is checked before it's written, so a corrupt block stops
+    # the stream where it happened
+    pool = OrderedWorkers(check_block, opts.workers, opts.buffer)
+    writer = Stage(write_pool, pool, sys.stdout)
+    writer.start()
+
+    root = sha1()
+    received = 0
+    frames = 0
+    start = time()
+    while True:
+        f = files[frames % len(files)]
+        size, digest = frame_header.unpack(read_exact(f, frame_header.size))
+        if size == 0:
+            break
+        pool.put(read_exact(f, size), digest, 'stream', received)
+        root.update(digest)
+        received += size
+        frames += 1
+    pool.close()
+    writer.finish()
+
+    # The trailer is on every connection
+    for other in files:
+        if other is not f:
+            size, trailer = frame_header.unpack(read_exact(other,
+                                                frame_header.size))
+            if size != 0 or trailer != digest:
+                raise HelperError('connections ended differently')
+    if digest != root.digest():
+        raise HelperError('tree hash mismatch after %d bytes' % received)
+    for sock in socks:
+        sock.close()
+    info('Received %d bytes (%.1f MB/s)', received, rate(received, start))
+
+def load_urls(filename, name):
+    '''Return the list of part URLs and the done URL for name from a file of
+       "NAME INDEX URL" lines, where INDEX is a part number or "done"'''
+    parts = {}
+    done = None
+    for line in open(filename):
+        fields = line.split()
+        if len(fields) == 3 and fields[0] == name:
+            if fields[1] == 'done':
+                done = fields[2]
+            else:
+                parts[int(fields[1])] = fields[2]
+    if not parts or done is None:
+        raise HelperError('no S3 URLs for %s in %s' % (name, filename))
+    return [parts[i] for i in sorted(parts)], done
+
+def s3_request(url, data = None):
+    '''GET an object from a presigned S3 URL, or PUT data to one, checking
+       the data against the ETag and retrying failures. None is returned if
+       the object to GET doesn't exist.'''
+    for attempt in xrange(s3_retries):
+        try:
+            if data is None:
+                response = urllib2.urlopen(url)
+                body = response.read()
+            else:
+                request = urllib2.Request(url, data)
+                request.add_header('Content-Type', 'application/octet-stream')
+                request.get_method = lambda: 'PUT'
+                response = urllib2.urlopen(request)
+                response.read()
+                body = data
+            etag = response.info().get('ETag', '').strip('"')
+            if etag and etag != md5(body).hexdigest():
+                raise HelperError('MD5 doesn\'t match the ETag')
+            return body
+        except urllib2.HTTPError, e:
+            if e.code == 404 and data is None:
+                return None
+            error = e
+        except (IOError, HelperError), e:
+            error = e
+        warning('S3 request failed (%s), retrying', error)
+        sleep(2 ** attempt)
+    raise HelperError('S3 request failed %d times: %s' % (s3_retries, error))
+
+def meter_pool(pool, name):
+    '''Take results from a pool in order, recording their total size as the
+       progress of stage name'''
+    make_dirs(progress_dir)
+    size = 0
+    start = time()
+    write_progress(name, size, False, start)
+    while True:
+        data = pool.get()
+        if data is None:
+            break
+        size += len(data)
+        write_progress(name, size, False, start)
+    write_progress(name, size, True, start)
+
+def s3_put(opts, name):
+    '''Upload stdin to S3 in parts, --streams at a time'''
+    urls, done = load_urls(opts.urls, name)
+    pool = OrderedWorkers(s3_request, opts.streams, opts.streams)
+    counter = Stage(meter_pool, pool, name + '.uploaded')
+    counter.start()
+
+    size = 0
+    parts = 0
+    start = time()
+    try:
+        while True:
+            data = sys.stdin.read(opts.part_size * 1048576)
+            if not data:
+                break
+            if parts == len(urls):
+                raise HelperError('%s needs more than %d parts' %
+                                  (name, len(urls)))
+            pool.put(urls[parts], data)
+            size += len(data)
+            parts += 1
+    finally:
+        pool.close()
+    counter.finish()
+    s3_request(done, '%d\n' % parts)
+    info('Uploaded %d bytes of %s in %d parts (%.1f MB/s)', size, name,
+         parts, rate(size, start))
+
+def fetch_part(url, done, index):
+    '''Download a part once it has been uploaded. Return an empty string if
+       the stream turns out to have fewer parts.'''
+    while True:
+        data = s3_request(url)
+        if data is not None:
+            return data
+        count = s3_request(done)
+        if count is not None and int(count) <= index:
+            return ''
+        sleep(s3_poll)
+
+def write_parts(pool, f, name, end):
+    '''Write parts from a pool to a file in order until an empty one marks
+       the end, then drain the pool'''
+    make_dirs(progress_dir)
+    size = 0
+    start = time()
+    write_progress(name, size, False, start)
+    try:
+        while True:
+            data = pool.get()
+            if data is None:
+                break
+            if end:
+                continue
+            if not data:
+                end.append(True)
+                continue
+            f.write(data)
+            size += len(data)
+            write_progress(name, size, False, start)
+        f.flush()
+    except Exception, e:
+        pool.stop(e)
+        raise
+    write_progress(name, size, True, start)
+
+def s3_get(opts, name):
+    '''Download a stream from S3 to stdout as its parts are uploaded,
+       --streams at a time'''
+    urls, done = load_urls(opts.urls, name)
+    pool = OrderedWorkers(fetch_part, opts.streams, opts.streams)
+    end = []
+    writer = Stage(write_parts, pool, sys.stdout, name + '.downloaded', end)
+    writer.start()
+    start = time()
+    try:
+        for index, url in enumerate(urls):
+            if end:
+                break
+            pool.put(url, done, index)
+    finally:
+        pool.close()
+    writer.finish()
+    if not end and int(s3_request(done) or 0) != len(urls):
+        raise HelperError('%s has more parts than there are URLs' % name)
+    info('Downloaded %s (%.1f s)', name, time() - start)
+
+def save_link(link):
+    '''Save what was measured about the link for the progress reports'''
+    f = open(link_file + '.tmp', 'w')
+    json.dump(link, f)
+    f.close()
+    os.rename(link_file + '.tmp', link_file)
+
+def s3_bench(opts):
+    '''Time uploading the "bench" parts to S3, --streams at a time'''
+    urls, done = load_urls(opts.urls, 'bench')
+    data = os.urandom(block_size) * opts.part_size
+    pool = OrderedWorkers(s3_request, opts.streams, len(urls) + 1)
+    start = time()
+    for url in urls:
+        pool.put(url, data)
+    pool.close()
+    while pool.get() is not None:
+        pass
+    mbps = len(urls) * len(data) * 8 / max(time() - start, 0.001) / 1e6
+    s3_request(done, '%d\n' % len(urls))
+    info('S3 upload: %.1f Mbit/s', mbps)
+    save_link({'s3_upload': mbps})
+
+def stripe_range(stripe, size):
+    '''Return the (start, end) byte range of stripe "I/N" of a device, I
+       counting from 0. Stripes start on a block boundary.'''
+    try:
+        i, n = [int(x) for x in stripe.split('/')]
+    except ValueError:
+        raise HelperError('bad stripe %s, expected I/N' % stripe)
+    if not 0 <= i < n:
+        raise HelperError('bad stripe %s, I must be 0 to N - 1' % stripe)
+    blocks = (size + block_size - 1) / block_size
+    return (min(blocks * i / n * block_size, size),
+            min(blocks * (i + 1) / n * block_size, size))
+
+def read_image(opts, path):
+    '''Write a sparse image of a device, or of one --stripe of it, to
+       stdout. With --raw the whole device is written as it is.'''
+    f = open(path, 'rb')
+    size = device_size(f)
+    if opts.raw:
+        for offset, data in read_blocks(path, [(0, size)], opts.readers,
+                                        opts.meter):
+            sys.stdout.write(data)
+        sys.stdout.flush()
+        return
+    ranges = [(0, size)]
+    if opts.used_only:
+        try:
+            ranges = used_ranges(f, size)
+        except (HelperError, struct.error, IndexError, ValueError), e:
+            warning('Copying %s raw: %s', path, e)
+    if opts.stripe:
+        # Records keep their offset in the device, so the stripes of a
+        # device can be written to it in any order
+        start, end = stripe_range(opts.stripe, size)
+        ranges = [(max(r[0], start), min(r[1], end)) for r in ranges
+                  if r[0] < end and r[1] > start]
+
+    base = None
+    base_url = put_url = None
+    if opts.manifests:
+        base_url, put_url = manifest_urls(opts.manifests,
+                                          os.path.basename(path))
+        if base_url and base_url != '-':
+            base = parse_manifest(urllib2.urlopen(base_url).read(), size)
+
+    queue = Queue(opts.buffer)
+    hashes = []
+    if put_url:
+        reader = Stage(read_chunks, path, queue, size, ranges, base, hashes,
+                       opts.readers, opts.meter)
+    else:
+        reader = Stage(read_extents, path, queue, ranges, opts.readers,
+                       opts.meter)
+    reader.start()
+
+    out = sys.stdout
+    out.write(image_header.pack(image_magic, size))
+    used = 0
+    start = time()
+    while True:
+        extent = queue.get()
+        if extent is None:
+            break
+        out.write(record_header.pack(extent[0], len(extent[1])))
+        out.write(extent[1])
+        used += len(extent[1])
+    reader.finish()
+    out.write(record_header.pack(0, 0))
+    out.flush()
+    info('Read %s: sent %d of %d bytes (%.1f%%, %.1f MB/s)', path,
+         used, size, size and 100.0 * used / size, rate(used, start))
+
+    if put_url:
+        if base is not None:
+            changed = len([i for i in xrange(len(hashes))
+                           if hashes[i] != base[i]])
+            info('%d of %d chunks changed since the base manifest', changed,
+                 len(hashes))
+        upload(put_url, manifest_format % (manifest_chunk_size, size)
+                        + ''.join(h + '\n' for h in hashes))
+        info('Uploaded manifest for %s', path)
+
+def write_image(opts, path):
+    '''Write a sparse image from stdin to a device, skipping the holes. With
+       --raw stdin is the whole device instead.'''
+    f = open(path, 'r+b')
+    if not opts.raw:
+        magic, size = image_header.unpack(read_exact(sys.stdin,
+                                                     image_header.size))
+        if magic != image_magic:
+            raise HelperError('input is not a sparse image')
+        if device_size(f) < size and not os.path.isfile(path):
+            raise HelperError('%s is smaller than the image (%d bytes)' %
+                              (path, size))
+
+    written = None
+    if opts.verify:
+        written = {}
+    queue = Queue(opts.buffer)
+    writer = Stage(write_extents, f, queue, written)
+    writer.start()
+
+    used = 0
+    start = time()
+    while opts.raw:
+        data = sys.stdin.read(block_size)
+        if not data:
+            size = used
+            break
+        queue.put((used, data))
+        used += len(data)
+    while not opts.raw:
+        offset, length = record_header.unpack(read_exact(sys.stdin,
+                                                         record_header.size))
+        if length == 0:
+            break
+        if offset + length > size:
+            raise HelperError('record past the end of the image')
+        queue.put((offset, read_exact(sys.stdin, length)))
+        used += length
+    queue.put(None)
+    writer.finish()
+
+    # Regular files are truncated to size so the holes stay sparse
+    if os.path.isfile(path) and not opts.raw:
+        f.truncate(size)
+    info('Wrote %s: %d bytes of data, left %d bytes untouched (%.1f MB/s)',
+         path, used, size - used, rate(used, start))
+    if opts.verify:
+        drop_cache(f)
+    f.close()
+    if opts.verify:
+        verify_device(path, written, opts.workers)
+
+def split_chunks(opts, prefix):
+    '''Split stdin into chunk files named PREFIX00000, PREFIX00001... and
+       write their manifest to --manifest'''
+    pool = OrderedWorkers(hash_block, opts.workers, opts.buffer)
+    reader = Stage(hash_blocks, sys.stdin, pool)
+    reader.start()
+
+    chunk_bytes = opts.chunk_size * 1048576
+    lines = []
+    f = None
+    while True:
+        block = pool.get()
+        if block is None or f is None or size + len(block[0]) > chunk_bytes:
+            if f is not None:
+                f.close()
+                lines.append('%s %d %s %s\n' % (name, size,
+                             sha1(''.join(leaves)).hexdigest(),
+                             ' '.join(l.encode('hex') for l in leaves)))
+            if block is None:
+                break
+            name = '%s%05d' % (prefix, len(lines))
+            f = open(name, 'wb')
+            size = 0
+            leaves = []
+        f.write(block[0])
+        size += len(block[0])
+        leaves.append(block[1])
+    reader.finish()
+
+    f = open(opts.manifest + '.tmp', 'w')
+    f.write(''.join(lines))
+    f.close()
+    os.rename(opts.manifest + '.tmp', opts.manifest)
+    info('Split %s into %d chunks', opts.manifest, len(lines))
+
+def read_chunk(name, size, leaves, pool):
+    '''Read a chunk file and check each of its blocks in a pool'''
+    try:
+        f = open(name, 'rb')
+    except IOError:
+        raise HelperError('%s is missing' % name)
+    if device_size(f) != size:
+        raise HelperError('%s is the wrong size' % name)
+    for i, leaf in enumerate(leaves):
+        pool.put(read_exact(f, min(block_size, size - i * block_size)),
+                 leaf, name, i * block_size)
+    f.close()
+
+def join_chunks(opts, manifest):
+    '''Write the chunk files in a manifest to stdout, checking each block
+       before it's written. A chunk that's corrupt is removed so that it's
+       fetched again.'''
+    chunks = []
+    for line in open(manifest):
+        try:
+            name, size, root = line.split()[:3]
+            size = int(size)
+            leaves = [l.decode('hex') for l in line.split()[3:]]
+        except (ValueError, TypeError):
+            leaves = None
+        if (not leaves or sha1(''.join(leaves)).hexdigest() != root
+                or len(leaves) != (size + block_size - 1) / block_size):
+            os.remove(manifest)
+            raise HelperError('%s is corrupt' % manifest)
+        chunks.append((name, size, leaves))
+
+    pool = OrderedWorkers(check_block, opts.workers, opts.buffer)
+    writer = Stage(write_pool, pool, sys.stdout)
+    writer.start()
+    start = time()
+    try:
+        try:
+            for name, size, leaves in chunks:
+                read_chunk(name, size, leaves, pool)
+        finally:
+            pool.close()
+        writer.finish()
+    except CorruptBlock, e:
+        os.remove(e.name)
+        raise
+    size = sum(c[1] for c in chunks)
+    info('Joined %d chunks, %d bytes (%.1f MB/s)', len(chunks), size,
+         rate(size, start))
+
+def compress(opts):
+    '''Compress stdin to stdout using all of the CPUs'''
+    level = opts.level or 1
+    pool = OrderedWorkers(compress_block, opts.workers, opts.workers * 4)
+    stats = [0]
+    writer = Stage(write_compressed, pool, sys.stdout, stats)
+    writer.start()
+
+    size = 0
+    blocks = 0
+    start = last = time()
+    busy = 0.0
+    while True:
+        data = sys.stdin.read(block_size)
+        if not data:
+            break
+        pool.put(data, level)
+        size += len(data)
+        blocks += 1
+
+        if not opts.level and blocks % compress_interval == 0:
+            now = time()
+            used = sum(pool.busy)
+            load = (used - busy) / ((now - last) * opts.workers)
+            if load > compress_busy_high and level > 1:
+                level -= 1
+            elif load < compress_busy_low and level < 9:
+                level += 1
+            debug('Compression load %.2f, level %d', load, level)
+            busy, last = used, now
+    pool.close()
+    writer.finish()
+
+    info('Compressed %d bytes to %d (ratio %.2f, level %d, %.1f MB/s)',
+         size, stats[0], stats[0] and float(size) / stats[0], level,
+         rate(size, start))
+
+def decompress(opts):
+    '''Decompress stdin to stdout using all of the CPUs'''
+    pool = OrderedWorkers(decompress_block, opts.workers, opts.workers * 4)
+    writer = Stage(write_pool, pool, sys.stdout)
+    writer.start()
+
+    size = 0
+    start = time()
+    while True:
+        length, flag = compress_header.unpack(read_exact(sys.stdin,
+                                              compress_header.size))
+        if length == 0:
+            break
+        pool.put(flag, read_exact(sys.stdin, length))
+        size += length
+    pool.close()
+    writer.finish()
+    info('Decompressed %d bytes (%.1f MB/s)', size, rate(size, start))
+
+def encrypt(opts):
+    '''Encrypt stdin to stdout using all of the CPUs'''
+    key = stream_key(opts.key_file)
+    load_crypto()
+    prefix = os.urandom(8)
+    sys.stdout.write(cipher_header.pack(cipher_magic, prefix))
+    pool = OrderedWorkers(encrypt_segment, opts.workers, opts.workers * 4)
+    writer = Stage(write_pool, pool, sys.stdout)
+    writer.start()
+
+    size = 0
+    index = 0
+    start = time()
+    while True:
+        data = sys.stdin.read(block_size)
+        if not data:
+            break
+        pool.put(key, prefix, index, segment_data, data)
+        index += 1
+        size += len(data)
+
+    # The commands feeding stdin touch --ok-file once they've succeeded. If
+    # they didn't, the stream is aborted rather than ended.
+    aborted = opts.ok_file and not os.path.exists(opts.ok_file)
+    if aborted:
+        pool.put(key, prefix, index, segment_abort, '')
+    else:
+        pool.put(key, prefix, index, segment_last, segment_trailer.pack(size))
+    pool.close()
+    writer.finish()
+    if aborted:
+        raise HelperError('aborted the stream after %d bytes, the input'
+                          ' failed' % size)
+    info('Encrypted %d bytes (%.1f MB/s)', size, rate(size, start))
+
+def decrypt(opts):
+    '''Decrypt and authenticate stdin to stdout using all of the CPUs'''
+    key = stream_key(opts.key_file)
+    load_crypto()
+    magic, prefix = cipher_header.unpack(read_exact(sys.stdin,
+                                                    cipher_header.size))
+    if magic != cipher_magic:
+        raise HelperError('input is not an encrypted stream')
+    pool = OrderedWorkers(decrypt_segment, opts.workers, opts.workers * 4)
+    writer = Stage(write_pool, pool, sys.stdout)
+    writer.start()
+
+    size = 0
+    index = 0
+    start = time()
+    while True:
+        length, kind = segment_header.unpack(read_exact(sys.stdin,
+                                                        segment_header.size))
+        if length > block_size or kind > segment_abort:
+            raise HelperError('bad segment header %d %d' % (length, kind))
+        data = read_exact(sys.stdin, length + tag_size)
+        if kind != segment_data:
+            break
+        pool.put(key, prefix, index, kind, data, size)
+        index += 1
+        size += length
+    pool.close()
+    writer.finish()
+
+    # The last segment is only trusted once it's been authenticated
+    trailer = decrypt_segment(key, prefix, index, kind, data, size)
+    if kind == segment_abort:
+        raise HelperError('the source aborted the stream after %d bytes'
+                          % size)
+    if len(trailer) != segment_trailer.size or \
+            segment_trailer.unpack(trailer)[0] != size:
+        raise HelperError('stream has %d bytes, not the length the source'
+                          ' sent' % size)
+    info('Decrypted %d bytes (%.1f MB/s)', size, rate(size, start))
+
+def benchmark(opts):
+    '''Compare the speed of openssl enc -aes-128-cbc, which the transfers
+       used to be encrypted with, to encrypt and decrypt'''
+    secret = tempfile.NamedTemporaryFile()
+    secret.write(os.urandom(256).encode('base64'))
+    secret.flush()
+    plain = tempfile.NamedTemporaryFile()
+    block = os.urandom(block_size)
+    for i in xrange(opts.size):
+        plain.write(block)
+    plain.flush()
+    cipher = tempfile.NamedTemporaryFile()
+    size = opts.size * block_size
+
+    helper = [sys.executable, os.path.abspath(__file__)]
+    workers = ['--workers', str(opts.workers), '--key-file', secret.name]
+    openssl = ['openssl', 'enc', '-aes-128-cbc', '-pass',
+               'file:' + secret.name]
+    runs = [('openssl enc -e -aes-128-cbc', openssl + ['-e'], plain),
+            ('openssl enc -d -aes-128-cbc', openssl + ['-d'], cipher),
+            ('encrypt (%d workers)' % opts.workers,
+             helper + ['encrypt'] + workers, plain),
+            ('decrypt (%d workers)' % opts.workers,
+             helper + ['decrypt'] + workers, cipher)]
+    devnull = open(os.devnull, 'w')
+    for name, command, f in runs:
+        # The output of each encryption is the input of the decryption
+        # after it
+        out = f is plain and cipher or devnull
+        f.seek(0)
+        if out is cipher:
+            out.seek(0)
+            out.truncate()
+        start = time()
+        subprocess.check_call(command, stdin = f, stdout = out,
+                              stderr = devnull)
+        print '%-32s %8.1f MB/s' % (name, rate(size, start))
+
+def make_dirs(path):
+    '''Create a directory and its parents, tolerating another helper
+       creating it first'''
+    try:
+        os.makedirs(path)
+    except OSError:
+        if not os.path.isdir(path):
+            raise
+
+def write_progress(name, size, done, start):
+    '''Record the progress of a meter'''
+    path = os.path.join(progress_dir, name)
+    f = open(path + '.tmp', 'w')
+    f.write('%d %d %.3f %.3f\n' % (size, done, start, time()))
+    f.close()
+    os.rename(path + '.tmp', path)
+
+def meter(opts, name):
+    '''Copy stdin to stdout and record how many bytes have gone through'''
+    make_dirs(progress_dir)
+    size = 0
+    start = last = time()
+    write_progress(name, size, False, start)
+    while True:
+        data = sys.stdin.read(block_size)
+        if not data:
+            break
+        sys.stdout.write(data)
+        size += len(data)
+        if time() - last >= meter_interval:
+            write_progress(name, size, False, start)
+            last = time()
+    sys.stdout.flush()
+    write_progress(name, size, True, start)
+
+def progress(chunks):
+    '''Return {volume: {stage: [bytes, done, start, updated]}} for every
+       meter, and for the chunk files of each volume as stage chunks if it's
+       set. The chunk files' times are the first and last modification.'''
+    volumes = {}
+    for path in glob.glob(os.path.join(progress_dir, '*.*')):
+        name = os.path.basename(path)
+        if name.endswith('.tmp'):
+            continue
+        try:
+            size, done, start, updated = open(path).read().split()
+        except (IOError, ValueError):
+            continue
+        volume, stage = name.rsplit('.', 1)
+        volumes.setdefault(volume, {})[stage] = [int(size), done == '1',
+                                                 float(start), float(updated)]
+    if chunks:
+        for path in glob.glob('*.img.*'):
+            volume = path.split('.', 1)[0]
+            try:
+                size = os.path.getsize(path)
+                mtime = os.path.getmtime(path)
+            except OSError:
+                continue
+            stats = volumes.setdefault(volume, {}).setdefault(chunks,
+                    [0, False, mtime, mtime])
+            stats[0] += size
+            stats[2] = min(stats[2], mtime)
+            stats[3] = max(stats[3], mtime)
+    return volumes
+
+def send_burst(sock, addr, step, rate, seconds, size):
+    '''Send size byte datagrams to addr at rate Mbit/s for seconds and return
+       the number sent'''
+    padding = '\0' * (size - probe_datagram.size)
+    interval = size * 8 / (rate * 1000000.0)
+    sent = 0
+    start = time()
+    while True:
+        elapsed = time() - start
+        if elapsed >= seconds:
+            break
+        while sent < int(elapsed / interval) + 1:
+            try:
+                sock.sendto(probe_datagram.pack(step, sent) + padding, addr)
+            except socket.error:
+                # The send buffer is full, give it a moment
+                break
+            sent += 1
+        sleep(0.0005)
+    return sent
+
+def probe_client(conn, addr, lock):
+    '''Answer the PING and BURST requests of a probe'''
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    f = conn.makefile('rb')
+    try:
+        while True:
+            fields = f.readline().split()
+            if not fields:
+                break
+            if fields[0] == 'PING':
+                conn.sendall('PONG\n')
+            elif fields[0] == 'BURST':
+                port, step, size = [int(x) for x in fields[1:4]]
+                rate, seconds = float(fields[4]), float(fields[5])
+                # Bursts to different destinations would skew each other
+                lock.acquire()
+                try:
+                    sent = send_burst(sock, (addr[0], port), step, rate,
+                                      seconds, size)
+                finally:
+                    lock.release()
+                conn.sendall('SENT %d\n' % sent)
+            elif fields[0] == 'SINK':
+                # Send as much as possible over TCP for a while
+                end = time() + float(fields[1])
+                while time() < end:
+                    conn.sendall(zero_block)
+                break
+    finally:
+        conn.close()
+        sock.close()
+
+def probe_server(opts):
+    '''Answer probes from the destinations until killed'''
+    lsock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    lsock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    lsock.bind(('', opts.port))
+    lsock.listen(5)
+    lock = threading.Lock()
+    while True:
+        conn, addr = lsock.accept()
+        info('Probe from %s:%d', addr[0], addr[1])
+        Stage(probe_client, conn, addr, lock).start()
+
+def count_datagrams(sock, counts):
+    '''Count the probe datagrams received for each step'''
+    while True:
+        try:
+            data = sock.recv(65536)
+        except socket.timeout:
+            continue
+        except socket.error:
+            break
+        if len(data) >= probe_datagram.size:
+            step = probe_datagram.unpack(data[:probe_datagram.size])[0]
+            counts[step] = counts.get(step, 0) + 1
+
+def sink(host, port, counts):
+    '''Count the bytes a probe server sends over TCP for probe_tcp_seconds'''
+    sock = connect(host, port, timeout = probe_timeout)
+    sock.sendall('SINK %f\n' % probe_tcp_seconds)
+    size = 0
+    while True:
+        data = sock.recv(block_size)
+        if not data:
+            break
+        size += len(data)
+    sock.close()
+    counts.append(size)
+
+def probe_tcp(opts):
+    '''Return the Mbit/s a probe server can send over --streams TCP
+       connections'''
+    counts = []
+    sinks = [Stage(sink, opts.host, opts.port, counts)
+             for i in xrange(opts.streams)]
+    start = time()
+    for s in sinks:
+        s.start()
+    for s in sinks:
+        s.finish()
+    return sum(counts) * 8 / (time() - start) / 1e6
+
+def probe_s3(opts):
+    '''Return the Mbit/s the "bench" parts can be downloaded from S3 at,
+       --streams at a time, once the source has uploaded them'''
+    urls, done = load_urls(opts.urls, 'bench')
+    start = time()
+    while s3_request(done) is None:
+        if time() - start > probe_timeout:
+            raise HelperError('the S3 benchmark parts were never uploaded')
+        sleep(s3_poll)
+    pool = OrderedWorkers(s3_request, opts.streams, len(urls) + 1)
+    start = time()
+    for url in urls:
+        pool.put(url)
+    pool.close()
+    size = 0
+    while True:
+        data = pool.get()
+        if data is None:
+            break
+        size += len(data)
+    return size * 8 / max(time() - start, 0.001) / 1e6
+
+def tsunami_settings(link):
+    '''Pick the tsunami client settings for a link measured by probe(). The
+       target rate is the best rate that got through with little loss, or at
+       least tsunami's default if no rate was lossy. The error threshold is
+       kept well above the loss seen at the lowest rate, which is the
+       link's background loss rather than congestion.'''
+    steps = link['steps']
+    clean = [s for s in steps if s['loss'] <= probe_loss]
+    if not clean:
+        rate = steps[0]['mbps']
+    elif clean[-1] is steps[-1]:
+        rate = max(clean[-1]['mbps'], tsunami_default_rate)
+    else:
+        rate = max(s['mbps'] for s in clean)
+    error = min(max(steps[0]['loss'] * 300, 5.0), 20.0)
+    return {'rate': max(int(rate), 1), 'error': round(error, 1),
+            'blocksize': link['size'] - tsunami_header}
+
+def probe(opts):
+    '''Measure the link from a probe server and print the tsunami client
+       commands to use on it'''
+    conn = connect(opts.host, opts.port, timeout = probe_timeout)
+    f = conn.makefile('rb')
+    rtts = []
+    for i in xrange(probe_pings):
+        start = time()
+        conn.sendall('PING\n')
+        if not f.readline():
+            raise HelperError('probe server went away')
+        rtts.append(time() - start)
+    rtt = min(rtts)
+
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, probe_buffer)
+    sock.bind(('', opts.udp_port))
+    sock.settimeout(0.5)
+    counts = {}
+    counter = Stage(count_datagrams, sock, counts)
+    counter.start()
+
+    link = {'rtt': rtt, 'size': tsunami_blocksize + tsunami_header,
+            'steps': []}
+    step = 0
+    for rate in probe_rates:
+        conn.sendall('BURST %d %d %d %f %f\n' % (opts.udp_port, step,
+                     link['size'], rate, probe_seconds))
+        fields = f.readline().split()
+        if not fields:
+            raise HelperError('probe server went away')
+        sent = int(fields[1])
+        # Wait for the datagrams that are still on the way
+        sleep(rtt + 0.5)
+        received = counts.get(step, 0)
+        step += 1
+        if not received and link['size'] != (tsunami_default_blocksize +
+                                               tsunami_header):
+            # Large datagrams don't get through, fall back to the default
+            warning('No %d byte datagrams got through, trying %d bytes',
+                    link['size'], tsunami_default_blocksize + tsunami_header)
+            link['size'] = tsunami_default_blocksize + tsunami_header
+            continue
+        if not received:
+            raise HelperError('no UDP datagrams got through')
+        result = {'rate': rate, 'sent': sent, 'received': received,
+                  'loss': max(1 - float(received) / max(sent, 1), 0.0),
+                  'mbps': received * link['size'] * 8 / probe_seconds / 1e6}
+        link['steps'].append(result)
+        info('Probe at %d Mbit/s: received %.1f Mbit/s, %.2f%% loss', rate,
+             result['mbps'], result['loss'] * 100)
+        if result['loss'] > probe_loss:
+            break
+    conn.close()
+    sock.close()
+
+    link['settings'] = tsunami_settings(link)
+    info('Link RTT %.1f ms; tsunami rate %dM, error %.1f%%, blocksize %d',
+         rtt * 1000, link['settings']['rate'], link['settings']['error'],
+         link['settings']['blocksize'])
+
+    # With --transport auto the other transports are timed too. One that
+    # fails is left out, so it isn't picked.
+    try:
+        if opts.tcp:
+            link['tcp'] = probe_tcp(opts)
+            info('TCP over %d connections: %.1f Mbit/s', opts.streams,
+                 link['tcp'])
+        if opts.urls:
+            link['s3_download'] = probe_s3(opts)
+            info('S3 download: %.1f Mbit/s', link['s3_download'])
+    except (socket.error, HelperError), e:
+        warning('Could not time the other transports: %s', e)
+    save_link(link)
+    print ('set rate %(rate)dM set error %(error)s'
+           ' set blocksize %(blocksize)d' % link['settings'])
+
+def report(opts):
+    '''Upload the progress of the transfer to a presigned S3 URL every
+       --interval seconds, along with the link measured by probe'''
+    while True:
+        try:
+            status = {'time': time(), 'volumes': progress(opts.chunks)}
+            if os.path.exists(link_file):
+                status['link'] = json.load(open(link_file))
+            upload(opts.url, json.dumps(status))
+        except (IOError, ValueError, urllib2.URLError), e:
+            warning('Progress upload failed: %s', e)
+        if opts.once:
+            break
+        sleep(opts.interval)
+
+# Command name: (function, positional arguments)
+commands = {
+        'serve':        (serve, []),
+        'fetch':        (fetch, []),
+        'read':         (read_image, ['DEVICE']),
+        'write':        (write_image, ['DEVICE']),
+        'split':        (split_chunks, ['PREFIX']),
+        'join':         (join_chunks, ['MANIFEST']),
+        'compress':     (compress, []),
+        'meter':        (meter, ['VOLUME.STAGE']),
+        'report':       (report, []),
+        'probe-server': (probe_server, []),
+        'probe':        (probe, []),
+        's3-put':       (s3_put, ['NAME']),
+        's3-get':       (s3_get, ['NAME']),
+        's3-bench':     (s3_bench, []),
+        'decompress':   (decompress, []),
+        'encrypt':      (encrypt, []),
+        'decrypt':      (decrypt, []),
+        'benchmark':    (benchmark, []),
+        }
+
+###############################################################################
+# Command Line
+###############################################################################
+if __name__ == '__main__':
+    parser = OptionParser(usage = '%prog COMMAND [ARGS] [options]\n\n'
+                          + 'commands:\n' + ''.join('  %s %s\n' %
+                          (c, ' '.join(commands[c][1]))
+                          for c in sorted(commands)))
+    parser.add_option('--host',
+                      help = 'host to fetch the stream from or to probe')
+    parser.add_option('--port', type = 'int', default = 46225,
+                      help = 'TCP port for the stream (default: %default)')
+    parser.add_option('--udp-port', type = 'int', default = 46224,
+                      help = 'probe: UDP port to receive the probe on'
+                             + ' (default: %default)')
+    parser.add_option('--streams', type = 'int', default = 1,
+                      help = 'fetch: number of TCP connections to spread the'
+                             + ' stream over; s3-*: number of parts to'
+                             + ' transfer at a time (default: %default)')
+    parser.add_option('--urls',
+                      help = 's3-*/probe: file of "NAME INDEX URL" lines with'
+                             + ' the presigned S3 URLs of the parts')
+    parser.add_option('--part-size', type = 'int', default = s3_part_size,
+                      metavar = 'MB',
+                      help = 's3-*: size of the parts (default: %default)')
+    parser.add_option('--tcp', action = 'store_true', default = False,
+                      help = 'probe: also time --streams TCP connections')
+    parser.add_option('--clients', type = 'int', default = 1,
+                      help = 'serve: number of clients to send the stream to'
+                             + ' (default: %default)')
+    parser.add_option('--buffer', type = 'int', default = 64,
+                      help = 'number of 1MB blocks to buffer between stages'
+                             + ' (default: %default)')
+    parser.add_option('--used-only', action = 'store_true', default = False,
+                      help = 'read: skip the free space of ext2/3/4, XFS and'
+                             + ' NTFS filesystems')
+    parser.add_option('--manifests',
+                      help = 'read: file of "DEVICE BASEURL PUTURL" lines used'
+                             + ' to fetch the base manifest and upload the new'
+                             + ' one')
+    parser.add_option('--stripe', metavar = 'I/N',
+                      help = 'read: only read stripe I of N equal byte ranges'
+                             + ' of the device, counting from 0')
+    parser.add_option('--readers', type = 'int', default = 16,
+                      help = 'read: number of 1MB reads of the device in'
+                             + ' flight at a time (default: %default)')
+    parser.add_option('--meter', metavar = 'VOLUME.STAGE',
+                      help = 'read: record how many bytes have been read from'
+                             + ' the device as the progress of VOLUME.STAGE')
+    parser.add_option('--ok-file', metavar = 'FILE',
+                      help = 'encrypt: abort the stream instead of ending it'
+                             + ' unless FILE exists once stdin ends')
+    parser.add_option('--raw', action = 'store_true', default = False,
+                      help = 'read: write the whole device rather than a'
+                             + ' sparse image; write: stdin is the whole'
+                             + ' device')
+    parser.add_option('--verify', action = 'store_true', default = False,
+                      help = 'write: read the device back once it\'s written'
+                             + ' and check it against what was received')
+    parser.add_option('--chunk-size', type = 'int',
+                      default = default_chunk_size, metavar = 'MB',
+                      help = 'split: size of the chunk files'
+                             + ' (default: %default)')
+    parser.add_option('--manifest',
+                      help = 'split: file to write the manifest of the chunks'
+                             + ' to')
+    parser.add_option('--level', type = 'int', default = 0,
+                      help = 'compress: zlib level, 0 picks the level from'
+                             + ' the measured throughput (default: %default)')
+    parser.add_option('--workers', type = 'int', default = cpu_count(),
+                      help = 'number of threads for compressing, encrypting,'
+                             + ' hashing and verifying (default: %default)')
+    parser.add_option('--key-file',
+                      help = 'encrypt/decrypt: file holding the secret that'
+                             + ' the key is derived from')
+    parser.add_option('--size', type = 'int', default = 512, metavar = 'MB',
+                      help = 'benchmark: amount of data to encrypt'
+                             + ' (default: %default)')
+    parser.add_option('--url',
+                      help = 'report: presigned S3 URL to upload the progress'
+                             + ' to')
+    parser.add_option('--interval', type = 'int', default = 15,
+                      help = 'report: seconds between uploads'
+                             + ' (default: %default)')
+    parser.add_option('--once', action = 'store_true', default = False,
+                      help = 'report: upload the progress once and exit')
+    parser.add_option('--chunks', metavar = 'STAGE',
+                      help = 'report: also report the size of the chunk files'
+                             + ' of each volume as STAGE')
+    parser.add_option('-d', '--debug', action = 'store_true', default = False,
+                      help = 'turn on debugging output')
+    opts, args = parser.parse_args()
+
+    if not args or args[0] not in commands:
+        parser.error('a command is required')
+    func, params = commands[args[0]]
+    if len(args) != len(params) + 1:
+        parser.error('%s requires %s' % (args[0], ' '.join(params)))
+    if args[0] in ('fetch', 'probe') and not opts.host:
+        parser.error('%s requires --host' % args[0])
+    if args[0] == 'report' and not opts.url:
+        parser.error('report requires --url')
+    if args[0] in ('encrypt', 'decrypt') and not opts.key_file:
+        parser.error('%s requires --key-file' % args[0])
+    if args[0].startswith('s3-') and not opts.urls:
+        parser.error('%s requires --urls' % args[0])
+    if args[0] == 'split' and not opts.manifest:
+        parser.error('split requires --manifest')
+    if opts.stripe and opts.manifests:
+        parser.error('--stripe can\'t be used with --manifests')
+    if args[0] == 'read' and opts.raw and (opts.stripe or opts.manifests or
+                                           opts.used_only):
+        parser.error('read --raw reads the whole device')
+    if opts.readers < 1:
+        parser.error('--readers must be at least 1')
+
+    logging.basicConfig(format = '%(asctime)s %(levelname)s: %(message)s',
+                        datefmt = '%Y-%m-%d %H:%M:%S',
+                        level = opts.debug and logging.DEBUG or logging.INFO,
+                        stream = sys.stderr)
+
+    try:
+        func(opts, *args[1:])
+    except (HelperError, socket.error, IOError), e:
+        logging.error('%s failed: %s', args[0], e)
+        sys.exit(1)
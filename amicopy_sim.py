@@ -0,0 +1,1568 @@
+#!/usr/bin/env python
+#
+# amicopy_sim.py - Run amicopy end to end on this machine against a fake EC2
+# and S3, and report the throughput of each stage of the transfer
+#
+# amicopy.py runs unchanged with the fake boto modules below. Its instances
+# are processes that run their user data here: volumes are files, the
+# ephemeral drive is a directory, the instances talk to each other over
+# loopback and S3 is a small HTTP server. Snapshots are files in the work
+# directory, so the copied AMI is checked against the source byte by byte.
+
+import filecmp
+import hashlib
+import json
+import os
+import pipes
+import shutil
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import urllib
+from argparse import ArgumentParser
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from copy import copy
+from SocketServer import ThreadingMixIn
+from time import time
+from types import ModuleType
+
+import amicopy_helper
+
+###############################################################################
+# Constants
+###############################################################################
+block_size = 1024 * 1024
+
+# Devices of the volumes in the simulated source AMI. The first is the root.
+ami_devices = ['/dev/sda1', '/dev/sdh', '/dev/sdi', '/dev/sdj', '/dev/sdk',
+               '/dev/sdl', '/dev/sdm', '/dev/sdn', '/dev/sdo', '/dev/sdp']
+
+source_region = 'us-east-1'
+
+# How long each kind of state change takes, in multiples of --state-delay
+state_delays = {'instance start': 1.0, 'instance shutdown': 0.5,
+                'instance stop': 0.5, 'instance terminate': 0.5,
+                'volume detach': 0.25, 'snapshot': 1.5, 'image': 2.0}
+destination_regions = ['us-west-2', 'eu-west-1', 'us-west-1']
+
+patterns = ['random', 'zeros', 'text', 'mixed']
+transports = ['tsunami', 'tcp', 's3', 'auto']
+
+# Commands the user data expects that aren't the same here. halt leaves a
+# marker, so the instance terminates like an EC2 instance with
+# instance_initiated_shutdown_behavior = terminate, and nc -z only needs to
+# see whether a port is open.
+shims = {
+        'python':   '#!/bin/sh\nexec %s "$@"\n' % sys.executable,
+        'halt':     '#!/bin/sh\ntouch "$SIM_HALT"\n',
+        'nc':       '#!/bin/sh\nshift\nexec %s -c "import socket, sys; '
+                    'socket.create_connection((sys.argv[1], '
+                    'int(sys.argv[2])), 5)" "$@"\n' % sys.executable,
+        }
+
+# Filesystems the used-blocks check makes images of: the mkfs command, which
+# is told to leave the old data in the free space, the mount type and a fsck
+# that doesn't change anything. The images are check_fs_size MB, which is as
+# small as XFS goes, with check_files files of up to 3.6 MB on them.
+check_filesystems = [
+        ('ext2', ['mkfs.ext2', '-q', '-F', '-b', '1024', '-E', 'nodiscard'],
+         'ext2', ['e2fsck', '-f', '-n']),
+        ('ext4', ['mkfs.ext4', '-q', '-F', '-b', '4096', '-E', 'nodiscard'],
+         'ext4', ['e2fsck', '-f', '-n']),
+        ('xfs', ['mkfs.xfs', '-q', '-f', '-K'], 'xfs', ['xfs_repair', '-n']),
+        ('ntfs', ['mkntfs', '-q', '-F', '-Q'], 'ntfs-3g', ['ntfsfix', '-n']),
+        ]
+check_fs_size = 320
+check_files = 12
+
+# The waiters check runs with --state-delay check_state_delay, and allows
+# check_slack seconds for the describe calls on top of the poll interval
+check_state_delay = 6
+check_slack = 1.0
+# The streams check sends this much data, which doesn't end on a block
+# boundary, to a client for each number of connections in the list
+check_stream_size = 20 * block_size + 12345
+check_stream_clients = [3, 1]
+check_stripes = 3
+check_chunk_size = 4
+check_meters = 16
+# The probe check runs on loopback as it is, and again in a network namespace
+# with netem making it look like a link between regions
+check_netem = 'delay 20ms rate 200mbit'
+check_netem_rtt = 0.04
+check_netem_rate = 200
+# Exit status of the probe script when netem can't be set up
+check_skipped = 77
+
+# Where system tools are when they aren't on the PATH
+tool_dirs = ['/sbin', '/usr/sbin']
+
+###############################################################################
+# Fake boto
+###############################################################################
+class ResponseError(Exception):
+    '''An error response from the fake EC2 or S3'''
+    def __init__(self, status, reason, body = None, error_code = None):
+        Exception.__init__(self, '%d %s %s' % (status, reason, error_code))
+        self.status = status
+        self.reason = reason
+        self.body = body
+        self.error_code = error_code
+
+class EC2ResponseError(ResponseError): pass
+class S3ResponseError(ResponseError): pass
+
+def not_found(kind, ids):
+    return EC2ResponseError(400, 'Bad Request', error_code =
+                            'Invalid%s.NotFound' % kind)
+
+class BlockDeviceType(object):
+    def __init__(self, snapshot_id = None, size = None,
+                 delete_on_termination = False, volume_type = None,
+                 iops = None, ephemeral_name = None, volume_id = None):
+        self.snapshot_id = snapshot_id
+        self.size = size
+        self.delete_on_termination = delete_on_termination
+        self.volume_type = volume_type
+        self.iops = iops
+        self.ephemeral_name = ephemeral_name
+        self.volume_id = volume_id
+
+class BlockDeviceMapping(dict): pass
+
+class Region(object):
+    def __init__(self, name):
+        self.name = name
+
+class Reservation(object):
+    def __init__(self, instances):
+        self.instances = instances
+
+class Tag(object):
+    def __init__(self, name, value):
+        self.name = name
+        self.value = value
+
+class Image(object):
+    def __init__(self, connection, id, name, block_device_mapping,
+                 description = '', kernel_id = None,
+                 architecture = 'x86_64', root_device_name = '/dev/sda1'):
+        self.connection = connection
+        self.id = id
+        self.name = name
+        self.block_device_mapping = block_device_mapping
+        self.description = description
+        self.kernel_id = kernel_id
+        self.architecture = architecture
+        self.root_device_name = root_device_name
+        self.platform = None
+        self.state = 'available'
+
+class Snapshot(object):
+    def __init__(self, connection, id, path, volume_size, description = ''):
+        self.connection = connection
+        self.id = id
+        self.path = path
+        self.volume_size = volume_size
+        self.description = description
+        self.status = 'completed'
+
+    def delete(self):
+        self.connection._request('DeleteSnapshot')
+        if os.path.exists(self.path):
+            os.remove(self.path)
+        del self.connection.snapshots[self.id]
+
+class Volume(object):
+    def __init__(self, connection, id, path, size, snapshot_id = None):
+        self.connection = connection
+        self.id = id
+        self.path = path
+        self.size = size
+        self.snapshot_id = snapshot_id
+        self.status = 'available'
+        self.instance = None
+
+    def create_snapshot(self, description = ''):
+        ec2 = self.connection
+        ec2._request('CreateSnapshot')
+        ss = Snapshot(ec2, ec2.cloud.new_id('snap'), ec2.cloud.path(
+                      'snapshots', ec2.cloud.new_id('data')), self.size,
+                      description)
+        # The volume isn't written again, so the snapshot can share its data
+        os.link(self.path, ss.path)
+        ss.status = 'pending'
+        delay = None
+        if ec2.cloud.snapshot_rate:
+            # Take as long as EBS would
+            delay = os.path.getsize(ss.path) / 1048576.0 / \
+                    ec2.cloud.snapshot_rate
+        ec2.snapshots[ss.id] = ss
+        ec2.cloud.change_state(ss, 'snapshot', 'status', 'completed', delay)
+        return ss
+
+    def detach(self, force = False):
+        self.connection._request('DetachVolume')
+        if self.instance:
+            self.instance.volumes.remove((self.device, self))
+            del self.instance.block_device_mapping[self.device]
+            self.instance = None
+        self.status = 'detaching'
+        self.connection.cloud.change_state(self, 'volume detach', 'status',
+                                           'available')
+
+    def attach(self, instance_id, device):
+        self.connection._request('AttachVolume')
+        self.connection.instances[instance_id].attach(device, self)
+
+    def delete(self):
+        self.connection._request('DeleteVolume')
+        if os.path.exists(self.path):
+            os.remove(self.path)
+        del self.connection.volumes[self.id]
+
+class SecurityGroup(object):
+    def __init__(self, connection, id, name):
+        self.connection = connection
+        self.id = id
+        self.name = name
+        self.rules = set()
+
+    def authorize(self, protocol, from_port, to_port, cidr):
+        self.connection._request('AuthorizeSecurityGroupIngress')
+        self.rules.add((protocol, from_port, to_port, cidr))
+
+    def revoke(self, protocol, from_port, to_port, cidr):
+        self.connection._request('RevokeSecurityGroupIngress')
+        self.rules.discard((protocol, from_port, to_port, cidr))
+
+    def delete(self):
+        self.connection._request('DeleteSecurityGroup')
+        del self.connection.security_groups[self.id]
+
+class Instance(object):
+    '''An instance that runs its user data as a local process'''
+    def __init__(self, connection, id, image_id, shutdown_behavior):
+        self.connection = connection
+        self.id = id
+        self.image_id = image_id
+        self.shutdown_behavior = shutdown_behavior
+        self.state = 'pending'
+        self.public_dns_name = '127.0.0.1'
+        self.ip_address = '127.0.0.1'
+        self.private_ip_address = '127.0.0.1'
+        self.placement = connection.region.name + 'a'
+        self.block_device_mapping = {}
+        self.volumes = []
+        self.root = connection.cloud.path('instances', id)
+        self.halted = os.path.join(self.root, 'halted')
+        self.process = None
+
+    def attach(self, device, volume):
+        volume.instance = self
+        volume.device = device
+        volume.status = 'in-use'
+        self.volumes.append((device, volume))
+        self.block_device_mapping[device] = BlockDeviceType(
+                volume_id = volume.id, delete_on_termination = False)
+
+    def boot(self, user_data):
+        '''Run the user data with the instance's own ephemeral drive and
+           devices. Without user data, like the Windows instances, it just
+           keeps running.'''
+        if not user_data:
+            self.connection.cloud.change_state(self, 'instance start',
+                                               'state', 'running')
+            return
+        ephemeral = os.path.join(self.root, 'ephemeral0')
+        devices = os.path.join(self.root, 'dev')
+        os.makedirs(ephemeral)
+        os.makedirs(devices)
+        for device, volume in self.volumes:
+            os.rename(volume.path, os.path.join(devices,
+                                                'xvd' + device[-1]))
+            volume.path = os.path.join(devices, 'xvd' + device[-1])
+        script = os.path.join(self.root, 'user-data')
+        f = open(script, 'w')
+        f.write(user_data.replace('/media/ephemeral0', ephemeral)
+                         .replace('/dev/xvd', devices + '/xvd'))
+        f.close()
+        env = dict(os.environ, SIM_HALT = self.halted,
+                   PATH = self.connection.cloud.path('bin') + ':'
+                          + os.environ['PATH'])
+        self.process = subprocess.Popen(['sh', script], cwd = self.root,
+                stdout = open(os.path.join(self.root, 'console.log'), 'w'),
+                stderr = subprocess.STDOUT, env = env,
+                preexec_fn = os.setsid)
+        self.connection.cloud.change_state(self, 'instance start', 'state',
+                                           'running')
+        t = threading.Thread(target = self.watch)
+        t.daemon = True
+        t.start()
+
+    def watch(self):
+        '''Shut the instance down when its user data finishes'''
+        self.process.wait()
+        self.connection.cloud.wait_changes(self)
+        if self.state != 'running':
+            return
+        if os.path.exists(self.halted) and self.shutdown_behavior == \
+                'terminate':
+            self.shut_down('instance shutdown', 'terminated')
+        else:
+            self.shut_down('instance shutdown', 'stopped')
+
+    def shut_down(self, kind, state):
+        for device, volume in self.volumes:
+            volume.status = 'available'
+            if state == 'terminated' and \
+                    self.block_device_mapping[device].delete_on_termination:
+                volume.delete()
+        self.connection.cloud.change_state(self, kind, 'state', state)
+
+    def terminate(self):
+        self.connection._request('TerminateInstances')
+        self.connection.cloud.wait_changes(self)
+        if self.state in ('shutting-down', 'terminated'):
+            return
+        if self.process and self.process.poll() is None:
+            self.state = 'shutting-down'
+            os.killpg(self.process.pid, signal.SIGTERM)
+            self.process.wait()
+            self.connection.cloud.wait_changes(self)
+        if self.state != 'terminated':
+            self.shut_down('instance terminate', 'terminated')
+
+    def stop(self, force = False):
+        self.connection._request('StopInstances')
+        self.connection.cloud.wait_changes(self)
+        if self.state != 'running':
+            return
+        self.state = 'stopping'
+        if self.process and self.process.poll() is None:
+            os.killpg(self.process.pid, signal.SIGTERM)
+            self.process.wait()
+        self.connection.cloud.change_state(self, 'instance stop', 'state',
+                                           'stopped')
+
+class EC2Connection(object):
+    '''The API of one EC2 region that amicopy uses'''
+    def __init__(self, cloud, region):
+        self.cloud = cloud
+        self.region = Region(region)
+        self.images = {}
+        self.snapshots = {}
+        self.volumes = {}
+        self.instances = {}
+        self.security_groups = {}
+        self.tags = {}
+
+    def make_request(self, action, *args, **kwargs):
+        '''Stand in for the boto method that amicopy wraps to trace each
+           request'''
+        return None
+
+    def _request(self, action):
+        self.make_request(action)
+
+    def _lookup(self, objs, kind, ids):
+        if ids is None:
+            return objs.values()
+        missing = [i for i in ids if i not in objs]
+        if missing:
+            raise not_found(kind, missing)
+        return [objs[i] for i in ids]
+
+    def get_image(self, image_id):
+        self._request('DescribeImages')
+        image = self.images.get(image_id)
+        if image:
+            self.cloud.described([image])
+        return image
+
+    def get_all_images(self, image_ids = None, filters = {}):
+        self._request('DescribeImages')
+        images = self._lookup(self.images, 'AMIID', image_ids)
+        if 'name' in filters:
+            images = [i for i in images if i.name == filters['name']]
+        self.cloud.described(images)
+        return images
+
+    def get_all_snapshots(self, snapshot_ids = None, filters = {}):
+        self._request('DescribeSnapshots')
+        if 'snapshot-id' in filters:
+            snapshots = [self.snapshots[i] for i in filters['snapshot-id']
+                         if i in self.snapshots]
+        else:
+            snapshots = self._lookup(self.snapshots, 'Snapshot',
+                                     snapshot_ids)
+        self.cloud.described(snapshots)
+        if 'status' in filters:
+            snapshots = [s for s in snapshots
+                         if s.status == filters['status']]
+        return snapshots
+
+    def get_all_volumes(self, volume_ids = None):
+        self._request('DescribeVolumes')
+        volumes = self._lookup(self.volumes, 'Volume', volume_ids)
+        self.cloud.described(volumes)
+        return volumes
+
+    def get_all_instances(self, instance_ids = None):
+        self._request('DescribeInstances')
+        instances = self._lookup(self.instances, 'InstanceID', instance_ids)
+        self.cloud.described(instances)
+        return [Reservation([i]) for i in instances]
+
+    def get_all_security_groups(self, groupnames = None, group_ids = None):
+        self._request('DescribeSecurityGroups')
+        if groupnames:
+            return [sg for sg in self.security_groups.values()
+                    if sg.name in groupnames]
+        return self._lookup(self.security_groups, 'Group', group_ids)
+
+    def create_security_group(self, name, description):
+        self._request('CreateSecurityGroup')
+        sg = SecurityGroup(self, self.cloud.new_id('sg'), name)
+        self.security_groups[sg.id] = sg
+        return sg
+
+    def create_tags(self, ids, tags):
+        self._request('CreateTags')
+        for i in ids:
+            self.tags.setdefault(i, {}).update(tags)
+
+    def get_all_tags(self, filters = {}):
+        self._request('DescribeTags')
+        tags = self.tags.get(filters.get('resource-id'), {})
+        return [Tag(k, v) for k, v in tags.items()
+                if filters.get('key', k) == k]
+
+    def create_volume(self, device, bdt):
+        '''Create the volume of a block device mapping entry, from its
+           snapshot or empty'''
+        v = Volume(self, self.cloud.new_id('vol'), self.cloud.path(
+                   'volumes', self.cloud.new_id('data')), bdt.size,
+                   bdt.snapshot_id)
+        if bdt.snapshot_id:
+            subprocess.check_call(['cp', '--sparse=always',
+                                   self.snapshots[bdt.snapshot_id].path,
+                                   v.path])
+        else:
+            f = open(v.path, 'w')
+            f.truncate(bdt.size * 1073741824)
+            f.close()
+        v.status = 'in-use'
+        self.volumes[v.id] = v
+        return v
+
+    def run_instances(self, image_id, key_name = None, security_groups = [],
+                      user_data = '', instance_type = None,
+                      block_device_map = {}, placement = None,
+                      instance_initiated_shutdown_behavior = 'stop'):
+        self._request('RunInstances')
+        i = Instance(self, self.cloud.new_id('i'), image_id,
+                     instance_initiated_shutdown_behavior)
+        # The AMI's own volumes, for the AMIs the simulation registered
+        bdm = {}
+        if image_id in self.images:
+            bdm.update(self.images[image_id].block_device_mapping)
+        bdm.update(block_device_map)
+        for device, bdt in sorted(bdm.items()):
+            if bdt.ephemeral_name:
+                continue
+            v = self.create_volume(device, bdt)
+            i.attach(device, v)
+            i.block_device_mapping[device].delete_on_termination = \
+                    bdt.delete_on_termination
+        self.instances[i.id] = i
+        i.boot(user_data)
+        return Reservation([i])
+
+    def register_image(self, name, description = '', architecture = None,
+                       kernel_id = None, root_device_name = None,
+                       block_device_map = None):
+        self._request('RegisterImage')
+        image = Image(self, self.cloud.new_id('ami'), name,
+                      block_device_map, description, kernel_id,
+                      architecture, root_device_name)
+        image.state = 'pending'
+        self.images[image.id] = image
+        self.cloud.change_state(image, 'image', 'state', 'available')
+        return image.id
+
+    def create_image(self, instance_id, name, description = '',
+                     no_reboot = False):
+        '''Register an AMI with a snapshot of each volume of an instance'''
+        self._request('CreateImage')
+        i = self.instances[instance_id]
+        bdm = BlockDeviceMapping()
+        for device, volume in i.volumes:
+            ss = volume.create_snapshot('Created by CreateImage(%s)' % i.id)
+            bdm[device] = BlockDeviceType(snapshot_id = ss.id,
+                                          size = volume.size)
+        image_id = self.register_image(name, description,
+                                       root_device_name = '/dev/sda1',
+                                       block_device_map = bdm)
+        self.images[image_id].platform = self.images[i.image_id].platform
+        return image_id
+
+class Key(object):
+    def __init__(self, bucket, name):
+        self.bucket = bucket
+        self.name = name
+
+    def path(self):
+        return os.path.join(self.bucket.path, urllib.quote(self.name, ''))
+
+    def set_contents_from_string(self, data, headers = None):
+        self.bucket.connection.make_request('PUT')
+        self.bucket.cloud.store(self.bucket.name, self.name, data)
+
+    def get_contents_as_string(self):
+        self.bucket.connection.make_request('GET')
+        try:
+            return open(self.path()).read()
+        except IOError:
+            raise S3ResponseError(404, 'Not Found')
+
+    def delete(self):
+        self.bucket.connection.make_request('DELETE')
+        if os.path.exists(self.path()):
+            os.remove(self.path())
+
+    def generate_url(self, expires_in, method = 'GET', headers = None):
+        return 'http://127.0.0.1:%d/%s/%s?Expires=%d&Signature=sim' % (
+                self.bucket.cloud.s3_port, self.bucket.name,
+                urllib.quote(self.name, ''), time() + expires_in)
+
+class Bucket(object):
+    def __init__(self, connection, name):
+        self.connection = connection
+        self.cloud = connection.cloud
+        self.name = name
+        self.path = connection.cloud.path('s3', name)
+
+    def new_key(self, name):
+        return Key(self, name)
+
+    def get_key(self, name):
+        self.connection.make_request('HEAD')
+        key = Key(self, name)
+        return os.path.exists(key.path()) and key or None
+
+    def list(self, prefix = ''):
+        self.connection.make_request('GET')
+        names = [urllib.unquote(n) for n in os.listdir(self.path)]
+        return [Key(self, n) for n in sorted(names) if n.startswith(prefix)]
+
+    def delete_keys(self, names):
+        self.connection.make_request('POST')
+        for name in names:
+            Key(self, name).delete()
+
+    def delete(self):
+        self.connection.make_request('DELETE')
+        if os.listdir(self.path):
+            raise S3ResponseError(409, 'Conflict', error_code =
+                                  'BucketNotEmpty')
+        os.rmdir(self.path)
+
+class S3Connection(object):
+    def __init__(self, cloud):
+        self.cloud = cloud
+        self.aws_access_key_id = 'AKIASIMULATED'
+
+    def make_request(self, action, *args, **kwargs):
+        return None
+
+    def create_bucket(self, name, location = ''):
+        self.make_request('PUT')
+        if not os.path.isdir(self.cloud.path('s3', name)):
+            os.makedirs(self.cloud.path('s3', name))
+        return Bucket(self, name)
+
+    def get_bucket(self, name):
+        self.make_request('HEAD')
+        if not os.path.isdir(self.cloud.path('s3', name)):
+            raise S3ResponseError(404, 'Not Found', error_code =
+                                  'NoSuchBucket')
+        return Bucket(self, name)
+
+    def lookup(self, name):
+        try:
+            return self.get_bucket(name)
+        except S3ResponseError:
+            return None
+
+class S3Handler(BaseHTTPRequestHandler):
+    '''Serve the presigned URLs of the fake S3'''
+    protocol_version = 'HTTP/1.0'
+
+    def key(self):
+        bucket, name = self.path.split('?')[0].lstrip('/').split('/', 1)
+        return bucket, urllib.unquote(name)
+
+    def do_PUT(self):
+        data = self.rfile.read(int(self.headers['Content-Length']))
+        self.server.cloud.store(*self.key() + (data,))
+        self.send_response(200)
+        self.send_header('ETag', '"%s"' % hashlib.md5(data).hexdigest())
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def do_GET(self):
+        bucket, name = self.key()
+        try:
+            data = open(os.path.join(self.server.cloud.path('s3', bucket),
+                                     urllib.quote(name, ''))).read()
+        except IOError:
+            self.send_response(404)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        self.send_response(200)
+        self.send_header('ETag', '"%s"' % hashlib.md5(data).hexdigest())
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        pass
+
+class S3Server(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+class Cloud(object):
+    '''The fake EC2 regions and S3, kept in a work directory'''
+    def __init__(self, root, snapshot_rate = 0, state_delay = 0):
+        self.root = root
+        self.snapshot_rate = snapshot_rate
+        self.state_delay = state_delay
+        self.lock = threading.Lock()
+        self.ids = 0
+        # Each state change of an object and when amicopy first saw it
+        self.changes = []
+        self.first_described = {}
+        self.regions = {}
+        # The last progress report each instance uploaded, which outlives
+        # the bucket
+        self.reports = {}
+        for d in ('bin', 'instances', 's3', 'snapshots', 'volumes'):
+            os.makedirs(self.path(d))
+        for name, script in shims.items():
+            f = open(self.path('bin', name), 'w')
+            f.write(script)
+            f.close()
+            os.chmod(self.path('bin', name), 0755)
+        self.server = S3Server(('127.0.0.1', 0), S3Handler)
+        self.server.cloud = self
+        self.s3_port = self.server.server_address[1]
+        t = threading.Thread(target = self.server.serve_forever)
+        t.daemon = True
+        t.start()
+
+    def path(self, *parts):
+        return os.path.join(self.root, *parts)
+
+    def new_id(self, prefix):
+        self.lock.acquire()
+        self.ids += 1
+        n = self.ids
+        self.lock.release()
+        return '%s-%08x' % (prefix, n)
+
+    def store(self, bucket, name, data):
+        '''Write an S3 object, keeping any progress report'''
+        path = os.path.join(self.path('s3', bucket), urllib.quote(name, ''))
+        f = open(path + '.tmp', 'w')
+        f.write(data)
+        f.close()
+        os.rename(path + '.tmp', path)
+        if '/progress-' in name:
+            self.reports[name.rsplit('/progress-', 1)[1]] = json.loads(data)
+
+    def change_state(self, obj, kind, attr, value, delay = None):
+        '''Set a state attribute of an object once the delay for kind has
+           passed, as EC2 does a while after it's asked to'''
+        if delay is None:
+            delay = self.state_delay * state_delays[kind]
+        change = {'kind': kind, 'id': obj.id, 'asked': time(),
+                  'due': time() + delay, 'first': None, 'seen': None,
+                  'done': False}
+        def apply():
+            setattr(obj, attr, value)
+            change['done'] = True
+        self.lock.acquire()
+        self.changes.append(change)
+        self.lock.release()
+        if not hasattr(obj, 'timers'):
+            obj.timers = []
+        if delay > 0:
+            t = threading.Timer(delay, apply)
+            t.daemon = True
+            t.start()
+            obj.timers.append(t)
+        else:
+            apply()
+
+    def wait_changes(self, obj):
+        '''Wait for the state changes of an object that are on the way'''
+        for t in getattr(obj, 'timers', []):
+            t.join()
+
+    def described(self, objs):
+        '''Record that amicopy has seen the state of objects'''
+        now = time()
+        self.lock.acquire()
+        for o in objs:
+            self.first_described.setdefault(o.id, now)
+        for change in self.changes:
+            if change['id'] not in [o.id for o in objs]:
+                continue
+            if change['first'] is None:
+                change['first'] = now
+            if change['done'] and change['seen'] is None:
+                change['seen'] = now
+        self.lock.release()
+
+    def waits(self):
+        '''Return the state changes amicopy waited for, with how far into
+           the wait each happened and how long it took to see it. A wait is
+           taken to start at the first describe call after amicopy asked for
+           the change. For shutdowns, which amicopy doesn't ask for, it's
+           the first describe of the instance, so that how far into the
+           wait they happened isn't understated.'''
+        waits = []
+        for change in self.changes:
+            if change['seen'] is None:
+                continue
+            start = change['first']
+            if change['kind'] == 'instance shutdown':
+                start = self.first_described[change['id']]
+            waits.append({'kind': change['kind'], 'id': change['id'],
+                          'into': max(change['due'] - start, 0.0),
+                          'late': change['seen'] - max(change['due'],
+                                                       change['first'])})
+        return waits
+
+    def connect_to_region(self, region, **kwargs):
+        if region not in self.regions:
+            self.regions[region] = EC2Connection(self, region)
+        return self.regions[region]
+
+    def s3_connection(self, **kwargs):
+        return S3Connection(self)
+
+    def install(self):
+        '''Put the fake boto modules in place of the real ones'''
+        modules = {}
+        for name in ('boto', 'boto.exception', 'boto.s3',
+                     'boto.s3.connection', 'boto.ec2',
+                     'boto.ec2.blockdevicemapping'):
+            modules[name] = ModuleType(name)
+        modules['boto.exception'].EC2ResponseError = EC2ResponseError
+        modules['boto.exception'].S3ResponseError = S3ResponseError
+        modules['boto.s3.connection'].S3Connection = self.s3_connection
+        modules['boto.ec2'].connect_to_region = self.connect_to_region
+        modules['boto.ec2.blockdevicemapping'].BlockDeviceMapping = \
+                BlockDeviceMapping
+        modules['boto.ec2.blockdevicemapping'].BlockDeviceType = \
+                BlockDeviceType
+        sys.modules.update(modules)
+
+###############################################################################
+# Functions
+###############################################################################
+def fill(path, size, pattern):
+    '''Write size bytes of a data pattern to a file'''
+    text = ''.join('%d the quick brown fox jumps over the lazy dog\n' % i
+                   for i in xrange(block_size / 40))[:block_size]
+    f = open(path, 'w')
+    for offset in xrange(0, size, block_size):
+        n = min(block_size, size - offset)
+        kind = pattern
+        if pattern == 'mixed':
+            kind = ['random', 'zeros', 'text'][offset * 3 / size]
+        if kind == 'random':
+            f.write(os.urandom(n))
+        elif kind == 'text':
+            f.write(text[:n])
+        else:
+            f.seek(n, os.SEEK_CUR)
+    f.truncate(size)
+    f.close()
+
+def make_ami(cloud, opts):
+    '''Register the source AMI, with one volume of --size MB and the data
+       pattern per --volumes'''
+    ec2 = cloud.connect_to_region(source_region)
+    bdm = BlockDeviceMapping()
+    size = opts.size * block_size
+    for device in ami_devices[:opts.volumes]:
+        ss = Snapshot(ec2, cloud.new_id('snap'), cloud.path('snapshots',
+                      cloud.new_id('data')), (size - 1) / 1073741824 + 1)
+        fill(ss.path, size, opts.pattern)
+        ec2.snapshots[ss.id] = ss
+        bdm[device] = BlockDeviceType(snapshot_id = ss.id,
+                                      size = ss.volume_size)
+    image = Image(ec2, cloud.new_id('ami'), 'amicopy-sim', bdm,
+                  'Simulated AMI')
+    if opts.windows:
+        image.platform = 'windows'
+    ec2.images[image.id] = image
+    return image
+
+def make_windows_amis(cloud, regions):
+    '''Register a Windows AMI in each region for amicopy to start the
+       instance it creates the copy from with, and return their ids'''
+    ids = []
+    for region in regions:
+        ec2 = cloud.connect_to_region(region)
+        ss = Snapshot(ec2, cloud.new_id('snap'), cloud.path('snapshots',
+                      cloud.new_id('data')), 1)
+        fill(ss.path, block_size, 'text')
+        ec2.snapshots[ss.id] = ss
+        bdm = BlockDeviceMapping()
+        bdm['/dev/sda1'] = BlockDeviceType(snapshot_id = ss.id, size = 1,
+                                           delete_on_termination = True)
+        image = Image(ec2, cloud.new_id('ami'), 'windows-sim', bdm,
+                      'Simulated Windows AMI')
+        image.platform = 'windows'
+        ec2.images[image.id] = image
+        ids.append(image.id)
+    return ids
+
+def same_data(source, copy):
+    '''Check that a copied volume starts with the source data and is zero
+       after it'''
+    a = open(source)
+    b = open(copy)
+    while True:
+        data = a.read(block_size)
+        if not data:
+            break
+        if b.read(len(data)) != data:
+            return False
+    while True:
+        data = b.read(block_size)
+        if not data:
+            return True
+        if data.count('\0') != len(data):
+            return False
+
+def check_copies(cloud, image, regions):
+    '''Return True if the AMI in every region has the source data, and no
+       snapshot was left behind that isn't part of an AMI'''
+    ok = True
+    for region in regions:
+        ec2 = cloud.connect_to_region(region)
+        used = set(bdt.snapshot_id for i in ec2.images.values()
+                   for bdt in i.block_device_mapping.values())
+        unused = sorted(set(ec2.snapshots) - used)
+        if unused:
+            print 'Snapshots left behind in %s: %s' % (region,
+                                                       ', '.join(unused))
+            ok = False
+        copies = [i for i in ec2.images.values() if i.name == image.name]
+        if len(copies) != 1:
+            print 'No AMI was registered in %s' % region
+            ok = False
+            continue
+        if copies[0].platform != image.platform:
+            print 'The AMI in %s is not a %s AMI' % (region, image.platform)
+            ok = False
+        for device, bdt in sorted(image.block_device_mapping.items()):
+            source = image.connection.snapshots[bdt.snapshot_id].path
+            copy = ec2.snapshots[copies[0].block_device_mapping[device]
+                                 .snapshot_id].path
+            if not same_data(source, copy):
+                print '%s in %s is not the same as the source' % (device,
+                                                                  region)
+                ok = False
+    return ok
+
+def stage_rates(reports):
+    '''Return {instance: {stage: (bytes, seconds)}} from the last progress
+       report of each instance'''
+    rates = {}
+    for instance, report in reports.items():
+        stages = {}
+        for volume, volume_stages in report['volumes'].items():
+            for stage, (size, done, start, updated) in volume_stages.items():
+                if stage == 'synced':
+                    # Only marks the volume as written
+                    continue
+                s = stages.setdefault(stage, [0, start, updated])
+                s[0] += size
+                s[1] = min(s[1], start)
+                s[2] = max(s[2], updated)
+        rates[instance] = dict((stage, (s[0], s[2] - s[1]))
+                               for stage, s in stages.items())
+    return rates
+
+def simulate(opts, amicopy_args, env = None):
+    '''Copy a simulated AMI with amicopy and return the results. amicopy
+       runs with env as its globals if it's given.'''
+    work = tempfile.mkdtemp(prefix = 'amicopy-sim-', dir = opts.work_dir)
+    cloud = Cloud(work, opts.snapshot_rate, opts.state_delay)
+    cloud.install()
+    image = make_ami(cloud, opts)
+    regions = destination_regions[:opts.destinations]
+
+    # amicopy loads the helper and the tsunami binaries from its directory
+    home = os.path.dirname(os.path.abspath(__file__))
+    os.makedirs(os.path.join(work, 'tsunami-udp'))
+    os.symlink(os.path.join(home, 'amicopy_helper.py'),
+               os.path.join(work, 'amicopy_helper.py'))
+    for binary in ('tsunami', 'tsunamid'):
+        path = os.path.join(home, 'tsunami-udp', binary)
+        if os.path.exists(path):
+            os.symlink(path, os.path.join(work, 'tsunami-udp', binary))
+        else:
+            open(os.path.join(work, 'tsunami-udp', binary), 'w').write(
+                    '#!/bin/sh\necho %s has not been built >&2\nexit 1\n'
+                    % binary)
+
+    argv = ['amicopy.py', image.id, source_region, ','.join(regions),
+            '--transport', opts.transport, '--name', 'sim',
+            '--state-dir', os.path.join(work, 'state')] + amicopy_args
+    if opts.windows:
+        argv += ['--dst-ami', ','.join(make_windows_amis(cloud, regions))]
+    print 'Copying %d x %d MB of %s data%s with --transport %s to %s' % (
+          opts.volumes, opts.size, opts.pattern, opts.windows and
+          ' (Windows)' or '', opts.transport, ', '.join(regions))
+    cwd = os.getcwd()
+    os.chdir(work)
+    sys.argv = argv
+    start = time()
+    try:
+        if env is None:
+            env = {}
+        env['__name__'] = '__main__'
+        execfile(os.path.join(home, 'amicopy.py'), env)
+        status = 0
+    except SystemExit, e:
+        status = e.code
+    elapsed = time() - start
+    os.chdir(cwd)
+
+    ok = not status and check_copies(cloud, image, regions)
+    rates = stage_rates(cloud.reports)
+    total = opts.volumes * opts.size * block_size
+
+    # End to end is from the first read on the source to the last write on
+    # a destination
+    starts = []
+    ends = []
+    for instance, report in cloud.reports.items():
+        for volume_stages in report['volumes'].values():
+            if instance == 'source' and 'read' in volume_stages:
+                starts.append(volume_stages['read'][2])
+            if instance != 'source' and 'written' in volume_stages:
+                ends.append(volume_stages['written'][3])
+    transfer = starts and ends and max(ends) - min(starts) or 0.0
+
+    print '%s: amicopy took %.1f s, the transfer %.1f s (%.1f MB/s end to' \
+          ' end)' % (ok and 'OK' or 'FAILED', elapsed, transfer,
+                     transfer and total / transfer / block_size or 0.0)
+    for instance, stages in sorted(rates.items()):
+        for stage, (size, seconds) in sorted(stages.items(),
+                key = lambda s: stage_order.index(s[0])
+                                if s[0] in stage_order else 99):
+            print '  %-10s %-10s %8.1f MB %7.1f s %8.1f MB/s' % (instance,
+                  stage, size / 1048576.0, seconds,
+                  seconds and size / seconds / 1048576 or 0.0)
+    waits = cloud.waits()
+    if opts.state_delay:
+        for w in waits:
+            print '  %-18s %-13s %7.1f s in, seen %5.1f s later' % (
+                  w['kind'], w['id'], w['into'], w['late'])
+
+    if opts.keep:
+        print 'Work directory: %s' % work
+    else:
+        shutil.rmtree(work, True)
+    return {'time': time(), 'pattern': opts.pattern,
+            'transport': opts.transport, 'volumes': opts.volumes,
+            'size': opts.size, 'destinations': opts.destinations,
+            'options': amicopy_args, 'ok': bool(ok), 'elapsed': elapsed,
+            'transfer': transfer, 'waits': waits,
+            'mbps': transfer and total / transfer / block_size or 0.0,
+            'stages': dict((instance, dict((stage, size / seconds / 1048576
+                                            if seconds else 0.0)
+                                           for stage, (size, seconds)
+                                           in stages.items()))
+                           for instance, stages in rates.items())}
+
+# Order the stages are listed in
+stage_order = ['read', 'staged', 'uploaded', 'received', 'downloaded',
+               'written']
+
+def tsunami_built():
+    '''Return True if the tsunami binaries have been built'''
+    return os.path.exists(os.path.join(os.path.dirname(os.path.abspath(
+            __file__)), 'tsunami-udp', 'tsunamid'))
+
+def run_suite(opts, amicopy_args):
+    '''Simulate every pattern with every transport that can run here, each
+       in its own process, and print a table of the results'''
+    suite_transports = [t for t in ('tsunami', 'tcp', 's3') if
+                        tsunami_built() or t != 'tsunami']
+    results_file = tempfile.NamedTemporaryFile(prefix = 'amicopy-sim-')
+    for pattern in ('random', 'zeros', 'text'):
+        for transport in suite_transports:
+            argv = [sys.executable, os.path.abspath(__file__),
+                    '--pattern', pattern, '--transport', transport,
+                    '--size', str(opts.size), '--volumes', str(opts.volumes),
+                    '--destinations', str(opts.destinations),
+                    '--snapshot-rate', str(opts.snapshot_rate),
+                    '--state-delay', str(opts.state_delay),
+                    '--results', results_file.name]
+            if opts.windows:
+                argv.append('--windows')
+            if opts.work_dir:
+                argv += ['--work-dir', opts.work_dir]
+            subprocess.call(argv + amicopy_args)
+    results = [json.loads(l) for l in open(results_file.name)]
+    results_file.close()
+
+    print
+    print '%-8s %-8s %10s %10s %12s  %s' % ('pattern', 'transport',
+            'amicopy', 'transfer', 'end to end', 'result')
+    for r in results:
+        print '%-8s %-8s %9.1fs %9.1fs %7.1f MB/s  %s' % (r['pattern'],
+                r['transport'], r['elapsed'], r['transfer'], r['mbps'],
+                r['ok'] and 'OK' or 'FAILED')
+    if opts.results:
+        f = open(opts.results, 'a')
+        for r in results:
+            f.write(json.dumps(r) + '\n')
+        f.close()
+    return all(r['ok'] for r in results) and len(results) == \
+           3 * len(suite_transports)
+
+###############################################################################
+# Checks
+###############################################################################
+def helper_command(*args):
+    '''Return the command line that runs the helper with args'''
+    return [sys.executable, os.path.join(os.path.dirname(os.path.abspath(
+            __file__)), 'amicopy_helper.py')] + list(args)
+
+def which(command):
+    '''Return the path of a command, or None if it isn't installed'''
+    for d in os.environ['PATH'].split(os.pathsep) + tool_dirs:
+        path = os.path.join(d, command)
+        if os.access(path, os.X_OK):
+            return path
+    return None
+
+def check_result(ok, what):
+    '''Print the result of a check and return it'''
+    print '%s: %s' % (ok and 'OK' or 'FAILED', what)
+    return ok
+
+def skip_check(what, reason):
+    '''Print that a check can't run here'''
+    print 'SKIPPED: %s (%s)' % (what, reason)
+    return True
+
+def start_pipeline(commands, log, stdin = None, stdout = None, cwd = None):
+    '''Start commands with the output of each piped to the next and that of
+       the last to stdout, or to the log, and return their processes'''
+    processes = []
+    for i, command in enumerate(commands):
+        p = subprocess.Popen(command, stdin = stdin, stderr = log, cwd = cwd,
+                             stdout = i < len(commands) - 1 and
+                                      subprocess.PIPE or stdout or log)
+        if stdin is not None and processes:
+            stdin.close()
+        stdin = p.stdout
+        processes.append(p)
+    return processes
+
+def finished(processes):
+    '''Wait for processes and return True if they all succeeded'''
+    return all([p.wait() == 0 for p in processes])
+
+def run_pipeline(commands, log, stdin = None, stdout = None, cwd = None):
+    '''Run commands with the output of each piped to the next, and return
+       True if they all succeeded'''
+    return finished(start_pipeline(commands, log, stdin, stdout, cwd))
+
+def make_filesystem(work, fs, mkfs, mount_type, files):
+    '''Make a filesystem image over old data, write files to it and delete
+       some of them. Return the image and the files that are left.'''
+    image = os.path.join(work, fs + '.img')
+    mnt = os.path.join(work, 'mnt')
+    if not os.path.isdir(mnt):
+        os.makedirs(mnt)
+    # The free space holds old data, which shouldn't be copied
+    fill(image, check_fs_size * block_size, 'text')
+    subprocess.check_call(mkfs + [image], stdout = open(os.devnull, 'w'))
+    subprocess.check_call(['mount', '-o', 'loop', '-t', mount_type, image,
+                           mnt])
+    try:
+        os.makedirs(os.path.join(mnt, 'data'))
+        for i in xrange(check_files):
+            files['data/file%d' % i] = os.urandom((i + 1) * 300000)
+        for name, data in files.items():
+            f = open(os.path.join(mnt, name), 'w')
+            f.write(data)
+            f.close()
+        for i in xrange(0, check_files, 3):
+            os.remove(os.path.join(mnt, 'data/file%d' % i))
+            del files['data/file%d' % i]
+    finally:
+        subprocess.check_call(['umount', mnt])
+    return image
+
+def same_files(image, mount_type, files, work):
+    '''Mount an image read-only and return True if it has the files'''
+    mnt = os.path.join(work, 'mnt')
+    subprocess.check_call(['mount', '-o', 'loop,ro', '-t', mount_type,
+                           image, mnt])
+    try:
+        return all([open(os.path.join(mnt, name)).read() == data
+                    for name, data in files.items()])
+    finally:
+        subprocess.check_call(['umount', mnt])
+
+def check_used_blocks(opts, work):
+    '''Copy ext4, XFS and NTFS images that have deleted files on them with
+       read --used-only, and check that the files that are left survive,
+       the copy passes fsck and the free space wasn't copied'''
+    ok = True
+    log = open(os.path.join(work, 'used-blocks.log'), 'w')
+    for fs, mkfs, mount_type, fsck in check_filesystems:
+        what = 'read --used-only of %s' % fs
+        if os.geteuid() != 0:
+            skip_check(what, 'mounting the images needs root')
+            continue
+        if not which(mkfs[0]) or not which(fsck[0]):
+            skip_check(what, '%s or %s is not installed' % (mkfs[0],
+                                                            fsck[0]))
+            continue
+        mkfs = [which(mkfs[0])] + mkfs[1:]
+        fsck = [which(fsck[0])] + fsck[1:]
+        files = {}
+        image = make_filesystem(work, fs, mkfs, mount_type, files)
+        copy = image + '.copy'
+        f = open(copy, 'w')
+        f.truncate(check_fs_size * block_size)
+        f.close()
+        copied = run_pipeline([helper_command('read', '--used-only', image),
+                               helper_command('write', copy)], log)
+        if not check_result(copied, what):
+            ok = False
+            continue
+
+        # Every block of the old data that was copied is a block the parser
+        # thought was in use
+        a = open(image)
+        b = open(copy)
+        skipped = 0
+        while True:
+            data = a.read(block_size)
+            if not data:
+                break
+            if b.read(block_size) != data:
+                skipped += 1
+        ok = check_result(skipped * 2 > check_fs_size,
+                          '%s left old data out of %d of %d MB' % (what,
+                          skipped, check_fs_size)) and ok
+        ok = check_result(subprocess.call(fsck + [copy], stdout = log,
+                                          stderr = log) == 0,
+                          '%s copy passes %s' % (fs, fsck[0])) and ok
+        ok = check_result(same_files(copy, mount_type, files, work),
+                          '%s copy has the %d files that weren\'t deleted'
+                          % (fs, len(files))) and ok
+        os.remove(image)
+        os.remove(copy)
+    return ok
+
+def check_waiters(opts, work):
+    '''Copy an AMI with the state changes taking a while, and check that
+       amicopy sees each one within the poll interval it has backed off to
+       by then'''
+    sim_opts = copy(opts)
+    sim_opts.size = 8
+    sim_opts.volumes = 2
+    sim_opts.pattern = 'mixed'
+    sim_opts.transport = 'tcp'
+    sim_opts.destinations = 2
+    sim_opts.snapshot_rate = 0
+    sim_opts.state_delay = check_state_delay
+    sim_opts.work_dir = work
+    env = {}
+    result = simulate(sim_opts, [], env)
+    ok = check_result(result['ok'], 'copy with state changes taking'
+                      ' %.0f-%.0f s' % (check_state_delay * min(
+                      state_delays.values()), check_state_delay *
+                      max(state_delays.values())))
+
+    # A change that happens t seconds into a wait is seen by the end of the
+    # poll interval then, which is at most poll_min + (backoff - 1) * t
+    # before jitter, and never more than poll_max
+    poll_min, poll_max, backoff, jitter = [env[name] for name in
+            ('poll_min', 'poll_max', 'poll_backoff', 'poll_jitter')]
+    for w in result['waits']:
+        bound = (1 + jitter) * min(poll_max, poll_min + (backoff - 1) *
+                                   w['into'] / (1 - jitter)) + check_slack
+        ok = check_result(w['late'] <= bound, '%s %s seen %.1f s after it'
+                          ' happened %.1f s into the wait (at most %.1f s)'
+                          % (w['kind'], w['id'], w['late'], w['into'],
+                             bound)) and ok
+    kinds = set([w['kind'] for w in result['waits']])
+    for kind in ('instance start', 'instance shutdown', 'snapshot',
+                 'image', 'instance terminate'):
+        ok = check_result(kind in kinds, 'amicopy waited for %s' % kind) \
+             and ok
+    return ok
+
+def free_port():
+    '''Return a loopback TCP port that nothing is listening on'''
+    s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    s.bind(('127.0.0.1', 0))
+    port = s.getsockname()[1]
+    s.close()
+    return port
+
+def same_stream(source, copy):
+    '''Return True if a stream was received whole'''
+    return os.path.exists(copy) and filecmp.cmp(source, copy, False)
+
+def check_streams(opts, work):
+    '''Send a stream over loopback with serve/fetch and through the fake S3
+       with s3-put/s3-get, split a device into stripes and a stream into
+       chunks and join them again, and check that it all arrives whole.
+       When an encrypted stream is cut short or its source fails, the
+       receiving end has to fail.'''
+    ok = True
+    log = open(os.path.join(work, 'streams.log'), 'w')
+    source = os.path.join(work, 'source')
+    fill(source, check_stream_size, 'mixed')
+    received = os.path.join(work, 'received')
+    secret = os.path.join(work, 'secret.txt')
+    f = open(secret, 'w')
+    f.write(os.urandom(32).encode('hex'))
+    f.close()
+    encrypt = helper_command('encrypt', '--key-file', secret)
+    decrypt = helper_command('decrypt', '--key-file', secret)
+    cut = ['head', '-c', str(check_stream_size / 2)]
+
+    # Every client gets the stream, over however many connections it uses
+    port = free_port()
+    serve = helper_command('serve', '--port', str(port))
+    fetch = helper_command('fetch', '--host', '127.0.0.1', '--port',
+                           str(port))
+    server = start_pipeline([serve + ['--clients',
+                             str(len(check_stream_clients))]], log,
+                            open(source))
+    clients = [start_pipeline([fetch + ['--streams', str(n)]], log,
+                              stdout = open('%s-%d' % (received, n), 'w'))
+               for n in check_stream_clients]
+    served = finished(server)
+    for n, client in zip(check_stream_clients, clients):
+        ok = check_result(finished(client) and served and same_stream(source,
+                          '%s-%d' % (received, n)), 'serve/fetch with'
+                          ' --streams %d' % n) and ok
+
+    # The server sends what it got in full, so the cut is only noticed by
+    # decrypt at the far end
+    server = start_pipeline([encrypt, cut, serve + ['--clients', '1']], log,
+                            open(source))
+    client = start_pipeline([fetch + ['--streams', '2'], decrypt], log,
+                            stdout = open(received, 'w'))
+    ok = check_result(not finished(client), 'serve/fetch of a cut stream'
+                      ' fails') and ok
+    finished(server)
+
+    # The source pipeline touches the .ok file only if reading succeeded
+    ok_file = os.path.join(work, 'read.ok')
+    ok = check_result(not run_pipeline([encrypt + ['--ok-file', ok_file],
+                      decrypt], log, open(source), open(received, 'w')),
+                      'encrypt aborts the stream when the source fails') \
+         and ok
+    open(ok_file, 'w').close()
+    ok = check_result(run_pipeline([encrypt + ['--ok-file', ok_file],
+                      decrypt], log, open(source), open(received, 'w')) and
+                      same_stream(source, received), 'encrypt ends the stream'
+                      ' when the source succeeds') and ok
+
+    # s3-get downloads the parts while s3-put is still uploading them
+    cloud = Cloud(os.path.join(work, 'cloud'))
+    bucket = cloud.s3_connection().create_bucket('check')
+    urls = os.path.join(work, 'urls.txt')
+    f = open(urls, 'w')
+    for name in ('whole', 'cut'):
+        for i in xrange(check_stream_size / block_size + 2):
+            f.write('%s %d %s\n' % (name, i, bucket.new_key('%s-%d' % (name,
+                    i)).generate_url(3600, 'PUT')))
+        f.write('%s done %s\n' % (name, bucket.new_key(name + '-done')
+                                   .generate_url(3600, 'PUT')))
+    f.close()
+    s3_opts = ['--urls', urls, '--part-size', '1', '--streams', '4']
+    put = start_pipeline([helper_command('s3-put', 'whole', *s3_opts)], log,
+                         open(source), cwd = work)
+    get = start_pipeline([helper_command('s3-get', 'whole', *s3_opts)], log,
+                         stdout = open(received, 'w'), cwd = work)
+    ok = check_result(finished(put) and finished(get) and
+                      same_stream(source, received), 's3-put/s3-get') and ok
+    put = start_pipeline([encrypt, cut, helper_command('s3-put', 'cut',
+                          *s3_opts)], log, open(source), cwd = work)
+    get = start_pipeline([helper_command('s3-get', 'cut', *s3_opts),
+                          decrypt], log, stdout = open(received, 'w'),
+                         cwd = work)
+    ok = check_result(not finished(get), 's3-put/s3-get of a cut stream'
+                      ' fails') and ok
+    finished(put)
+    cloud.server.shutdown()
+
+    # The stripes are all written to the copy at once
+    striped = os.path.join(work, 'striped')
+    f = open(striped, 'w')
+    f.truncate(check_stream_size)
+    f.close()
+    stripes = [start_pipeline([helper_command('read', '--stripe', '%d/%d' %
+                               (i, check_stripes), source),
+                               helper_command('write', striped)], log)
+               for i in xrange(check_stripes)]
+    ok = check_result(all([finished(p) for p in stripes]) and
+                      same_stream(source, striped), 'read --stripe of %d'
+                      ' stripes' % check_stripes) and ok
+
+    prefix = os.path.join(work, 'chunk')
+    manifest = prefix + '.manifest'
+    ok = check_result(run_pipeline([helper_command('split', '--chunk-size',
+                      str(check_chunk_size), '--manifest', manifest,
+                      prefix)], log, open(source)) and
+                      run_pipeline([helper_command('join', manifest)], log,
+                      stdout = open(received, 'w')) and
+                      same_stream(source, received), 'split/join of %d MB'
+                      ' chunks' % check_chunk_size) and ok
+    chunk = prefix + '00001'
+    f = open(chunk, 'r+b')
+    f.seek(1000)
+    byte = f.read(1)
+    f.seek(1000)
+    f.write(chr(ord(byte) ^ 1))
+    f.close()
+    ok = check_result(not run_pipeline([helper_command('join', manifest)],
+                      log, stdout = open(received, 'w')) and
+                      not os.path.exists(chunk), 'join of a corrupt chunk'
+                      ' fails and removes it') and ok
+
+    # The meters all start at once, with no progress directory yet
+    meters = os.path.join(work, 'meters')
+    os.makedirs(meters)
+    processes = [start_pipeline([helper_command('meter', 'vol%d.read' % i)],
+                                log, open(source), open(os.devnull, 'w'),
+                                meters)
+                 for i in xrange(check_meters)]
+    metered = all([finished(p) for p in processes])
+    for i in xrange(check_meters):
+        path = os.path.join(meters, 'progress', 'vol%d.read' % i)
+        metered = metered and os.path.exists(path) and \
+                  open(path).read().split()[:2] == [str(check_stream_size),
+                                                    '1']
+    ok = check_result(metered, '%d meters starting at once' % check_meters) \
+         and ok
+    return ok
+
+def run_probe(work, log, name, netem = None):
+    '''Run probe-server and probe on loopback, in a network namespace with
+       netem on it if that's given. Return the exit status, what probe
+       printed and the link it saved.'''
+    cwd = os.path.join(work, name)
+    os.makedirs(cwd)
+    port = str(free_port())
+    server = helper_command('probe-server', '--port', port)
+    probe = helper_command('probe', '--host', '127.0.0.1', '--port', port,
+                           '--udp-port', str(free_port()))
+    script = ('%s > /dev/null 2>&1 &\n%s\nSTATUS=$?\nkill $!\n'
+              'exit $STATUS\n' % (' '.join(map(pipes.quote, server)),
+                                   ' '.join(map(pipes.quote, probe))))
+    command = ['sh', '-c', script]
+    if netem:
+        script = ('ip link set lo up || exit %d\n'
+                  'tc qdisc add dev lo root netem %s || exit %d\n'
+                  % (check_skipped, netem, check_skipped)) + script
+        command = ['unshare', '--net', 'sh', '-c', script]
+    p = subprocess.Popen(command, stdout = subprocess.PIPE, stderr = log,
+                         cwd = cwd)
+    output = p.communicate()[0].strip()
+    link = None
+    if p.returncode == 0:
+        link = json.load(open(os.path.join(cwd, amicopy_helper.link_file)))
+    return p.returncode, output, link
+
+def check_probe(opts, work):
+    '''Probe the link over loopback, and over loopback made slower with
+       netem if it's available, and check the tsunami settings that are
+       picked from it'''
+    ok = True
+    log = open(os.path.join(work, 'probe.log'), 'w')
+    cases = [('loopback', None)]
+    if os.geteuid() != 0:
+        skip_check('probe with netem', 'network namespaces need root')
+    elif not which('unshare') or not which('tc') or not which('ip'):
+        skip_check('probe with netem', 'unshare, tc or ip is not installed')
+    else:
+        cases.append(('netem', check_netem))
+    for name, netem in cases:
+        status, output, link = run_probe(work, log, name, netem)
+        if status == check_skipped:
+            skip_check('probe with netem', 'netem can\'t be set up here')
+            continue
+        if not check_result(status == 0, 'probe on %s' % name):
+            ok = False
+            continue
+
+        # What probe printed has to be what tsunami_settings() makes of
+        # the link it saved
+        settings = amicopy_helper.tsunami_settings(link)
+        ok = check_result(output == 'set rate %(rate)dM set error %(error)s'
+                          ' set blocksize %(blocksize)d' % settings and
+                          link['settings'] == settings, '%s: probe printed'
+                          ' "%s"' % (name, output)) and ok
+        ok = check_result(settings['blocksize'] ==
+                          amicopy_helper.tsunami_blocksize, '%s: blocksize'
+                          ' %d' % (name, settings['blocksize'])) and ok
+        ok = check_result(5.0 <= settings['error'] <= 20.0, '%s: error'
+                          ' %.1f%% with %.2f%% loss at %d Mbit/s' % (name,
+                          settings['error'], link['steps'][0]['loss'] *
+                          100, link['steps'][0]['rate'])) and ok
+        lowest = link['steps'][0]['mbps']
+        highest = max([s['mbps'] for s in link['steps']])
+        if netem:
+            ok = check_result(link['rtt'] >= check_netem_rtt, '%s: RTT'
+                              ' %.1f ms' % (name, link['rtt'] * 1000)) and ok
+            highest = min(highest, check_netem_rate * 1.1)
+        else:
+            highest = max(highest, amicopy_helper.tsunami_default_rate)
+        ok = check_result(lowest * 0.9 <= settings['rate'] <= highest,
+                          '%s: rate %dM from %s Mbit/s' % (name,
+                          settings['rate'], ', '.join(['%.0f' % s['mbps']
+                          for s in link['steps']]))) and ok
+    return ok
+
+def check_windows(opts, work):
+    '''Copy a Windows AMI, which amicopy registers from an instance with
+       the copied volumes attached, and check that no snapshot is left
+       behind'''
+    sim_opts = copy(opts)
+    sim_opts.size = 8
+    sim_opts.volumes = 2
+    sim_opts.pattern = 'mixed'
+    sim_opts.transport = 'tcp'
+    sim_opts.destinations = 2
+    sim_opts.snapshot_rate = 0
+    sim_opts.state_delay = 0
+    sim_opts.windows = True
+    sim_opts.work_dir = work
+    return check_result(simulate(sim_opts, [])['ok'], 'copy of a Windows'
+                        ' AMI')
+
+# Checks that --check can run
+checks = {
+        'probe':        check_probe,
+        'streams':      check_streams,
+        'used-blocks':  check_used_blocks,
+        'waiters':      check_waiters,
+        'windows':      check_windows,
+        }
+
+def run_checks(opts):
+    '''Run the --check checks, each in a work directory of its own, and
+       return True if they all passed'''
+    names = 'all' in opts.check and sorted(checks) or opts.check
+    ok = True
+    for name in names:
+        work = tempfile.mkdtemp(prefix = 'amicopy-check-',
+                                dir = opts.work_dir)
+        print 'Checking %s' % name
+        ok = checks[name](opts, work) and ok
+        if opts.keep:
+            print 'Work directory: %s' % work
+        else:
+            shutil.rmtree(work, True)
+    return ok
+
+###############################################################################
+# Command Line
+###############################################################################
+if __name__ == '__main__':
+    parser = ArgumentParser(description = 'Copy a simulated AMI with amicopy'
+                            ' on this machine and report the throughput of'
+                            ' each stage. Options that aren\'t listed here'
+                            ' are passed on to amicopy.')
+    parser.add_argument('--size', type = int, default = 256, metavar = 'MB',
+                        help = 'size of each volume (default: %(default)s)')
+    parser.add_argument('--volumes', type = int, default = 2,
+                        help = 'number of volumes in the AMI (default:'
+                               + ' %(default)s)')
+    parser.add_argument('--pattern', default = 'random', choices = patterns,
+                        help = 'data in the volumes (default: %(default)s)')
+    parser.add_argument('--transport', default = 'tcp',
+                        choices = transports,
+                        help = 'amicopy transport (default: %(default)s)')
+    parser.add_argument('--destinations', type = int, default = 1,
+                        choices = range(1, len(destination_regions) + 1),
+                        help = 'number of destination regions (default:'
+                               + ' %(default)s)')
+    parser.add_argument('--snapshot-rate', type = float, default = 0,
+                        metavar = 'MB/s',
+                        help = 'how fast destination snapshots complete, 0'
+                               + ' for at once (default: %(default)s)')
+    parser.add_argument('--state-delay', type = float, default = 0,
+                        metavar = 'SECONDS',
+                        help = 'how long instances take to start. Other'
+                               + ' state changes take a multiple of it, 0'
+                               + ' for at once (default: %(default)s)')
+    parser.add_argument('--windows', action = 'store_true', default = False,
+                        help = 'copy a Windows AMI, which amicopy registers'
+                               + ' from an instance with the copied volumes'
+                               + ' attached')
+    parser.add_argument('--suite', action = 'store_true', default = False,
+                        help = 'run every pattern with every transport'
+                               + ' that can run here')
+    parser.add_argument('--results', metavar = 'FILE',
+                        help = 'append the results to FILE as lines of JSON')
+    parser.add_argument('--work-dir', metavar = 'DIR',
+                        help = 'directory for the volumes, snapshots and'
+                               + ' instances (default: the temp directory)')
+    parser.add_argument('--keep', action = 'store_true', default = False,
+                        help = 'keep the work directory to look at the'
+                               + ' instance logs')
+    parser.add_argument('--check', action = 'append', metavar = 'NAME',
+                        choices = sorted(checks) + ['all'],
+                        help = 'instead of a copy, run a check of part of'
+                               + ' amicopy: %s or all (can be repeated)'
+                               % ', '.join(sorted(checks)))
+    opts, amicopy_args = parser.parse_known_args()
+
+    if not 1 <= opts.volumes <= len(ami_devices):
+        parser.error('--volumes must be 1-%d' % len(ami_devices))
+    if not opts.suite and opts.transport in ('tsunami', 'auto') and \
+            not tsunami_built():
+        parser.error('--transport %s needs the tsunami binaries, run make'
+                     % opts.transport)
+    if opts.destinations > 1 and opts.transport in ('tsunami', 'auto'):
+        # Every destination would receive on the same UDP ports
+        parser.error('tsunami can only copy to one destination here')
+
+    if opts.check:
+        sys.exit(not run_checks(opts) and 1 or 0)
+    if opts.suite:
+        sys.exit(not run_suite(opts, amicopy_args) and 1 or 0)
+    result = simulate(opts, amicopy_args)
+    if opts.results:
+        f = open(opts.results, 'a')
+        f.write(json.dumps(result) + '\n')
+        f.close()
+    sys.exit(not result['ok'] and 1 or 0)
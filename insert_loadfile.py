@@ -1,6 +1,6 @@
 #!/usr/bin/env python
 #
-# insert_loadfile.py - Replace load_file calls with the actual file
+# insert_loadfile.py - Embed the files of Artifact calls, base64 encoded
 
 import re
 from sys import argv, stderr
@@ -10,7 +10,7 @@ from base64 import encodestring
 if len(argv) != 3:
     print >> stderr, 'usage: %s INPUTFILE OUTPUT' % argv[0]
 
-pat = re.compile(r'''=\s*load_file\s*\( *['"]([^'"]+)['"] *\)''')
+pat = re.compile(r'''\bArtifact\( *['"]([^'"]+)['"] *\)''')
 
 f = open(argv[1])
 
@@ -20,7 +20,7 @@ for l in f:
     m = pat.search(l)
     if m:
         i = encodestring(open(m.group(1)).read())
-        l = pat.sub(r"""= b64decode('''\n%s''')""" % i, l)
+        l = pat.sub(r"""Artifact('\1', '''\n%s''')""" % i, l)
 
     out += l
 